@@ -1,5 +1,7 @@
 # This file holds the definition and key functions of the actual CORPSE model
 
+from functools import lru_cache
+
 # List of parameters the model needs
 expected_params={'vmaxref': 'Relative maximum enzymatic decomp rates for each microbe pool (length 3)',
         	'Ea':	'Activation energy (length 3)',
@@ -44,6 +46,18 @@ def prot_clay(claypercent,slope=0.4833,intercept=2.3282,BD=1.15,porosity=0.4):
     prot=1.0*(10**(slope*log10(claypercent)+intercept)*BD*1e-6)
     return prot
 
+# Protection rate modifier for a soil's clay content, relative to a reference clay content
+# Only depends on clay, so values for single sites are cached instead of recomputing the log10 on every call of the model
+def clay_modifier(clay,clay_ref=20):
+    from numpy import ndim
+    if ndim(clay)==0:
+        return scalar_clay_modifier(float(clay),float(clay_ref))
+    return prot_clay(clay)/prot_clay(clay_ref)
+
+@lru_cache(maxsize=1024)
+def scalar_clay_modifier(clay,clay_ref):
+    return float(prot_clay(clay)/prot_clay(clay_ref))
+
 # Check if the parameters sent to the model included the correct set of parameters and raise an error if not
 def check_params(params):
     '''params: dictionary containing parameter values. Should contain these fields (showing reasonable default values):
@@ -71,129 +85,484 @@ def check_params(params):
             print ('Missing parameter: %s [%s]'%(k,unused_params[k]))
         raise ValueError('Missing parameters: %s'%unused_params.keys())
 
+# Pools that are integrated by the solvers, in the order used for the packed state array.
+# Layout is unprotected C types, protected C types, microbial pools, then CO2 (originalC is not integrated)
+state_pools = ['u'+t+'C' for t in chem_types]+\
+              ['p'+t+'C' for t in chem_types]+\
+              [m for m in microbial_pools]+\
+              ['CO2']
+
+# Gas constant and reference temperature for the Arrhenius temperature response
+Tref=293.15
+Rugas=8.314472
+
+# Convert the nested parameter dictionaries into dense arrays that the packed-array model function can use directly
+def compile_params(params):
+    '''Build a compiled model spec from a CORPSE parameter dictionary.
+       Microbe x chem type parameters (vmaxref, kC, eup) become arrays of shape (microbial groups, chem types, 1),
+       per-microbe parameters (minMicrobeC, Tmic, et) have shape (microbial groups, 1) and per-chem type
+       parameters (Ea, protection_rate) have shape (chem types, 1), so they all broadcast against the points axis.
+       Keys in params that are not microbial pools or chem types are ignored, as in CORPSE_deriv.
+
+       Any parameter value can also be an array with one value per ensemble member (e.g. from CORPSE_ensemble.sample_ensemble).
+       The last axis of the compiled arrays then has one entry per member instead of 1, and each point of the state is one
+       member. All array-valued parameters must have the same length.
+
+       Returns a dictionary that can be passed to CORPSE_deriv_array (or anywhere a params dictionary is accepted)'''
+    from numpy import asarray,atleast_1d,broadcast_arrays,stack,eye
+
+    # Stack parameter values into an array with a trailing ensemble axis (length 1 without an ensemble)
+    def stacked(values):
+        vals=broadcast_arrays(*[atleast_1d(asarray(v,dtype=float)) for v in values])
+        return stack(vals)
+    def by_microbe_chem(name):
+        return stacked([params[name][m][t] for m in microbial_pools for t in chem_types]).reshape(len(microbial_pools),len(chem_types),-1)
+    def by_microbe(name):
+        return stacked([params[name][m] for m in microbial_pools])
+    def by_chem(name):
+        return stacked([params[name][t] for t in chem_types])
+    # Scalar parameters stay floats unless they have an ensemble axis
+    def scalar(name):
+        v=asarray(params[name],dtype=float)
+        return float(v) if v.ndim==0 else v
+
+    model={'pools':list(state_pools),
+           'chem_types':list(chem_types),
+           'microbial_pools':list(microbial_pools),
+           'nchem':len(chem_types),
+           'nmic':len(microbial_pools),
+           'necro':chem_types.index('Necro'),
+           # Chem types that have a protected pool (all of them, unless the model is pruned; see prune_model)
+           'prot':slice(0,len(chem_types)),
+           'nprot':len(chem_types),
+           'prot_matrix':eye(len(chem_types)),
+           'vmaxref':by_microbe_chem('vmaxref'),
+           'kC':by_microbe_chem('kC'),
+           'eup':by_microbe_chem('eup'),
+           'Ea':by_chem('Ea'),
+           'protection_rate':by_chem('protection_rate'),
+           'minMicrobeC':by_microbe('minMicrobeC'),
+           'Tmic':by_microbe('Tmic'),
+           'et':by_microbe('et'),
+           'tProtected':scalar('tProtected'),
+           'gas_diffusion_exp':scalar('gas_diffusion_exp'),
+           'substrate_diffusion_exp':scalar('substrate_diffusion_exp'),
+           'new_resp_units':bool(params['new_resp_units']),
+           }
+    # Terms that only depend on parameters are calculated once here
+    model['aerobic_max']=aerobic_max(model)
+    reset_memos(model)
+
+    sizes=set([atleast_1d(model[k]).shape[-1] for k in ensemble_params])-set([1])
+    if len(sizes)>1:
+        raise ValueError('Ensemble parameters have different lengths: %s'%sorted(sizes))
+    model['nensemble']=sizes.pop() if len(sizes)==1 else 1
+    return model
+
+# Compiled model entries that can have an ensemble axis (always the last axis)
+ensemble_params=['vmaxref','kC','eup','Ea','protection_rate','minMicrobeC','Tmic','et','tProtected','gas_diffusion_exp','substrate_diffusion_exp','aerobic_max']
+
+# Compiled model entries that memoize results calculated from its parameters (temperature_response, prune_model and
+# CORPSE_kernel.kernel_params). They fill up during runs without changing the model, so hashes of a model skip them
+memo_keys=('Tcache','pruned','kernel')
+
+# Empty the memos of a compiled model, e.g. of a copy with different parameter arrays
+def reset_memos(model):
+    for k in memo_keys:
+        model[k]={}
+    return model
+
+# Return a compiled model restricted to some ensemble members (an index array or slice), for calculations on a subset of points
+# Models without an ensemble axis are returned unchanged
+def select_members(model,members):
+    from numpy import ndim,arange
+    if model['nensemble']==1:
+        return model
+    sub=dict(model)
+    for k in ensemble_params:
+        if ndim(model[k])>0 and model[k].shape[-1]>1:
+            sub[k]=model[k][...,members]
+    sub['nensemble']=len(arange(model['nensemble'])[members])
+    reset_memos(sub)
+    return sub
+
+# Return a compiled model without the pools that stay zero for the given initial state and inputs, so the solvers
+# don't carry them or spend time on them. A pool is dropped when it is zero at every point, gets no inputs, and:
+#   - microbial groups: nothing can grow from zero biomass (decomposition and turnover are proportional to it)
+#   - chem types other than Necro: nothing produces them, so both the unprotected and protected pool stay zero
+#   - protected pools: the chem type's protection_rate is zero (for every ensemble member)
+# Microbial groups with zero vmaxref but some biomass are kept, since their turnover and share of total biomass still matter.
+# SOM: packed initial state (n_pools, n_points) and inputs: packed input rates, both in the order of model['pools']
+# The dropped pools can be restored as zeros with expand_pools. Pruned models are memoized in the full model
+def prune_model(model,SOM,inputs=None):
+    from numpy import asarray,atleast_1d,zeros,array,arange,ix_
+    SOM=asarray(SOM,dtype=float)
+    if SOM.ndim==1:
+        SOM=SOM[:,None]
+    if inputs is None:
+        inputs=zeros(len(model['pools']))
+    pools=model['pools']
+    live=dict(zip(pools,(SOM!=0).any(axis=1)|(asarray(inputs)!=0)))
+
+    chem=model['chem_types']
+    im=[n for n,m in enumerate(model['microbial_pools']) if live[m]]
+    ic=[n for n,t in enumerate(chem) if n==model['necro'] or live['u'+t+'C'] or live.get('p'+t+'C',False)]
+    protected=[t for n,t in enumerate(chem) if n in arange(len(chem))[model['prot']]]
+    rate=atleast_1d(model['protection_rate'])
+    ip=[k for k,n in enumerate(ic) if chem[n] in protected and (live['p'+chem[n]+'C'] or (rate[n]!=0).any())]
+    if len(im)==model['nmic'] and len(ic)==model['nchem'] and len(ip)==model['nprot']:
+        return model
+
+    key=(tuple(im),tuple(ic),tuple(ip))
+    if key in model['pruned']:
+        return model['pruned'][key]
+    sub=dict(model)
+    sub['chem_types']=[chem[n] for n in ic]
+    sub['microbial_pools']=[model['microbial_pools'][n] for n in im]
+    sub['nchem']=len(ic)
+    sub['nmic']=len(im)
+    sub['necro']=ic.index(model['necro'])
+    sub['prot']=slice(0,len(ic)) if len(ip)==len(ic) else array(ip,dtype=int)
+    sub['nprot']=len(ip)
+    sub['prot_matrix']=zeros((len(ic),len(ip)))
+    sub['prot_matrix'][ip,arange(len(ip))]=1.0
+    sub['pools']=['u'+sub['chem_types'][n]+'C' for n in range(len(ic))]+ \
+                 ['p'+sub['chem_types'][k]+'C' for k in ip]+sub['microbial_pools']+['CO2']
+    for k in ('vmaxref','kC','eup'):
+        sub[k]=model[k][ix_(im,ic)]
+    for k in ('Ea','protection_rate'):
+        sub[k]=model[k][ic]
+    for k in ('minMicrobeC','Tmic','et'):
+        sub[k]=model[k][im]
+    reset_memos(sub)
+    model['pruned'][key]=sub
+    return sub
+
+# Put the rows of a packed array (n_pools, ...) of a pruned model back into the layout of the full list of pools,
+# with zeros for the pools that were dropped
+def expand_pools(values,pools,full_pools):
+    from numpy import zeros
+    if list(pools)==list(full_pools):
+        return values
+    full=zeros((len(full_pools),)+values.shape[1:])
+    full[[list(full_pools).index(p) for p in pools]]=values
+    return full
+
+# Check that the ensemble size of a compiled model fits the number of points it will be run on
+def check_ensemble(model,npoints):
+    if model['nensemble'] not in (1,npoints):
+        raise ValueError('Parameter ensemble has %d members but there are %d points. Each point must be one ensemble member'%(model['nensemble'],npoints))
+
+# Compiled models of recently used parameter dictionaries, keyed by id(params), so the dictionary adapters (CORPSE_deriv,
+# CORPSE_solvers.fsolve_wrapper, ...) can be called with the same dictionary on every step without compiling it again.
+# Each entry keeps the dictionary itself (so its id can't be reused by another object) and a copy of its nested dictionaries
+# that shares their values. The compiled model is only used while the dictionary still has those values, so changing a
+# parameter compiles the model again. Arrays that are changed in place (instead of replaced) are not noticed: call
+# clear_compiled after doing that. The solvers compile their parameters once per run and pass the model along
+compiled_models={}
+max_compiled_models=32
+
+# Return a compiled model spec, compiling params first if it is still a parameter dictionary
+def get_model(params):
+    if 'pools' in params:
+        return params
+    entry=compiled_models.get(id(params))
+    if entry is not None and entry[0] is params and same_values(entry[1],params):
+        return entry[2]
+    compiled_models.pop(id(params),None)
+    if len(compiled_models)>=max_compiled_models:
+        compiled_models.pop(next(iter(compiled_models)))
+    model=compile_params(params)
+    compiled_models[id(params)]=(params,nested_copy(params),model)
+    return model
+
+# Copy of the nested dictionaries of params, sharing their values
+def nested_copy(params):
+    return dict([(k,nested_copy(v) if isinstance(v,dict) else v) for k,v in params.items()])
+
+# True if two parameter dictionaries have the same values. Values that are the same object compare equal without
+# looking at them; arrays that are different objects count as changed
+def same_values(a,b):
+    try:
+        return bool(a==b)
+    except ValueError:
+        return False
+
+# Forget all compiled models of parameter dictionaries
+def clear_compiled():
+    compiled_models.clear()
+
+# Temperature response of vmax for each microbe and chem type. Shape (microbial groups, chem types, n_points), or
+# (microbial groups, chem types, 1) when every point has the same temperature.
+# Results are memoized in the compiled model, so constant temperature runs and repeated temperatures are only calculated once.
+# Only temperature arrays of up to Tcache_points values are cached, and at most Tcache_size of them.
+Tcache_size=512
+Tcache_points=64
+def temperature_response(T,model):
+    from numpy import exp,atleast_1d
+    T=atleast_1d(T)
+    if T.size==1 or (T==T[0]).all():
+        key=float(T[0])
+        T=T[:1]
+    elif T.size<=Tcache_points:
+        key=T.tobytes()
+    else:
+        key=None
+
+    cache=model['Tcache']
+    if key is not None and key in cache:
+        return cache[key]
+    vmax=model['vmaxref']*exp(-model['Ea']*(1.0/(Rugas*T)-1.0/(Rugas*Tref)))
+    if key is not None:
+        if len(cache)>=Tcache_size:
+            cache.pop(next(iter(cache)))
+        cache[key]=vmax
+    return vmax
+
+# Empty the temperature cache of a compiled model. Needed if the arrays of a compiled model are changed directly
+def clear_cache(model):
+    model['Tcache'].clear()
+
+# Pack a dictionary of pools into one (n_pools, n_points) array in the order given by pools (default state_pools)
+def pack_pools(SOM,pools=None):
+    from numpy import asarray,atleast_1d,broadcast_arrays,vstack
+    if pools is None:
+        pools=state_pools
+    return vstack(broadcast_arrays(*[atleast_1d(asarray(SOM[p],dtype=float)) for p in pools]))
+
+# Unpack a packed state (or derivative) array back into a dictionary of pools. Rows are views, not copies
+def unpack_pools(SOM_array,pools=None):
+    if pools is None:
+        pools=state_pools
+    return dict([(p,SOM_array[n]) for n,p in enumerate(pools)])
+
+# Pack a dictionary of C input rates into a vector with one value per pool. Pools not in inputs get zero input
+def pack_inputs(inputs,pools=None):
+    from numpy import zeros
+    if pools is None:
+        pools=state_pools
+    vals=zeros(len(pools))
+    for pool in inputs.keys():
+        vals[pools.index(pool)]+=inputs[pool]
+    return vals
+
+# Moisture correction factor for the maximum of the moisture function. Only depends on parameters
+def aerobic_max(model):
+    if model['new_resp_units']:
+        theta_resp_max=model['substrate_diffusion_exp']/(model['gas_diffusion_exp']*(1.0+model['substrate_diffusion_exp']/model['gas_diffusion_exp']))
+        return theta_resp_max**model['substrate_diffusion_exp']*(1.0-theta_resp_max)**model['gas_diffusion_exp']
+    else:
+        return 1.0
+
+# Decomposition rate of each unprotected C type by each microbial group, on the packed state array
+def decompRate_array(SOM,T,theta,model):
+    '''SOM: packed state array (n_pools, n_points)
+       T: Temperature (K), theta: Soil water content (fraction of saturation, already constrained to 0-1)
+       Returns array of shape (microbial groups, chem types, n_points)'''
+    from numpy import where,errstate
+    nc=model['nchem']; nm=model['nmic']; npr=model['nprot']
+    uC=SOM[:nc]
+    MBC=SOM[nc+npr:nc+npr+nm]
+    totalU=uC.sum(axis=0)
+    totalMBC=MBC.sum(axis=0)
+
+    # Temperature adjusted vmax for each microbe and chem type
+    vmax=temperature_response(T,model)
+    moisture=theta**model['substrate_diffusion_exp']*(1.0-theta)**model['gas_diffusion_exp']/model['aerobic_max']
+
+    # Skip the decomposition calculation if there is no carbon or no microbe biomass (to avoid dividing by zero)
+    dodecomp=(totalU!=0.0)&(theta!=0.0)&(MBC!=0.0)
+    with errstate(divide='ignore',invalid='ignore'):
+        decomp=vmax*moisture*uC*MBC[:,None,:]/(totalU*model['kC']+totalMBC)
+    return where(dodecomp[:,None,:],decomp,0.0)
+
+# The main model function on packed arrays. Same equations as CORPSE_deriv, without any dictionary handling
+def CORPSE_deriv_array(SOM,T,theta,model,claymod=1.0):
+    '''Calculate rates of change for all CORPSE pools
+       SOM: packed state array, shape (n_pools,) or (n_pools, n_points), pools in the order of model['pools']
+       T: Temperature (K)
+       theta: Soil water content (fraction of saturation)
+       model: compiled model spec from compile_params
+
+       Returns array with the same layout as SOM'''
+    from numpy import asarray,atleast_1d,clip,where,maximum,empty
+
+    SOM=asarray(SOM,dtype=float)
+    onedim=SOM.ndim==1
+    if onedim:
+        SOM=SOM[:,None]
+    nc=model['nchem']; nm=model['nmic']; npr=model['nprot']
+    uC=SOM[:nc]
+    pC=SOM[nc:nc+npr]
+    MBC=SOM[nc+npr:nc+npr+nm]
+
+    # Constrain theta to 0 < theta < 1
+    theta=clip(atleast_1d(theta),0.0,1.0)
+    T=atleast_1d(T)
+
+    # Maximum potential C decomposition rate of each C pool by each microbial group
+    decomp=decompRate_array(SOM,T,theta,model)
+
+    # Microbial turnover, only for microbial pools with positive biomass, and never below zero
+    totalU=uC.sum(axis=0)
+    microbeTurnover=where(MBC>0,maximum((MBC-model['minMicrobeC']*totalU)/model['Tmic'],0.0),0.0)
+    deadmic_C_production=(microbeTurnover*model['et']).sum(axis=0)
+    maintenanceResp=(microbeTurnover*(1.0-model['et'])).sum(axis=0)
+    microbeGrowth=(decomp*model['eup']).sum(axis=1)
+    CO2prod=maintenanceResp+(decomp*(1.0-model['eup'])).sum(axis=(0,1))
+
+    # Protected carbon formation and turnover
+    protectedCturnover=pC/model['tProtected']
+    protectedCprod=uC*model['protection_rate']*claymod
+
+    # In a pruned model only some chem types (model['prot']) have a protected pool; the others have zero protection_rate
+    derivs=empty((len(model['pools']),decomp.shape[-1]))
+    derivs[:nc]=-decomp.sum(axis=0)-protectedCprod
+    derivs[model['prot']]+=protectedCturnover
+    derivs[nc:nc+npr]=protectedCprod[model['prot']]-protectedCturnover
+    derivs[nc+npr:nc+npr+nm]=microbeGrowth-microbeTurnover
+    derivs[nc+npr+nm]=CO2prod
+    # Add new dead MBC to the necromass pool
+    derivs[model['necro']]+=deadmic_C_production
+
+    if onedim and derivs.shape[1]==1:
+        return derivs[:,0]
+    return derivs
+
+# Analytical Jacobian of CORPSE_deriv_array with respect to the pools, for implicit (stiff) solvers
+def CORPSE_jacobian_array(SOM,T,theta,model,claymod=1.0):
+    '''Calculate the Jacobian matrix d(deriv_i)/d(pool_j) of the CORPSE rates of change
+       Includes Michaelis-Menten decomposition, microbial turnover with the minMicrobeC floor, and protection exchange.
+       Carbon inputs are constant so they don't contribute.
+       SOM: packed state array, shape (n_pools,) or (n_pools, n_points)
+
+       Returns array of shape (n_pools, n_pools), or (n_pools, n_pools, n_points) for more than one point'''
+    from numpy import asarray,atleast_1d,clip,where,errstate,zeros,eye
+
+    SOM=asarray(SOM,dtype=float)
+    onedim=SOM.ndim==1
+    if onedim:
+        SOM=SOM[:,None]
+    nc=model['nchem']; nm=model['nmic']; npr=model['nprot']
+    uC=SOM[:nc]
+    MBC=SOM[nc+npr:nc+npr+nm]
+    iu=slice(0,nc); ip=slice(nc,nc+npr); ib=slice(nc+npr,nc+npr+nm); ico2=nc+npr+nm
+    theta=clip(atleast_1d(theta),0.0,1.0)
+    T=atleast_1d(T)
+    totalU=uC.sum(axis=0)
+    totalMBC=MBC.sum(axis=0)
+
+    # Decomposition D[m,t]=Vf[m,t]*u[t]*B[m]/den[m,t] with den=U*kC+sum(MBC), where Vf includes temperature and moisture
+    # The expression is continuous at B[m]=0 and at U=0 (D goes to zero with u[t]), so the derivatives are taken from the formula
+    # wherever the denominator is nonzero, even though CORPSE_deriv_array skips the calculation at those points
+    Vf=temperature_response(T,model)* \
+        theta**model['substrate_diffusion_exp']*(1.0-theta)**model['gas_diffusion_exp']/model['aerobic_max']
+    den=totalU*model['kC']+totalMBC
+    valid=(theta!=0.0)&(den>0)
+    with errstate(divide='ignore',invalid='ignore'):
+        Vf=where(valid,Vf/den,0.0)       # Vf/den
+        D=Vf*uC*MBC[:,None,:]            # decomposition rates
+        D_den=where(valid,D/den,0.0)     # D/den
+    # dD[m,t]/du[s] = g[m,t]*delta(t,s) - h[m,t]
+    g=Vf*MBC[:,None,:]
+    h=D_den*model['kC']
+    # dD[m,t]/dB[n] = e[m,t]*delta(m,n) - D_den[m,t]
+    e=Vf*uC
+
+    # Turnover tau[m]=(B[m]-minMicrobeC[m]*U)/Tmic[m] where it is positive
+    active=(MBC>0)&(MBC-model['minMicrobeC']*totalU>0)
+    Gb=where(active,1.0/model['Tmic'],0.0)               # dtau[m]/dB[m]
+    Gu=where(active,-model['minMicrobeC']/model['Tmic'],0.0)  # dtau[m]/du[s], same for all s
+
+    npts=D.shape[-1]
+    eye_c=eye(nc)[:,:,None]
+    eye_m=eye(nm)[:,:,None]
+    eup=model['eup']
+    et=model['et']
+    rate=model['protection_rate']*claymod+zeros(npts)
+
+    J=zeros((len(model['pools']),len(model['pools']),npts))
+    # Unprotected C rows
+    J[iu,iu]=-(g.sum(axis=0)[:,None,:]*eye_c-h.sum(axis=0)[:,None,:])-rate[:,None,:]*eye_c
+    P=model['prot_matrix'][:,:,None]
+    J[iu,ip]=P/model['tProtected']
+    J[iu,ib]=-e.transpose(1,0,2)+D_den.sum(axis=0)[:,None,:]
+    J[model['necro'],iu]+=(et*Gu).sum(axis=0)
+    J[model['necro'],ib]+=et*Gb
+    # Protected C rows
+    J[ip,iu]=P.transpose(1,0,2)*rate[None,:,:]
+    J[ip,ip]=-eye(npr)[:,:,None]/model['tProtected']
+    # Microbial biomass rows
+    J[ib,iu]=eup*g-(eup*h).sum(axis=1)[:,None,:]-Gu[:,None,:]
+    J[ib,ib]=(eup*e).sum(axis=1)[:,None,:]*eye_m-(eup*D_den).sum(axis=1)[:,None,:]-Gb[:,None,:]*eye_m
+    # CO2 row
+    resp=1.0-eup
+    J[ico2,iu]=(resp*g).sum(axis=0)-(resp*h).sum(axis=(0,1))+((1.0-et)*Gu).sum(axis=0)
+    J[ico2,ib]=(resp*e).sum(axis=1)-(resp*D_den).sum(axis=(0,1))+(1.0-et)*Gb
+
+    if onedim and npts==1:
+        return J[:,:,0]
+    return J
+
+# Structural sparsity pattern of the Jacobian (True where an entry can be nonzero), for solvers that accept one
+def jacobian_sparsity(model):
+    from numpy import zeros,eye
+    nc=model['nchem']; nm=model['nmic']; npr=model['nprot']
+    iu=slice(0,nc); ip=slice(nc,nc+npr); ib=slice(nc+npr,nc+npr+nm); ico2=nc+npr+nm
+    S=zeros((len(model['pools']),len(model['pools'])),dtype=bool)
+    S[iu,iu]=True
+    S[iu,ip]=model['prot_matrix']!=0
+    S[iu,ib]=True
+    S[ip,iu]=model['prot_matrix'].T!=0
+    S[ip,ip]=eye(npr,dtype=bool)
+    S[ib,iu]=True
+    S[ib,ib]=True
+    S[ico2,iu]=True
+    S[ico2,ib]=True
+    return S
+
 # The main model function. Given the current state of the model along with temperature, moisture, and parameters, it calculates the rate of change of all pools
-from numpy import zeros,size,where,atleast_1d
+# This is a thin dictionary adapter around CORPSE_deriv_array
 def CORPSE_deriv(SOM,T,theta,params,claymod=1.0):
     '''Calculate rates of change for all CORPSE pools
        T: Temperature (K)
        theta: Soil water content (fraction of saturation)
+       params: parameter dictionary, or compiled model spec from compile_params
 
        Returns same data structure as SOM'''
+    model=get_model(params)
+    deriv_array=CORPSE_deriv_array(pack_pools(SOM,model['pools']),T,theta,model,claymod=claymod)
 
-    # convert input into array
-    theta=atleast_1d(theta)
-    T=atleast_1d(T)
-
-    # Constraint theta to 0 < theta < 1
-    theta[theta<0]=0.0
-    theta[theta>1]=1.0
-
-    # Calculate maximum potential C decomposition rate of each C pool by each microbial group
-    decomp=decompRate(SOM,T,theta,params)
-
-    # Create empty variables for dead MBC and microbial turnover rate
-    deadmic_C_production=0
-    microbeTurnover={}
-    maintenanceResp={}
-    total_maintenanceResp=0
-    CO2prod=0
-    microbeGrowth={}
-    
-    # Calculate microbial turnover and dead MBC production for each microbial pool. If MBC pool > 0, calculate microbial turnover. If not, set turnover equal to 0.
-    microbeTurnover=dict([(m, where((SOM[m]>0), (SOM[m]-params['minMicrobeC'][m]*(sumCtypes(SOM,'u')))/params['Tmic'][m],0)) for m in microbial_pools])
-    
-    for m in microbial_pools:    
-        # Ensure that microbial turnover is > 0
-        if isinstance(microbeTurnover[m],float):
-            microbeTurnover[m]=max(0.0,microbeTurnover[m])
-        else:
-            microbeTurnover[m][microbeTurnover[m]<0.0]=0.0
-            
-        deadmic_C_production=deadmic_C_production+microbeTurnover[m]*params['et'][m]
-        maintenanceResp[m]=microbeTurnover[m]*(1.0-params['et'][m])
-        total_maintenanceResp=total_maintenanceResp+maintenanceResp[m]
-        CO2prod=CO2prod+maintenanceResp[m]
-    
-        microbeGrowth[m]=0
-        for t in chem_types: 
-            CO2prod=CO2prod + decomp[m][t]*(1.0-params['eup'][m][t])
-            microbeGrowth[m]=microbeGrowth[m]+decomp[m][t]*params['eup'][m][t]
-
-
-
-
-    # Update protected carbon
-    protectedCturnover = dict([(t,SOM['p'+t+'C']/params['tProtected']) for t in chem_types])
-    protectedCprod =     dict([(t,SOM['u'+t+'C']*params['protection_rate'][t]*claymod) for t in chem_types])
-        # Some slow, protected C is being formed, but none of the pools are undergoing turnover > 0. Where is the protected C coming from??
-        
-        
-    #### Assign new values to SOM pools (based on calculated rates of change)
-    derivs=SOM.copy() # Create a copy of the original SOM dictionary
-    for k in derivs.keys():
-        derivs[k]=0.0 # Set all the C pools to 0
-        
-    # Fill in dictionary with new MBC pool size based on microbial growth and turnover 
-    for m in microbial_pools:
-        derivs[m]=microbeGrowth[m]-microbeTurnover[m]
-
-    derivs['CO2']=CO2prod
-
-    total_decomp={}   # create empty dictionary 
-    for t in chem_types:
-        total_decomp['u'+t+'C']=0 # Assign an initial value of 0 to for decomposition rate of C pool
-        total_decomp['p'+t+'C']=0
-        for m in microbial_pools:
-            # Calculate cumulative decomposition of each pool by each microbial group
-            total_decomp['u'+t+'C']=total_decomp['u'+t+'C']+decomp[m][t]
-        # Fill in derivs dictionary with new C pool (Fast, Slow, Necro, Py) size based on decomposition rate, protected C formation, and protected C turnover
-        derivs['u'+t+'C']=-total_decomp['u'+t+'C']+protectedCturnover[t]-protectedCprod[t]
-        derivs['p'+t+'C']=-total_decomp['p'+t+'C']+protectedCprod[t]-protectedCturnover[t]
-
-    # Add new dead MBC to the necromass pool 
-    derivs['uNecroC']=derivs['uNecroC']+deadmic_C_production
+    # Pools in SOM that are not part of the model (e.g. originalC) don't change
+    derivs=dict([(k,0.0) for k in SOM.keys()])
+    for n,pool in enumerate(model['pools']):
+        derivs[pool]=deriv_array[n]
     return derivs
 
 
 # Decomposition rate
+# Dictionary adapter around decompRate_array
 def decompRate(SOM,T,theta,params):
+    from numpy import clip,atleast_1d
+    model=get_model(params)
+    decomp=decompRate_array(pack_pools(SOM,model['pools']),atleast_1d(T),clip(atleast_1d(theta),0.0,1.0),model)
 
-    # This only really needs to be calculated once
-    # This corrects the units of vmaxref for the moisture function, so the 
-    # units can be in actual 1/time. 
-    # This essentially sets the maximum value of the moisture function to 1
-    if params['new_resp_units']:
-        theta_resp_max=params['substrate_diffusion_exp']/(params['gas_diffusion_exp']*(1.0+params['substrate_diffusion_exp']/params['gas_diffusion_exp']))
-        aerobic_max=theta_resp_max**params['substrate_diffusion_exp']*(1.0-theta_resp_max)**params['gas_diffusion_exp']
-
-    else:
-        aerobic_max=1.0
- 
-    vmax=dict([(m, Vmax(m,T,params)) for m in microbial_pools])
-        
-    # Skip the decomposition calculation if there is no carbon or no microbe biomass (to avoid dividing by zero)
-    dodecomp=dict([(m,(sumCtypes(SOM,'u')!=0.0)&(theta!=0.0)&(SOM[m]!=0.0)) for m in microbial_pools])
-
-    # Create empty dictionary to store decomposition rates
-    decompRate={}
-    
-    for m in microbial_pools:
-        decompRate[m]=dict([(t, where(dodecomp[m],vmax[m][t]*theta**params['substrate_diffusion_exp']*(SOM['u'+t+'C'])*SOM[m]/(sumCtypes(SOM,'u')*params['kC'][m][t]+(SOM['MBC_1']+SOM['MBC_2']+SOM['MBC_3']+SOM['MBC_4']))*(1.0-theta)**params['gas_diffusion_exp']/aerobic_max,0.0)) for t in chem_types])
-
-    return decompRate # output is the decomposition rates of each C pool by given MBC group
+    # Output is the decomposition rates of each C pool by given MBC group
+    return dict([(m,dict([(t,decomp[i,j]) for j,t in enumerate(model['chem_types'])])) for i,m in enumerate(model['microbial_pools'])])
 
 
 def Vmax(Micro_pool, T,params):
     '''Vmax function, normalized to Tref=293.15
     T is in K'''
 
-    Tref=293.15;
-    Rugas=8.314472;
-
-    from numpy import exp
+    from numpy import ndim
 
-    # Calculate temperature adjusted vmax for each chem type
-    Vmax=dict([(t,params['vmaxref'][Micro_pool][t]*exp(-params['Ea'][t]*(1.0/(Rugas*T)-1.0/(Rugas*Tref)))) for t in chem_types]);
+    # Temperature adjusted vmax for each chem type, from the temperature response memoized in the compiled model
+    vmax=temperature_response(T,get_model(params))
+    if ndim(T)==0 and vmax.shape[-1]==1:
+        vmax=vmax[...,0]
+    m=microbial_pools.index(Micro_pool)
+    Vmax=dict([(t,vmax[m,n]) for n,t in enumerate(chem_types)])
 
     return Vmax
 
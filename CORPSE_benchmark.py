@@ -0,0 +1,265 @@
+# Benchmark suite for the CORPSE model function and solvers
+# Measures run time and peak memory of CORPSE_deriv, fsolve_wrapper, run_models_ODE and vector_iterate over a range of
+# point counts, simulation lengths and microbial community configurations (2 and 4 groups), using the initial values and
+# parameter sets from Whitman_sims.py as fixtures. Results are saved as JSON so they can be compared against a baseline.
+# The run_models_ODE_stiff cases run the BDF and Radau backends with and without the analytical Jacobian (jac=True/False).
+#
+# Run the benchmarks and save the results:
+#   python CORPSE_benchmark.py run --preset standard --out baseline.json
+# Compare a new set of results against a baseline (exit code 1 if anything got slower by more than the threshold):
+#   python CORPSE_benchmark.py compare baseline.json new.json --threshold 1.25
+#
+# Presets: 'quick' (small cases only), 'standard', 'full' (up to 10^5 points and 100 year simulations; needs a lot of time and memory)
+
+import CORPSE_array
+import CORPSE_kernel
+import CORPSE_solvers
+
+
+# Case sizes for each preset
+presets={
+    'quick':{'deriv_points':[1,100,10000],
+             'ode_points':[1],
+             'ode_batch_points':[10],
+             'stiff_points':[10],
+             'iterate_points':[1,100],
+             'horizons':[70/365,10]},
+    'standard':{'deriv_points':[1,100,10000,100000],
+                'ode_points':[1,10],
+                'ode_batch_points':[10,100,1000],
+                'stiff_points':[10,100],
+                'iterate_points':[1,100,10000],
+                'horizons':[70/365,10,100]},
+    'full':{'deriv_points':[1,100,10000,100000],
+            'ode_points':[1,10,100],
+            'ode_batch_points':[10,100,1000,10000,100000],
+            'stiff_points':[10,100,1000],
+            'iterate_points':[1,100,10000,100000],
+            'horizons':[70/365,10,100]},
+}
+
+# Initial values and parameters from Whitman_sims.py, for each scenario and for 2 or 4 microbial groups
+# Whitman_sims.py uses 2 groups (MBC_3 and MBC_4 are empty). The 4 group version gives MBC_3 and MBC_4 the traits of MBC_1
+# and MBC_2 with a smaller share of the biomass, so that all four groups are active
+def fixtures(scenario,groups=2):
+    import copy
+    import Whitman_sims
+    initvals=copy.deepcopy(Whitman_sims.initvals[scenario])
+    params=copy.deepcopy(Whitman_sims.paramsets[scenario])
+    envir=copy.deepcopy(Whitman_sims.envir_params[scenario])
+    if groups==4:
+        for new,old in (('MBC_3','MBC_1'),('MBC_4','MBC_2')):
+            initvals[new]=initvals[old]*0.5
+            for name in ('vmaxref','kC','eup'):
+                params[name][new]=copy.deepcopy(params[name][old])
+            for name in ('minMicrobeC','Tmic','et'):
+                params[name][new]=params[name][old]
+    return initvals,params,envir
+
+# Environmental conditions for n points, spread around the Whitman_sims incubation conditions
+def make_sites(npoints,envir,seed=0):
+    from numpy.random import default_rng
+    rng=default_rng(seed)
+    Tmin=18.0+rng.uniform(-3,3,npoints)
+    Tmax=Tmin+6.0
+    thetamin=float(envir['thetamin'])+rng.uniform(-0.1,0.1,npoints)
+    thetamax=thetamin+float(envir['thetamax']-envir['thetamin'])
+    clay=rng.uniform(2.5,30,npoints)
+    return Tmin,Tmax,thetamin,thetamax,clay
+
+# Output times for a simulation of the given length (years): daily for incubation-length runs, monthly for long runs
+def output_times(horizon):
+    from numpy import arange
+    if horizon<=1:
+        return arange(0,horizon,1/365)
+    return arange(0,horizon+1e-9,1/12)
+
+# Time a function: best of several calls, repeating until at least min_time seconds have been spent (max_repeat calls)
+# One untimed call comes first, so lazy imports and caches don't count.
+# Peak memory is measured in a separate call with tracemalloc, so its overhead doesn't affect the timing
+def measure(fun,min_time=0.2,max_repeat=20,memory=True):
+    import time,io,contextlib,tracemalloc
+    times=[]
+    with contextlib.redirect_stdout(io.StringIO()):
+        fun()
+        while len(times)<max_repeat and (len(times)==0 or sum(times)<min_time):
+            t0=time.perf_counter()
+            fun()
+            times.append(time.perf_counter()-t0)
+        peak=None
+        if memory:
+            tracemalloc.start()
+            fun()
+            peak=tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return {'time':min(times),'mean_time':sum(times)/len(times),'repeats':len(times),'peak_memory':peak}
+
+# Build the list of benchmark cases: (name, description dictionary, function to time)
+def benchmark_cases(preset='standard',scenarios=None,groups=(2,4)):
+    import copy
+    from numpy import array,full,arange
+    import pandas
+    import CORPSE_output
+    import Whitman_sims
+    sizes=presets[preset]
+    if scenarios is None:
+        scenarios=list(Whitman_sims.initvals.keys())
+
+    cases=[]
+    def add(kind,fun,**info):
+        name='%s[%s]'%(kind,','.join(['%s=%s'%(k,info[k]) for k in sorted(info)]))
+        cases.append((name,dict(info,kind=kind),fun))
+
+    for scenario in scenarios:
+        for ngroups in groups:
+            initvals,params,envir=fixtures(scenario,ngroups)
+            model=CORPSE_array.get_model(params)
+            label=dict(scenario=scenario.replace(' ','_'),groups=ngroups)
+
+            # The model function itself, through the dictionary API and on packed arrays
+            for npoints in sizes['deriv_points']:
+                Tmin,Tmax,thetamin,thetamax,clay=make_sites(npoints,envir)
+                SOM=dict([(k,full(npoints,float(v))) for k,v in initvals.items()])
+                packed=CORPSE_array.pack_pools(SOM,model['pools'])
+                T=Tmin+273.15
+                add('CORPSE_deriv',lambda SOM=SOM,T=T,theta=thetamin: CORPSE_array.CORPSE_deriv(SOM,T,theta,params),points=npoints,**label)
+                add('CORPSE_deriv_array',lambda packed=packed,T=T,theta=thetamin: CORPSE_array.CORPSE_deriv_array(packed,T,theta,model),points=npoints,**label)
+                # The fused kernel, if Numba is installed (see CORPSE_kernel)
+                if CORPSE_kernel.numba is not None:
+                    add('kernel_deriv',lambda packed=packed,T=T,theta=thetamin: CORPSE_kernel.kernel_deriv(packed,T,theta,model,1.0,CORPSE_kernel.deriv_points),
+                        points=npoints,**label)
+
+            # One call of the solver wrapper, as the ODE solver makes it
+            ivals=CORPSE_solvers.get_initvals(initvals,0)
+            add('fsolve_wrapper',lambda: CORPSE_solvers.fsolve_wrapper(ivals,293.15,0.6,{},2.5,params),points=1,**label)
+
+            for horizon in sizes['horizons']:
+                times=output_times(horizon)
+                hlabel=dict(label,horizon='%gd'%round(horizon*365) if horizon<1 else '%gy'%horizon)
+
+                # ODE solver, one point at a time and batched
+                for npoints in sizes['ode_points']:
+                    Tmin,Tmax,thetamin,thetamax,clay=make_sites(npoints,envir)
+                    add('run_models_ODE',lambda Tmin=Tmin,Tmax=Tmax,thetamin=thetamin,thetamax=thetamax,clay=clay,times=times:
+                        CORPSE_solvers.run_models_ODE(Tmin,Tmax,thetamin,thetamax,times,{},params,clay,initvals,output='array'),points=npoints,**hlabel)
+                for npoints in sizes['ode_batch_points']:
+                    Tmin,Tmax,thetamin,thetamax,clay=make_sites(npoints,envir)
+                    add('run_models_ODE_batch',lambda Tmin=Tmin,Tmax=Tmax,thetamin=thetamin,thetamax=thetamax,clay=clay,times=times:
+                        CORPSE_solvers.run_models_ODE(Tmin,Tmax,thetamin,thetamax,times,{},params,clay,initvals,output='array',batch=True),points=npoints,**hlabel)
+                # Batched with the stiff solve_ivp methods, with the analytical Jacobian and with finite difference estimates of it
+                for npoints in sizes['stiff_points']:
+                    Tmin,Tmax,thetamin,thetamax,clay=make_sites(npoints,envir)
+                    for method in ('BDF','Radau'):
+                        for jac in (True,False):
+                            add('run_models_ODE_stiff',lambda Tmin=Tmin,Tmax=Tmax,thetamin=thetamin,thetamax=thetamax,clay=clay,times=times,method=method,jac=jac:
+                                CORPSE_solvers.run_models_ODE(Tmin,Tmax,thetamin,thetamax,times,{},params,clay,initvals,output='array',batch=True,
+                                                              method=method,jac=jac),points=npoints,method=method,jac=jac,**hlabel)
+
+                # Fixed step iterator with daily steps. Only CO2 is kept (monthly) for long runs so output fits in memory
+                daily=arange(0,horizon,1/365)
+                for npoints in sizes['iterate_points']:
+                    Tmin,Tmax,thetamin,thetamax,clay=make_sites(npoints,envir)
+                    T=array((Tmin+Tmax)/2+273.15)
+                    theta=array((thetamin+thetamax)/2)
+                    SOM_init=dict([(k,full(npoints,float(v))) for k,v in initvals.items()])
+                    SOM_init=dict([(k,pandas.Series(v)) for k,v in SOM_init.items()]) if npoints>1 else copy.deepcopy(initvals)
+                    def run_iterate(SOM_init=SOM_init,T=T,theta=theta,clay=pandas.Series(clay),daily=daily,horizon=horizon):
+                        sink=CORPSE_output.OutputSink(pools=['CO2'],every=30) if horizon>1 else None
+                        return CORPSE_solvers.vector_iterate(SOM_init,params,T,theta,{},clay,daily,sink=sink)
+                    add('vector_iterate',run_iterate,points=npoints,**hlabel)
+    return cases
+
+# Run all benchmark cases (or those whose name contains one of the strings in select) and return the results dictionary
+def run_benchmarks(preset='standard',scenarios=None,groups=(2,4),select=None,memory=True,verbose=True):
+    import platform,datetime,numpy,scipy
+    results={}
+    for name,info,fun in benchmark_cases(preset,scenarios,groups):
+        if select is not None and not any([s in name for s in select]):
+            continue
+        results[name]=dict(info,**measure(fun,memory=memory))
+        if verbose:
+            peak=results[name]['peak_memory']
+            print('%-100s %10.4f s %s'%(name,results[name]['time'],'' if peak is None else '%8.1f MB'%(peak/1e6)),flush=True)
+    meta={'preset':preset,
+          'date':datetime.datetime.now().isoformat(),
+          'python':platform.python_version(),
+          'numpy':numpy.__version__,
+          'scipy':scipy.__version__,
+          'machine':platform.machine(),
+          'processor':platform.processor(),
+          }
+    return {'meta':meta,'results':results}
+
+def save_results(results,filename):
+    import json
+    with open(filename,'w') as f:
+        json.dump(results,f,indent=1)
+
+def load_results(filename):
+    import json
+    with open(filename) as f:
+        return json.load(f)
+
+# Compare two sets of results. A case is a regression if its time (or peak memory) grew by more than threshold times
+# Returns a list of (name, measure, old value, new value, ratio) for the regressions
+def compare_results(old,new,threshold=1.25,memory_threshold=None,verbose=True):
+    if memory_threshold is None:
+        memory_threshold=threshold
+    regressions=[]
+    for name in old['results']:
+        if name not in new['results']:
+            continue
+        o=old['results'][name]
+        n=new['results'][name]
+        ratio=n['time']/o['time']
+        flag=''
+        if ratio>threshold:
+            regressions.append((name,'time',o['time'],n['time'],ratio))
+            flag='SLOWER'
+        elif ratio<1.0/threshold:
+            flag='faster'
+        mem_ratio=None
+        if o.get('peak_memory') and n.get('peak_memory'):
+            mem_ratio=n['peak_memory']/o['peak_memory']
+            if mem_ratio>memory_threshold:
+                regressions.append((name,'peak_memory',o['peak_memory'],n['peak_memory'],mem_ratio))
+                flag=flag+' MORE MEMORY'
+        if verbose:
+            print('%-100s %10.4f -> %10.4f s  x%6.2f %s %s'%(name,o['time'],n['time'],ratio,'' if mem_ratio is None else 'mem x%5.2f'%mem_ratio,flag))
+    if verbose:
+        missing=[name for name in old['results'] if name not in new['results']]
+        if len(missing)>0:
+            print('%d cases in the baseline were not run'%len(missing))
+        print('%d regressions'%len(regressions))
+    return regressions
+
+def main(argv=None):
+    import argparse
+    parser=argparse.ArgumentParser(description='CORPSE benchmark suite')
+    sub=parser.add_subparsers(dest='command',required=True)
+    run=sub.add_parser('run',help='Run the benchmarks')
+    run.add_argument('--preset',default='standard',choices=sorted(presets.keys()))
+    run.add_argument('--out',help='JSON file to save the results in')
+    run.add_argument('--scenario',action='append',help='Whitman_sims scenario to use (default all). Can be repeated')
+    run.add_argument('--groups',type=int,action='append',choices=[2,4],help='Number of microbial groups (default 2 and 4). Can be repeated')
+    run.add_argument('--select',action='append',help='Only run cases whose name contains this string. Can be repeated')
+    run.add_argument('--no-memory',action='store_true',help='Skip the peak memory measurements')
+    cmp=sub.add_parser('compare',help='Compare results against a baseline')
+    cmp.add_argument('baseline')
+    cmp.add_argument('new')
+    cmp.add_argument('--threshold',type=float,default=1.25,help='Time ratio above which a case counts as a regression')
+    cmp.add_argument('--memory-threshold',type=float,default=None,help='Peak memory ratio above which a case counts as a regression')
+    args=parser.parse_args(argv)
+
+    if args.command=='run':
+        results=run_benchmarks(args.preset,args.scenario,tuple(args.groups) if args.groups else (2,4),args.select,memory=not args.no_memory)
+        if args.out:
+            save_results(results,args.out)
+        return 0
+    else:
+        regressions=compare_results(load_results(args.baseline),load_results(args.new),args.threshold,args.memory_threshold)
+        return 1 if len(regressions)>0 else 0
+
+if __name__=='__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,177 @@
+# On-disk cache of simulation results
+# run_models_ODE and run_models_iterator take cache=<directory> (or a ResultCache). Each run is identified by a hash of everything that
+# determines its output: parameters, initial values, environmental conditions or forcing, times, inputs, clay, solver settings, and
+# the source code of the model and solver modules (so editing the model invalidates old results). If the directory has a result
+# for that hash, it is loaded instead of running the simulation. So re-running a script only simulates the scenarios that changed.
+# Settings that only change the form of the output (output, full_output, profile, ...) are not part of the hash.
+# Runs that write to an output sink are not cached.
+#
+# Each result is one .npy file named after its hash. The cache is limited to max_bytes: when it is bigger, the least recently
+# used results are removed. Use invalidate (one run) or clear (everything) to remove results explicitly.
+
+import logging
+log=logging.getLogger(__name__)
+
+# Modules whose source code is part of every hash
+model_modules=['CORPSE_array','CORPSE_solvers','CORPSE_forcing','CORPSE_layers','CORPSE_disturbance','CORPSE_kernel']
+
+# Arguments of the solvers that don't change the simulated values
+ignored_args=['cache','sink','output','full_output','profile','trace_memory','checkpoint','checkpoint_interval']
+
+
+class ResultCache:
+    '''Results of simulations in directory path, keyed by a hash of their inputs.
+       max_bytes: maximum total size of the cached results. Least recently used results are removed beyond it'''
+
+    def __init__(self,path,max_bytes=2e9):
+        import os
+        self.path=path
+        self.max_bytes=max_bytes
+        os.makedirs(path,exist_ok=True)
+
+    # Hash of a solver call (see call_hash), plus the model version
+    def key(self,function,call):
+        import hashlib
+        h=hashlib.blake2b(digest_size=20)
+        update_hash(h,model_version())
+        update_hash(h,call_hash(function,call))
+        return h.hexdigest()
+
+    def filename(self,key):
+        import os
+        return os.path.join(self.path,key+'.npy')
+
+    # Cached result for key, or None if there isn't one. Marks the result as recently used
+    def load(self,key):
+        import os
+        from numpy import load
+        filename=self.filename(key)
+        try:
+            result=load(filename)
+        except (OSError,ValueError):
+            return None
+        os.utime(filename)
+        return result
+
+    # Add a result to the cache, then remove the least recently used results if the cache is too big
+    def store(self,key,result):
+        import os
+        from numpy import save
+        tmp=self.filename(key)+'.tmp'
+        with open(tmp,'wb') as f:
+            save(f,result)
+        os.replace(tmp,self.filename(key))
+        self.evict()
+
+    # Cached results as a list of (key, size in bytes, time last used), least recently used first
+    def entries(self):
+        import os
+        entries=[]
+        for f in os.listdir(self.path):
+            if f.endswith('.npy'):
+                info=os.stat(os.path.join(self.path,f))
+                entries.append((f[:-4],info.st_size,info.st_mtime))
+        return sorted(entries,key=lambda e:e[2])
+
+    # Total size of the cached results (bytes)
+    def size(self):
+        return sum([e[1] for e in self.entries()])
+
+    # Remove least recently used results until the cache is no bigger than max_bytes
+    def evict(self):
+        entries=self.entries()
+        total=sum([e[1] for e in entries])
+        for key,size,used in entries:
+            if total<=self.max_bytes:
+                break
+            self.invalidate(key)
+            total-=size
+            log.debug('Removed result %s from cache',key)
+
+    # Remove one result: a key, or the function name and arguments of the call that produced it
+    def invalidate(self,key,call=None):
+        import os
+        if call is not None:
+            key=self.key(key,call)
+        try:
+            os.remove(self.filename(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    # Remove all results
+    def clear(self):
+        for key,size,used in self.entries():
+            self.invalidate(key)
+
+
+# Hash of a solver call: function name (in CORPSE_solvers) and the arguments (a dictionary) that determine its simulated values
+# Arguments that are left out get their default values, so a call hashes the same whether defaults are given or not
+def call_hash(function,call):
+    import hashlib,inspect
+    import CORPSE_solvers
+    bound=inspect.signature(getattr(CORPSE_solvers,function)).bind_partial(**call)
+    bound.apply_defaults()
+    h=hashlib.blake2b(digest_size=20)
+    update_hash(h,function)
+    update_hash(h,dict([(k,v) for k,v in bound.arguments.items() if k not in ignored_args]))
+    return h.hexdigest()
+
+# A ResultCache from a cache argument, which can be a ResultCache or a directory
+def get_cache(cache):
+    if isinstance(cache,ResultCache):
+        return cache
+    return ResultCache(cache)
+
+# Hash of the source code of the model modules, calculated once
+version=None
+def model_version():
+    global version
+    if version is None:
+        import hashlib,importlib
+        h=hashlib.blake2b(digest_size=20)
+        for name in model_modules:
+            with open(importlib.import_module(name).__file__,'rb') as f:
+                h.update(f.read())
+        version=h.hexdigest()
+    return version
+
+# Add a value to a hash. Dictionaries (in sorted key order), lists, arrays (including memory-mapped ones, read in blocks),
+# numbers, strings, DataFrames, Results and forcing are hashed by content. The type of every value is included, so e.g. 1 and '1' differ
+def update_hash(h,val):
+    import pickle
+    from numbers import Number
+    from numpy import ndarray,generic,ascontiguousarray
+    import CORPSE_forcing,CORPSE_array
+    h.update(type(val).__name__.encode())
+    if isinstance(val,dict):
+        for k in sorted(val.keys(),key=str):
+            # Memos of a compiled model (see CORPSE_array.memo_keys), which fill up during runs without changing its values
+            if k in CORPSE_array.memo_keys:
+                continue
+            update_hash(h,k)
+            update_hash(h,val[k])
+    elif isinstance(val,(list,tuple)):
+        h.update(str(len(val)).encode())
+        for v in val:
+            update_hash(h,v)
+    elif isinstance(val,(ndarray,generic)) and val.dtype.hasobject:
+        update_hash(h,val.tolist())
+    elif isinstance(val,(ndarray,generic)):
+        val=val.reshape(1) if val.ndim==0 else val
+        h.update(('%s%s'%(val.dtype.str,val.shape)).encode())
+        # In blocks of rows, so big memory-mapped arrays are not read into memory at once
+        step=max(1,2**24//max(1,val[:1].nbytes))
+        for start in range(0,len(val),step):
+            h.update(ascontiguousarray(val[start:start+step]).tobytes())
+    elif isinstance(val,(str,bytes)):
+        h.update(val.encode() if isinstance(val,str) else val)
+    elif val is None or isinstance(val,(Number,slice)):
+        h.update(repr(val).encode())
+    elif isinstance(val,CORPSE_forcing.Forcing):
+        update_hash(h,[val.times,val.T,val.theta])
+    elif hasattr(val,'values') and hasattr(val,'keys'):
+        # DataFrames and CORPSE_results.Results
+        update_hash(h,[list(val.keys()),val.values])
+    else:
+        h.update(pickle.dumps(val))
@@ -0,0 +1,137 @@
+# Checkpoint and resume for long simulations
+# run_models_ODE and vector_iterate take checkpoint=<directory>. While they run, they save the full state of the run there
+# at regular intervals: the pools of all points, the position in the output times, the output so far (if it is kept in memory;
+# output streamed to disk by CORPSE_output.NpyOutputSink is already there), the solver stats and the solver settings.
+# The arguments of the call are saved once at the start, including forcing (memory-mapped forcing by file name, with its cached position).
+#
+# If the run is interrupted (e.g. a preemptible node is taken away), resume(directory) continues it from the latest checkpoint.
+# Calling the solver again with the same arguments and checkpoint does the same. A resumed run gives the same output as the
+# same run without the interruption. Checkpoints are taken between points, between chunks of output times (batch mode) or between
+# steps (vector_iterate), where the run restarts anyway, so they don't change the output either, with one exception: a batch
+# run that keeps its output in memory normally solves all output times in one solver call, and with a checkpoint it is restarted
+# every chunk_records output times instead. Its output then differs from a run without a checkpoint within the solver tolerances.
+# A checkpoint is only used by a run with the same arguments (parameters, initial values, inputs, environment, forcing, ...,
+# compared by a hash of the call, see CORPSE_cache.call_hash). Otherwise it belongs to a different simulation and an error is raised.
+# The checkpoint is removed when the run finishes.
+#
+# Files are replaced atomically (written to a temporary file, then renamed), so an interruption while saving leaves the previous checkpoint.
+
+import logging
+log=logging.getLogger(__name__)
+
+# Files that a Checkpoint writes in its directory
+checkpoint_files=('call.pkl','state.pkl')
+
+
+class Checkpoint:
+    '''Saves and loads the checkpoints of one run in directory path.
+       function: name of the CORPSE_solvers function being run
+       call: its arguments, saved once so that resume can repeat the call
+       interval: minimum time (s) between checkpoints. 0 saves one at every opportunity'''
+
+    def __init__(self,path,function,call,interval=60.0):
+        import os
+        from time import perf_counter
+        import CORPSE_cache
+        self.path=path
+        self.function=function
+        self.interval=interval
+        self.last=perf_counter()
+        self.call_hash=CORPSE_cache.call_hash(function,call)
+        # The directory is only removed at the end if the checkpoint created it. This is recorded in call.pkl,
+        # so that it is still known when an interrupted run is resumed
+        call_file=os.path.join(path,'call.pkl')
+        self.created=not os.path.isdir(path) or (os.path.exists(call_file) and read(call_file).get('created',False))
+        os.makedirs(path,exist_ok=True)
+        # A run that is resuming keeps the call it was started with
+        if not os.path.exists(os.path.join(path,'state.pkl')):
+            write_atomic(call_file,{'function':function,'call':call,'call_hash':self.call_hash,'created':self.created})
+
+    # Load the latest checkpoint, or None if there is none yet
+    # settings: the settings of the current run (times, number of points, pools, solver options). They, and the hash of the
+    # call, have to match the ones the checkpoint was saved with, otherwise the checkpoint belongs to a different run and an error is raised
+    def load(self,settings):
+        import os
+        path=os.path.join(self.path,'state.pkl')
+        if not os.path.exists(path):
+            return None
+        saved=read(path)
+        if saved['function']!=self.function:
+            raise ValueError('Checkpoint in %s was saved by %s, not %s'%(self.path,saved['function'],self.function))
+        if saved.get('call_hash')!=self.call_hash:
+            raise ValueError('Checkpoint in %s was saved by a run with different arguments (parameters, initial values, inputs, '
+                             'environment or forcing). Remove it or use another checkpoint directory to start a new run'%self.path)
+        different=[k for k in settings if not same(settings[k],saved['settings'].get(k))]
+        if len(different)>0:
+            raise ValueError('Checkpoint in %s was saved by a run with different %s'%(self.path,', '.join(different)))
+        return saved
+
+    # True when at least interval seconds have passed since the last checkpoint (or the start of the run)
+    def due(self):
+        from time import perf_counter
+        return perf_counter()-self.last>=self.interval
+
+    # Save a checkpoint
+    # settings: as in load. position: index of the next output time (or point) to run. time: the simulation time it has reached
+    # state: packed pools to continue from. output: output so far (result array or sink state). solves: solver stats so far
+    def save(self,settings,position,time,state,output,solves):
+        import os
+        from time import perf_counter
+        write_atomic(os.path.join(self.path,'state.pkl'),{'function':self.function,'call_hash':self.call_hash,'settings':settings,
+                                                          'position':position,'time':time,'state':state,'output':output,'solves':solves})
+        self.last=perf_counter()
+        log.debug('Checkpoint saved in %s at time %g',self.path,time)
+
+    # Remove the checkpoint once the run has finished. Only the files of the checkpoint are deleted (the directory can also
+    # hold other files, e.g. when it is the output directory), and the directory itself only if the checkpoint created it and it is empty
+    def remove(self):
+        import os
+        for name in checkpoint_files:
+            for path in (os.path.join(self.path,name),os.path.join(self.path,name)+'.tmp'):
+                if os.path.exists(path):
+                    os.remove(path)
+        if self.created:
+            try:
+                os.rmdir(self.path)
+            except OSError:
+                log.debug('Checkpoint directory %s is not empty, so it is kept',self.path)
+
+
+# Pickle data to path, replacing any previous file only once the new one is completely written
+def write_atomic(path,data):
+    import os,pickle
+    tmp=path+'.tmp'
+    with open(tmp,'wb') as f:
+        pickle.dump(data,f,protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp,path)
+
+def read(path):
+    import pickle
+    with open(path,'rb') as f:
+        return pickle.load(f)
+
+# Compare two settings values, which can be numbers, strings, lists or arrays
+def same(a,b):
+    from numpy import array_equal,asarray
+    try:
+        return array_equal(asarray(a),asarray(b))
+    except (TypeError,ValueError):
+        return a==b
+
+# Continue an interrupted run from its checkpoint directory, with the arguments it was started with
+# Returns the output of the solver, as the original call would have
+def resume(path):
+    import os
+    import CORPSE_solvers
+    saved=read(os.path.join(path,'call.pkl'))
+    log.info('Resuming %s from %s',saved['function'],path)
+    return getattr(CORPSE_solvers,saved['function'])(**saved['call'])
+
+# Simulation time reached by the checkpoint in directory path, or None if there is no checkpoint
+def checkpoint_time(path):
+    import os
+    if not os.path.exists(os.path.join(path,'state.pkl')):
+        return None
+    return read(os.path.join(path,'state.pkl'))['time']
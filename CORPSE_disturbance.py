@@ -0,0 +1,161 @@
+# Disturbance events (fires, harvests, ...) during a simulation
+# run_models_ODE(..., events=[...]) applies them at the given times: C is moved instantly between pools, and the parameters
+# can switch to a new set from then on. The solver runs in batch mode and only restarts at the event times (and between
+# chunks of output), continuing from the state of the previous segment with the same output buffers and sink.
+#
+# An event is a dictionary:
+#   {'time': 0.5,                                     time of the event (years). Or an array with one time per point, NaN for
+#                                                     points where it doesn't happen (e.g. sites that burn in different years)
+#    'transfers': [('uFastC','CO2',0.6),              (source, target, fraction): move this fraction of the source pool to the target
+#                  ('uFastC','uPyC',0.05),            pool. Fractions are of the amounts just before the event, so several transfers
+#                  ('MBC_1','uNecroC',0.5)],          from one pool add up. target None removes the C from the system.
+#                                                     A fraction can also be an array with one value per point (e.g. burn severity)
+#    'params': params_after}                          optional: parameter dictionary (or compiled model) used from this time on
+# All the events at one time are applied together, in the order of the list. A record at an output time that equals the event
+# time has the state just after the event. Events at or before the first output time change the initial state.
+# Events after the last output time are ignored. recurring_events builds a fire regime of repeated events.
+#
+# Parameter switches are per point: points that have the event use the new parameters, the others keep theirs. So the model
+# gets an ensemble axis with one member per point (see CORPSE_ensemble) once points have different parameters.
+
+import logging
+log=logging.getLogger(__name__)
+
+
+# Check events and put their times and fractions into arrays with one value per point
+# pools: the pools of the (unpruned) model. Returns a list of compiled events, each a dictionary with
+# 'time' (n_points,), 'transfers' [(source, target, fraction (n_points,))] and 'params' (or None)
+def compile_events(events,pools,npoints):
+    from numpy import atleast_1d,asarray,broadcast_to,zeros,isnan
+    compiled=[]
+    for n,event in enumerate(events):
+        unknown=[k for k in event if k not in ('time','transfers','params')]
+        if len(unknown)>0:
+            raise ValueError('Unknown settings of event %d: %s'%(n,unknown))
+        time=atleast_1d(asarray(event['time'],dtype=float))
+        if time.shape not in ((1,),(npoints,)):
+            raise ValueError('Event %d has %d times but there are %d points'%(n,len(time),npoints))
+        transfers=[]
+        totals=dict()
+        for source,target,fraction in event.get('transfers',[]):
+            for pool in (source,target):
+                if pool is not None and pool not in pools:
+                    raise ValueError('Event %d transfers C of pool %s, which is not in the model'%(n,pool))
+            fraction=atleast_1d(asarray(fraction,dtype=float))
+            if fraction.shape not in ((1,),(npoints,)):
+                raise ValueError('Event %d has %d fractions of %s but there are %d points'%(n,len(fraction),source,npoints))
+            fraction=broadcast_to(fraction,(npoints,))
+            totals[source]=totals.get(source,zeros(npoints))+fraction
+            transfers.append((source,target,fraction))
+        for source,total in totals.items():
+            if (total<0).any() or (total>1).any():
+                raise ValueError('Event %d transfers fractions of pool %s that add up to less than 0 or more than 1'%(n,source))
+        compiled.append({'time':broadcast_to(time,(npoints,)),'transfers':transfers,'params':event.get('params')})
+        if isnan(time).all():
+            log.debug('Event %d does not happen at any point',n)
+    return compiled
+
+# Times of the events (sorted, unique) after first_time and up to last_time
+# Times that only differ by rounding (e.g. 0.2+0.4 and 0.1+0.5) count as one, so the solver doesn't restart for a step of almost zero
+def event_times(events,first_time,last_time):
+    from numpy import concatenate,unique,isnan
+    if len(events)==0:
+        return []
+    t=concatenate([e['time'] for e in events])
+    times=[]
+    for x in unique(t[~isnan(t)]):
+        if x>first_time and x<=last_time and (len(times)==0 or not same_time(x,times[-1])):
+            times.append(float(x))
+    return times
+
+# Event times are equal when they differ only by rounding
+def same_time(a,t):
+    from numpy import absolute,maximum
+    return absolute(a-t)<=1e-9*maximum(1.0,absolute(t))
+
+# Pools that have to stay in the integrated state for the events even if they start at zero (see CORPSE_array.prune_model):
+# targets of transfers, and the protected pools of chem types that any of the models protects (before or after a switch)
+# models: unpruned compiled models. Returns one flag per pool
+def live_pools(events,models,pools):
+    from numpy import zeros,atleast_1d
+    flags=zeros(len(pools))
+    for event in events:
+        for source,target,fraction in event['transfers']:
+            if target is not None:
+                flags[pools.index(target)]=1.0
+    for model in models:
+        if model is None:
+            continue
+        rate=atleast_1d(model['protection_rate'])
+        for n,t in enumerate(model['chem_types']):
+            if (rate[n]!=0).any():
+                flags[pools.index('p'+t+'C')]=1.0
+    return flags
+
+# Apply the transfers of the events at time t to the state of the points that have them
+# SOM: packed state (n_pools, n_points), changed in place. pools: the pools of SOM (which can be a pruned model; transfers
+# from pools that were pruned move nothing)
+def apply_transfers(events,t,SOM,pools):
+    for event in events:
+        points=same_time(event['time'],t)
+        if not points.any() or len(event['transfers'])==0:
+            continue
+        pre=SOM.copy()
+        for source,target,fraction in event['transfers']:
+            if source not in pools:
+                continue
+            amount=pre[pools.index(source)]*fraction*points
+            SOM[pools.index(source)]-=amount
+            if target is not None:
+                SOM[pools.index(target)]+=amount
+    return SOM
+
+# The model after the parameter switches of the events at time t
+# models: the compiled (and pruned) model of each event's params, or None for events without them
+def switch_params(events,models,t,model,npoints):
+    for event,new in zip(events,models):
+        if new is None:
+            continue
+        points=same_time(event['time'],t)
+        if points.any():
+            model=mix_models(model,new,points,npoints)
+    return model
+
+# A model that uses new's parameters at the points in mask (n_points,) and old's parameters at the others
+# Both must have the same pools. The result has an ensemble axis with one member per point, unless mask covers every point
+def mix_models(old,new,mask,npoints):
+    from numpy import atleast_1d,asarray,broadcast_to,where
+    import CORPSE_array
+    if old['pools']!=new['pools'] or old['new_resp_units']!=new['new_resp_units']:
+        raise ValueError('Parameters switched by an event must have the same pools and new_resp_units as the parameters before')
+    if mask.all() and new['nensemble'] in (1,npoints):
+        return new
+    mixed=dict(old)
+    for k in CORPSE_array.ensemble_params:
+        a=atleast_1d(asarray(old[k],dtype=float))
+        b=atleast_1d(asarray(new[k],dtype=float))
+        a=broadcast_to(a,a.shape[:-1]+(npoints,))
+        b=broadcast_to(b,b.shape[:-1]+(npoints,))
+        mixed[k]=where(mask,b,a)
+    mixed['nensemble']=npoints
+    CORPSE_array.reset_memos(mixed)
+    return mixed
+
+# Repeated events, e.g. a fire regime: event (a dictionary as above, without 'time') every interval years from first until stop
+# first and interval can be arrays with one value per point (e.g. a different fire return interval at each site).
+# Returns a list of events, with NaN times for points whose n-th event would come after stop
+def recurring_events(event,first,interval,stop):
+    from numpy import asarray,where,atleast_1d,isnan
+    first=asarray(first,dtype=float)
+    interval=asarray(interval,dtype=float)
+    if (interval<=0).any():
+        raise ValueError('Interval between recurring events must be positive')
+    # Points with a NaN first time never have the event
+    steps=atleast_1d((stop-first)//interval)
+    steps=steps[~isnan(steps)&(steps>=0)]
+    count=int(steps.max())+1 if len(steps)>0 else 0
+    events=[]
+    for n in range(count):
+        time=first+n*interval
+        events.append(dict(event,time=where(time<=stop,time,float('nan'))))
+    return events
@@ -0,0 +1,66 @@
+# Functions for building parameter ensembles for Monte Carlo and calibration runs
+# An ensemble is a normal parameter dictionary in which some values are arrays with one value per ensemble member.
+# CORPSE_array.compile_params turns it into a model with an ensemble axis, and each point of a simulation is then one member,
+# so the whole ensemble runs as one vectorized integration (e.g. run_models_ODE with batch=True, or run_models_iterator).
+
+
+# Parameters are named by their path in the parameter dictionary, either as a tuple or a dot-separated string:
+# ('vmaxref','MBC_1','Fast') or 'vmaxref.MBC_1.Fast', 'Ea.Slow', 'tProtected'
+def param_path(name):
+    if isinstance(name,str):
+        return tuple(name.split('.'))
+    return tuple(name)
+
+# Get the value of a parameter from its path
+def get_param(params,name):
+    val=params
+    for key in param_path(name):
+        val=val[key]
+    return val
+
+# Set the value of a parameter from its path
+def set_param(params,name,value):
+    path=param_path(name)
+    target=params
+    for key in path[:-1]:
+        target=target[key]
+    target[path[-1]]=value
+
+# Draw n points in the unit hypercube with d dimensions
+# method: 'lhs' (Latin hypercube), 'sobol' (scrambled Sobol sequence; n should be a power of 2) or 'random'
+def unit_samples(n,d,method='lhs',seed=None):
+    if method=='random':
+        from numpy.random import default_rng
+        return default_rng(seed).random((n,d))
+    from scipy.stats import qmc
+    if method=='lhs':
+        sampler=qmc.LatinHypercube(d=d,seed=seed)
+    elif method=='sobol':
+        sampler=qmc.Sobol(d=d,scramble=True,seed=seed)
+    else:
+        raise ValueError('Unknown sampling method: %s'%method)
+    return sampler.random(n)
+
+# Build a parameter ensemble with n members
+# params: base parameter dictionary (not changed)
+# ranges: dictionary of parameter path -> (low, high), or (low, high, 'log') to sample uniformly in log space
+# Returns a copy of params where each parameter in ranges is an array of n sampled values. All other parameters are shared
+def sample_ensemble(params,ranges,n,method='lhs',seed=None):
+    import copy
+    from numpy import log,exp
+    ensemble=copy.deepcopy(params)
+    names=list(ranges.keys())
+    samples=unit_samples(n,len(names),method=method,seed=seed)
+    for i,name in enumerate(names):
+        low,high=ranges[name][0],ranges[name][1]
+        if len(ranges[name])>2 and ranges[name][2]=='log':
+            vals=exp(log(low)+samples[:,i]*(log(high)-log(low)))
+        else:
+            vals=low+samples[:,i]*(high-low)
+        set_param(ensemble,name,vals)
+    return ensemble
+
+# Number of members in an ensemble parameter dictionary (1 if no parameter has an ensemble axis)
+def ensemble_size(params):
+    import CORPSE_array
+    return CORPSE_array.get_model(params)['nensemble']
@@ -0,0 +1,180 @@
+# Time series climate forcing for the CORPSE solvers
+# Instead of the cosine annual cycle built from Tmin/Tmax/thetamin/thetamax, the solvers can be driven by records of
+# temperature and soil moisture (e.g. daily or hourly observations) for each point. Values between records are linearly interpolated.
+# Records can be memory-mapped .npy files (see save_forcing and load_forcing), so decades of forcing for thousands of sites
+# don't have to be loaded into memory: only the records around the current time are read.
+#
+# Each call looks up the pair of records that bracket the requested time. The bracket of the last call is cached
+# (for all points, or for each point when every point has its own time), and since solvers move forward in small steps,
+# the next bracket is almost always the same one or the next one, so a full search through the record times is rarely needed.
+
+
+class Forcing:
+    '''Temperature and soil moisture records for a set of points.
+       times: record times (years), increasing
+       T: temperature (C), array of shape (n_times, n_points), or (n_times,) for the same values at every point
+       theta: soil moisture (fraction of saturation), same shape rules as T
+       T and theta can be numpy memmaps; they are never copied as a whole. Before the first and after the last record,
+       the first and last values are used'''
+
+    def __init__(self,times,T,theta):
+        from numpy import asarray
+        self.times=asarray(times,dtype=float)
+        self.T=T.reshape(-1,1) if T.ndim==1 else T
+        self.theta=theta.reshape(-1,1) if theta.ndim==1 else theta
+        for name,vals in (('T',self.T),('theta',self.theta)):
+            if vals.shape[0]!=len(self.times):
+                raise ValueError('%s has %d records but there are %d record times'%(name,vals.shape[0],len(self.times)))
+        if len(self.times)>1 and (self.times[1:]<=self.times[:-1]).any():
+            raise ValueError('Forcing record times must be increasing')
+        self.npoints=max(self.T.shape[1],self.theta.shape[1])
+        for name,vals in (('T',self.T),('theta',self.theta)):
+            if vals.shape[1] not in (1,self.npoints):
+                raise ValueError('%s has %d points, expected %d'%(name,vals.shape[1],self.npoints))
+        # Directory and columns the records were loaded from (see load_forcing), so they can be pickled by reference
+        self.source=None
+        # Cached bracket for calls with one time for all points, and the records around it
+        self.index=0
+        self.rows=None
+        # Cached brackets for calls where each point has its own time
+        self.point_index=None
+
+    # Index i of the records bracketing time t (times[i] <= t < times[i+1]), clipped to 0..n_times-2
+    # Starts from the cached index and only searches if t is not in that interval or the next one
+    def bracket(self,t):
+        from numpy import searchsorted
+        times=self.times
+        last=len(times)-2
+        i=self.index
+        if times[i]<=t and (i==last or t<times[i+1]):
+            return i
+        if i<last and times[i+1]<=t and (i+1==last or t<times[i+2]):
+            self.index=i+1
+        else:
+            self.index=min(max(int(searchsorted(times,t,side='right'))-1,0),max(last,0))
+        return self.index
+
+    # Same as bracket, for an array of times with one time per point. Brackets are cached for each point
+    def point_brackets(self,t,points):
+        from numpy import zeros,searchsorted,clip,nonzero
+        times=self.times
+        last=len(times)-2
+        # Records shared by all points (one column) can be used by any number of points
+        needed=int(points.max())+1 if len(points)>0 else 0
+        if self.point_index is None or len(self.point_index)<needed:
+            old=self.point_index
+            self.point_index=zeros(max(needed,self.npoints),dtype=int)
+            if old is not None:
+                self.point_index[:len(old)]=old
+        i=self.point_index[points]
+        stale=nonzero(~((times[i]<=t)&((i==last)|(t<times[i+1]))))[0]
+        if len(stale)>0:
+            i[stale]=clip(searchsorted(times,t[stale],side='right')-1,0,max(last,0))
+            self.point_index[points]=i
+        return i
+
+    # Forcing for a subset of the points (a slice or an index array). Slices of memory-mapped records stay memory-mapped
+    def select(self,points):
+        T=self.T if self.T.shape[1]==1 else self.T[:,points]
+        theta=self.theta if self.theta.shape[1]==1 else self.theta[:,points]
+        sub=Forcing(self.times,T,theta)
+        if self.source is not None and isinstance(points,slice) and points.step in (None,1):
+            path,columns=self.source
+            sub.source=(path,points if columns is None else compose_slices(columns,points))
+        return sub
+
+    # Memory-mapped records are pickled (e.g. sent to worker processes by CORPSE_parallel) as their file and columns,
+    # and mapped again when unpickled, instead of copying all the records
+    def __getstate__(self):
+        state=self.__dict__.copy()
+        state['rows']=None
+        if self.source is not None:
+            state['T']=state['theta']=None
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        if self.source is not None:
+            path,columns=self.source
+            loaded=load_forcing(path)
+            self.T=loaded.T if columns is None or loaded.T.shape[1]==1 else loaded.T[:,columns]
+            self.theta=loaded.theta if columns is None or loaded.theta.shape[1]==1 else loaded.theta[:,columns]
+
+    # Columns of the records for the given points (column 0 if the records are shared by all points)
+    def columns(self,vals,points):
+        if vals.shape[1]==1:
+            return 0
+        return points
+
+    # Interpolated temperature (C) and moisture at time t
+    # t is one time, or an array with one time per point (for solvers where every point has its own time)
+    # points: index or array of point indices (default all points)
+    # Returns T and theta with one value per point (or single values if points is a single index)
+    def __call__(self,t,points=None):
+        from numpy import ndim,asarray,clip,arange
+        if len(self.times)==1:
+            return self.values(0,0.0,points)
+        if ndim(t)==0:
+            i=self.bracket(t)
+            w=clip((t-self.times[i])/(self.times[i+1]-self.times[i]),0.0,1.0)
+            if points is None:
+                # Cache the two records for all points, so they are only read once while t stays in the same interval
+                if self.rows is None or self.rows[0]!=i:
+                    self.rows=(i,asarray(self.T[i:i+2]),asarray(self.theta[i:i+2]))
+                T,theta=self.rows[1],self.rows[2]
+                return T[0]+w*(T[1]-T[0]),theta[0]+w*(theta[1]-theta[0])
+            return self.values(i,w,points)
+        if points is None:
+            points=arange(self.npoints)
+        i=self.point_brackets(asarray(t),points)
+        w=clip((t-self.times[i])/(self.times[i+1]-self.times[i]),0.0,1.0)
+        return self.values(i,w,points)
+
+    # Interpolated values between records i and i+1 with weight w, for the given points
+    def values(self,i,w,points):
+        from numpy import arange,minimum
+        if points is None:
+            points=arange(self.npoints)
+        j=minimum(i+1,len(self.times)-1)
+        T0=self.T[i,self.columns(self.T,points)]
+        T1=self.T[j,self.columns(self.T,points)]
+        theta0=self.theta[i,self.columns(self.theta,points)]
+        theta1=self.theta[j,self.columns(self.theta,points)]
+        return T0+w*(T1-T0),theta0+w*(theta1-theta0)
+
+
+# Save forcing records as .npy files in directory path (times.npy, T.npy, theta.npy), which load_forcing can memory-map
+def save_forcing(path,times,T,theta):
+    import os
+    from numpy import save,asarray
+    os.makedirs(path,exist_ok=True)
+    save(os.path.join(path,'times.npy'),asarray(times,dtype=float))
+    save(os.path.join(path,'T.npy'),asarray(T,dtype=float))
+    save(os.path.join(path,'theta.npy'),asarray(theta,dtype=float))
+
+# Load forcing records saved by save_forcing. With mmap=True (default) T and theta are memory-mapped and read on demand
+# To build forcing that is too big for memory, create T.npy and theta.npy with numpy.lib.format.open_memmap and fill them site by site
+def load_forcing(path,mmap=True):
+    import os
+    from numpy import load
+    mode='r' if mmap else None
+    forcing=Forcing(load(os.path.join(path,'times.npy')),
+                    load(os.path.join(path,'T.npy'),mmap_mode=mode),
+                    load(os.path.join(path,'theta.npy'),mmap_mode=mode))
+    if mmap:
+        forcing.source=(path,None)
+    return forcing
+
+# Slice of a slice (both with step 1), as one slice of the original columns
+def compose_slices(outer,inner):
+    start=(outer.start or 0)+(inner.start or 0)
+    stop=(outer.start or 0)+inner.stop if inner.stop is not None else outer.stop
+    if outer.stop is not None and stop is not None:
+        stop=min(stop,outer.stop)
+    return slice(start,stop)
+
+# Record times (years) for n daily or hourly records starting at time start (years)
+def record_times(n,step='daily',start=0.0):
+    from numpy import arange
+    per_year={'daily':365.0,'hourly':365.0*24}[step]
+    return start+arange(n)/per_year
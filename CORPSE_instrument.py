@@ -0,0 +1,134 @@
+# Instrumentation for the CORPSE solvers: call counters, timings, solver diagnostics and optional profiling hooks
+# The solvers fill a stats dictionary for every solver call (one per point, or one per chunk of points in batch mode)
+# and summarize them in one dictionary for the whole run. run_models_ODE and run_models_iterator return it with full_output=True.
+# Progress and run summaries go to the logging module instead of being printed (loggers are named after the modules,
+# e.g. 'CORPSE_solvers'). Use logging.basicConfig(level=logging.INFO) to see them on the console, or level=logging.DEBUG
+# to also see the stats of every point.
+
+
+# Counters for one solver call. Values that the solver doesn't report are None
+#   nfev, njev: calls of the derivative and Jacobian functions (nfev includes finite difference Jacobian estimates)
+#   steps, rejected: accepted and rejected time steps. Only run_models_iterator reports rejected steps: neither odeint nor
+#                    solve_ivp gives their number
+#   method_switches: LSODA switches between the non-stiff (Adams) and stiff (BDF) methods. fraction_stiff is the
+#                    fraction of output intervals that ended on the stiff method. Both are only reported by odeint
+#   nlu: LU decompositions (solve_ivp implicit methods)
+#   time_deriv, time_jac: time (s) spent in the derivative and Jacobian functions. time_solver is the rest of time_total
+def new_stats():
+    return {'nfev':0,'njev':0,'steps':None,'rejected':None,'method_switches':None,'fraction_stiff':None,'nlu':None,
+            'time_deriv':0.0,'time_jac':0.0,'time_solver':0.0,'time_total':0.0}
+
+# Wrap a function so that its calls are counted in stats[count] and their run time is added to stats[timer]
+def counted(fun,stats,count,timer):
+    from time import perf_counter
+    def wrapper(*args,**kwargs):
+        t0=perf_counter()
+        val=fun(*args,**kwargs)
+        stats[timer]+=perf_counter()-t0
+        stats[count]+=1
+        return val
+    return wrapper
+
+# Copy the diagnostics of odeint(full_output=True) into stats
+# mused is the method used for the last step before each output time (1: Adams, 2: BDF), so switches are counted per output interval
+def odeint_stats(stats,infodict):
+    from numpy import asarray,count_nonzero,diff
+    mused=asarray(infodict['mused'])
+    stats['steps']=int(infodict['nst'][-1])
+    stats['njev']=int(infodict['nje'][-1])
+    stats['method_switches']=int(count_nonzero(diff(mused)))
+    stats['fraction_stiff']=float((mused==2).mean()) if len(mused)>0 else 0.0
+    stats['message']=infodict.get('message')
+
+# Event function for solve_ivp that counts its accepted steps in stats['steps'], which solve_ivp doesn't report itself.
+# solve_ivp evaluates the events once at the start and then after every accepted step. This event never happens
+def step_counter(stats):
+    stats['steps']=-1
+    def event(t,y):
+        stats['steps']+=1
+        return 1.0
+    return event
+
+# Copy the diagnostics of a solve_ivp solution into stats
+def solve_ivp_stats(stats,sol):
+    stats['njev']=max(stats['njev'],int(sol.njev))
+    stats['nlu']=int(sol.nlu)
+    stats['message']=sol.message
+
+# Add up the stats of several solver calls into one dictionary for the run
+# Counters that none of the calls reported stay None, fraction_stiff is averaged. solves keeps the list of per-call stats
+def summarize(solves):
+    run=new_stats()
+    for name in ['nfev','njev','steps','rejected','method_switches','nlu']:
+        vals=[s[name] for s in solves if s.get(name) is not None]
+        run[name]=sum(vals) if len(vals)>0 else None
+    vals=[s['fraction_stiff'] for s in solves if s.get('fraction_stiff') is not None]
+    run['fraction_stiff']=sum(vals)/len(vals) if len(vals)>0 else None
+    for name in ['time_deriv','time_jac','time_solver','time_total']:
+        run[name]=sum([s[name] for s in solves])
+    run['solves']=solves
+    return run
+
+# Start the optional profiling hooks of a run
+# profile: False, True (keep the cProfile.Profile object in stats['profile']) or a file name to save the profile to (read it with pstats)
+# trace_memory: measure the peak of Python memory allocations during the run with tracemalloc (stats['peak_memory'], bytes).
+#               This slows the run down, so it is off by default
+# Returns the state that stop_hooks needs
+def start_hooks(profile=False,trace_memory=False):
+    from time import perf_counter
+    hooks={'profile':profile,'profiler':None,'tracing':False,'t0':perf_counter()}
+    if trace_memory:
+        import tracemalloc
+        # If tracemalloc is already running (e.g. under a benchmark), only reset its peak and leave it running
+        hooks['tracing']=not tracemalloc.is_tracing()
+        if hooks['tracing']:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        hooks['trace_memory']=True
+    if profile:
+        import cProfile
+        hooks['profiler']=cProfile.Profile()
+        hooks['profiler'].enable()
+    return hooks
+
+# Stop the hooks started by start_hooks and record their results, the total run time and the peak resident memory of the process
+def stop_hooks(hooks,stats):
+    from time import perf_counter
+    if hooks['profiler'] is not None:
+        hooks['profiler'].disable()
+        if isinstance(hooks['profile'],str):
+            hooks['profiler'].dump_stats(hooks['profile'])
+        stats['profile']=hooks['profiler']
+    if hooks.get('trace_memory'):
+        import tracemalloc
+        stats['peak_memory']=tracemalloc.get_traced_memory()[1]
+        if hooks['tracing']:
+            tracemalloc.stop()
+    stats['peak_rss']=peak_rss()
+    stats['time_elapsed']=perf_counter()-hooks['t0']
+    return stats
+
+# Peak resident memory of the process so far (bytes), or None where the resource module is not available
+def peak_rss():
+    try:
+        import resource,sys
+    except ImportError:
+        return None
+    rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return rss if sys.platform=='darwin' else rss*1024
+
+# One line key=value summary of a stats dictionary, for log messages
+def format_stats(stats):
+    parts=[]
+    for name in ['nfev','njev','steps','rejected','method_switches','fraction_stiff','nlu']:
+        if stats.get(name) is not None:
+            parts.append('%s=%s'%(name,stats[name] if not isinstance(stats[name],float) else '%1.3g'%stats[name]))
+    for name in ['time_deriv','time_jac','time_solver','time_output','time_elapsed']:
+        if stats.get(name) is not None:
+            parts.append('%s=%1.3fs'%(name,stats[name]))
+    for name in ['peak_memory','peak_rss']:
+        if stats.get(name) is not None:
+            parts.append('%s=%1.1fMB'%(name,stats[name]/1e6))
+    return ' '.join(parts)
@@ -0,0 +1,310 @@
+# Fused loop kernels for the CORPSE right-hand side and Jacobian, compiled with Numba when it is installed
+# CORPSE_array.CORPSE_deriv_array evaluates the model as a chain of NumPy expressions, each allocating arrays of the full size
+# (decomposition rates, the where() masks, turnover terms, ...). The kernels here calculate the same equations point by point
+# in one loop, writing straight into the output, with no temporaries. This matters most for small calls, e.g. odeint in
+# per-point mode, where NumPy's per-operation overhead dominates, and for big batches, where the temporaries don't fit in cache.
+# The temperature response of vmax is the one exception: it comes from CORPSE_array.temperature_response, so the kernels share
+# its memo (model['Tcache']) with the NumPy functions instead of calculating the exponentials again for every point.
+#
+# deriv and jacobian have the same arguments and results as CORPSE_deriv_array and CORPSE_jacobian_array, and the solvers call
+# them. They use the compiled kernels if Numba can be imported (backend 'auto', the default) and the NumPy functions otherwise.
+# set_backend('numpy') or set_backend('numba') chooses one explicitly. compare_backends checks that the two agree.
+# Numba is optional: nothing else in the model needs it.
+
+import logging
+log=logging.getLogger(__name__)
+
+# The kernels are compiled on their first call (and cached on disk by Numba, so later sessions don't compile them again).
+# Without Numba they stay plain Python functions, which compare_backends can still check against NumPy
+try:
+    import numba
+    jit=numba.njit(cache=True,error_model='numpy')
+except ImportError:
+    numba=None
+    def jit(function):
+        return function
+
+# Backend used by deriv and jacobian: 'auto' (Numba if available, otherwise NumPy), 'numba' or 'numpy'
+backend='auto'
+
+# Choose the backend. 'numba' raises ImportError if Numba is not installed
+def set_backend(name):
+    global backend
+    if name not in ('auto','numba','numpy'):
+        raise ValueError('Unknown backend: %s'%name)
+    if name=='numba' and numba is None:
+        raise ImportError('The numba backend needs the numba package')
+    backend=name
+
+# The backend deriv and jacobian actually use, after resolving 'auto'
+def active_backend():
+    if backend=='numpy' or numba is None:
+        return 'numpy'
+    return 'numba'
+
+
+# Rates of change of the pools for one point. Same equations as CORPSE_array.CORPSE_deriv_array
+# SOM: packed pools of the point. out: rates of change, written in place. Parameter arrays are for this point's ensemble member
+@jit
+def deriv_point(SOM,vmax,theta,claymod,kC,eup,rate,minC,Tmic,et,tProt,sde,gde,amax,prot,necro,nc,nm,npr,e,v,out):
+    th=min(max(theta,0.0),1.0)
+    moisture=th**sde[e]*(1.0-th)**gde[e]/amax[e]
+    totalU=0.0
+    for c in range(nc):
+        totalU+=SOM[c]
+    totalMBC=0.0
+    for m in range(nm):
+        totalMBC+=SOM[nc+npr+m]
+    for c in range(nc):
+        out[c]=-SOM[c]*rate[c,e]*claymod
+    CO2=0.0
+    deadmic=0.0
+    for m in range(nm):
+        B=SOM[nc+npr+m]
+        growth=0.0
+        if totalU!=0.0 and th!=0.0 and B!=0.0:
+            for c in range(nc):
+                D=vmax[m,c,v]*moisture*SOM[c]*B/(totalU*kC[m,c,e]+totalMBC)
+                out[c]-=D
+                growth+=D*eup[m,c,e]
+                CO2+=D*(1.0-eup[m,c,e])
+        turnover=0.0
+        if B>0.0:
+            turnover=max((B-minC[m,e]*totalU)/Tmic[m,e],0.0)
+        out[nc+npr+m]=growth-turnover
+        deadmic+=turnover*et[m,e]
+        CO2+=turnover*(1.0-et[m,e])
+    for k in range(npr):
+        c=prot[k]
+        turnover=SOM[nc+k]/tProt[e]
+        out[c]+=turnover
+        out[nc+k]=SOM[c]*rate[c,e]*claymod-turnover
+    out[nc+npr+nm]=CO2
+    out[necro]+=deadmic
+
+# Jacobian of deriv_point for one point. Same terms as CORPSE_array.CORPSE_jacobian_array
+# J: (n_pools, n_pools) array, written in place. g, h, q, D_den and G are work arrays of shape (nm, nc) and (2, nm)
+@jit
+def jacobian_point(SOM,vmax,theta,claymod,kC,eup,rate,minC,Tmic,et,tProt,sde,gde,amax,prot,necro,nc,nm,npr,e,v,J,g,h,q,D_den,G):
+    th=min(max(theta,0.0),1.0)
+    moisture=th**sde[e]*(1.0-th)**gde[e]/amax[e]
+    totalU=0.0
+    for c in range(nc):
+        totalU+=SOM[c]
+    totalMBC=0.0
+    for m in range(nm):
+        totalMBC+=SOM[nc+npr+m]
+    ib=nc+npr
+    ico2=nc+npr+nm
+    for i in range(ico2+1):
+        for j in range(ico2+1):
+            J[i,j]=0.0
+
+    # Decomposition D[m,c]=Vf[m,c]*u[c]*B[m] with Vf=vmax*moisture/den: g=dD/du[c], h=D_den*kC, q=dD/dB[m]
+    for m in range(nm):
+        B=SOM[ib+m]
+        for c in range(nc):
+            den=totalU*kC[m,c,e]+totalMBC
+            if th!=0.0 and den>0.0:
+                Vf=vmax[m,c,v]*moisture/den
+                D_den[m,c]=Vf*SOM[c]*B/den
+            else:
+                Vf=0.0
+                D_den[m,c]=0.0
+            g[m,c]=Vf*B
+            h[m,c]=D_den[m,c]*kC[m,c,e]
+            q[m,c]=Vf*SOM[c]
+        # Turnover derivatives with respect to B[m] (G[0]) and to each u (G[1])
+        if B>0.0 and B-minC[m,e]*totalU>0.0:
+            G[0,m]=1.0/Tmic[m,e]
+            G[1,m]=-minC[m,e]/Tmic[m,e]
+        else:
+            G[0,m]=0.0
+            G[1,m]=0.0
+
+    # Sums over microbes and chem types shared by several rows
+    sum_resp_h=0.0
+    sum_resp_D=0.0
+    necro_u=0.0
+    co2_u=0.0
+    for m in range(nm):
+        for c in range(nc):
+            sum_resp_h+=(1.0-eup[m,c,e])*h[m,c]
+            sum_resp_D+=(1.0-eup[m,c,e])*D_den[m,c]
+        necro_u+=et[m,e]*G[1,m]
+        co2_u+=(1.0-et[m,e])*G[1,m]
+
+    # Unprotected C and CO2 rows, columns of unprotected C
+    for t in range(nc):
+        gsum=0.0
+        hsum=0.0
+        Dsum=0.0
+        resp_g=0.0
+        for m in range(nm):
+            gsum+=g[m,t]
+            hsum+=h[m,t]
+            Dsum+=D_den[m,t]
+            resp_g+=(1.0-eup[m,t,e])*g[m,t]
+        for s in range(nc):
+            J[t,s]=hsum
+        J[t,t]+=-gsum-rate[t,e]*claymod
+        for n in range(nm):
+            J[t,ib+n]=-q[n,t]+Dsum
+        J[ico2,t]=resp_g-sum_resp_h+co2_u
+    for s in range(nc):
+        J[necro,s]+=necro_u
+
+    # Protection exchange
+    for k in range(npr):
+        c=prot[k]
+        J[c,nc+k]=1.0/tProt[e]
+        J[nc+k,c]=rate[c,e]*claymod
+        J[nc+k,nc+k]=-1.0/tProt[e]
+
+    # Microbial biomass rows, necromass and CO2 columns of microbial biomass
+    for m in range(nm):
+        eup_h=0.0
+        eup_q=0.0
+        eup_D=0.0
+        resp_q=0.0
+        for c in range(nc):
+            eup_h+=eup[m,c,e]*h[m,c]
+            eup_q+=eup[m,c,e]*q[m,c]
+            eup_D+=eup[m,c,e]*D_den[m,c]
+            resp_q+=(1.0-eup[m,c,e])*q[m,c]
+        for s in range(nc):
+            J[ib+m,s]=eup[m,s,e]*g[m,s]-eup_h-G[1,m]
+        for n in range(nm):
+            J[ib+m,ib+n]=-eup_D
+        J[ib+m,ib+m]+=eup_q-G[0,m]
+        J[necro,ib+m]+=et[m,e]*G[0,m]
+        J[ico2,ib+m]=resp_q-sum_resp_D+(1.0-et[m,e])*G[0,m]
+
+# Loops over the points. theta and claymod have one value per point, or a single value for all of them.
+# vmax is the temperature response from CORPSE_array.temperature_response, with a last axis of one value per point or a single value.
+# Ensemble parameters have one member per point, or a single member (last axis of length 1)
+@jit
+def deriv_points(SOM,vmax,theta,claymod,kC,eup,rate,minC,Tmic,et,tProt,sde,gde,amax,prot,necro,out):
+    nc=rate.shape[0]
+    nm=Tmic.shape[0]
+    npr=len(prot)
+    for p in range(SOM.shape[1]):
+        deriv_point(SOM[:,p],vmax,theta[p%len(theta)],claymod[p%len(claymod)],kC,eup,rate,minC,Tmic,et,tProt,sde,gde,amax,
+                    prot,necro,nc,nm,npr,p%len(tProt),p%vmax.shape[2],out[:,p])
+
+@jit
+def jacobian_points(SOM,vmax,theta,claymod,kC,eup,rate,minC,Tmic,et,tProt,sde,gde,amax,prot,necro,J,g,h,q,D_den,G):
+    nc=rate.shape[0]
+    nm=Tmic.shape[0]
+    npr=len(prot)
+    for p in range(SOM.shape[1]):
+        jacobian_point(SOM[:,p],vmax,theta[p%len(theta)],claymod[p%len(claymod)],kC,eup,rate,minC,Tmic,et,tProt,sde,gde,amax,
+                       prot,necro,nc,nm,npr,p%len(tProt),p%vmax.shape[2],J[p],g,h,q,D_den,G)
+
+
+# Parameter arrays of a compiled model (CORPSE_array.compile_params) for the kernels: every ensemble parameter broadcast to its
+# full shape with a last axis of one member or one per point, as contiguous float arrays. vmaxref and Ea are not included: the
+# kernels get the temperature response from CORPSE_array.temperature_response instead. Memoized in model['kernel'] (one of
+# CORPSE_array.memo_keys). The memo is rebuilt if the model's arrays were replaced (e.g. in a copy made by select_members or prune_model)
+def kernel_params(model):
+    from numpy import atleast_1d,asarray,ascontiguousarray,broadcast_to,arange
+    import CORPSE_array
+    sources=[model[k] for k in CORPSE_array.ensemble_params]+[model['prot_matrix']]
+    memo=model.get('kernel')
+    if memo and all([a is b for a,b in zip(memo['sources'],sources)]):
+        return memo['params']
+    nc=model['nchem']; nm=model['nmic']
+    E=model['nensemble']
+    def full(name,shape):
+        return ascontiguousarray(broadcast_to(atleast_1d(asarray(model[name],dtype=float)),shape+(E,)))
+    params=(full('kC',(nm,nc)),full('eup',(nm,nc)),full('protection_rate',(nc,)),
+            full('minMicrobeC',(nm,)),full('Tmic',(nm,)),full('et',(nm,)),full('tProtected',()),full('substrate_diffusion_exp',()),
+            full('gas_diffusion_exp',()),full('aerobic_max',()),arange(nc)[model['prot']].astype('int64'),int(model['necro']))
+    model['kernel']={'sources':sources,'params':params}
+    return params
+
+# Temperature, moisture and clay modifier as float arrays of one value, or one per point
+def point_values(v):
+    from numpy import atleast_1d,asarray
+    return atleast_1d(asarray(v,dtype=float)).ravel()
+
+# Number of points of a call, from the state, environment and ensemble. Like NumPy broadcasting in CORPSE_deriv_array, each of them
+# has one value for all points or one per point, and anything else raises ValueError
+def point_count(SOM,T,theta,claymod,model):
+    from numpy import broadcast_shapes
+    return broadcast_shapes((SOM.shape[1],),(len(T),),(len(theta),),(len(claymod),),(model['nensemble'],))[0]
+
+# Rates of change of all pools, with the same arguments and result as CORPSE_array.CORPSE_deriv_array
+def deriv(SOM,T,theta,model,claymod=1.0):
+    import CORPSE_array
+    if active_backend()=='numpy':
+        return CORPSE_array.CORPSE_deriv_array(SOM,T,theta,model,claymod=claymod)
+    return kernel_deriv(SOM,T,theta,model,claymod,deriv_points)
+
+# Jacobian of deriv, with the same arguments and result as CORPSE_array.CORPSE_jacobian_array
+def jacobian(SOM,T,theta,model,claymod=1.0):
+    import CORPSE_array
+    if active_backend()=='numpy':
+        return CORPSE_array.CORPSE_jacobian_array(SOM,T,theta,model,claymod=claymod)
+    return kernel_jacobian(SOM,T,theta,model,claymod,jacobian_points)
+
+# Call the point loop of a kernel on arrays of points
+def kernel_deriv(SOM,T,theta,model,claymod,kernel):
+    from numpy import asarray,empty,ascontiguousarray
+    import CORPSE_array
+    SOM=asarray(SOM,dtype=float)
+    onedim=SOM.ndim==1
+    if onedim:
+        SOM=SOM[:,None]
+    T=point_values(T); theta=point_values(theta); claymod=point_values(claymod)
+    params=kernel_params(model)
+    npts=point_count(SOM,T,theta,claymod,model)
+    if SOM.shape[1]!=npts:
+        SOM=SOM[:,[0]*npts]
+    vmax=ascontiguousarray(CORPSE_array.temperature_response(T,model))
+    out=empty(SOM.shape)
+    kernel(SOM,vmax,theta,claymod,*params,out)
+    if onedim and npts==1:
+        return out[:,0]
+    return out
+
+def kernel_jacobian(SOM,T,theta,model,claymod,kernel):
+    from numpy import asarray,empty,ascontiguousarray
+    import CORPSE_array
+    SOM=asarray(SOM,dtype=float)
+    onedim=SOM.ndim==1
+    if onedim:
+        SOM=SOM[:,None]
+    T=point_values(T); theta=point_values(theta); claymod=point_values(claymod)
+    params=kernel_params(model)
+    npts=point_count(SOM,T,theta,claymod,model)
+    if SOM.shape[1]!=npts:
+        SOM=SOM[:,[0]*npts]
+    vmax=ascontiguousarray(CORPSE_array.temperature_response(T,model))
+    npools,nc,nm=SOM.shape[0],model['nchem'],model['nmic']
+    J=empty((npts,npools,npools))
+    kernel(SOM,vmax,theta,claymod,*params,J,empty((nm,nc)),empty((nm,nc)),empty((nm,nc)),empty((nm,nc)),empty((2,nm)))
+    if onedim and npts==1:
+        return J[0]
+    return J.transpose(1,2,0)
+
+
+# Check that the kernels agree with the NumPy model functions, on random states around the initial values of params
+# Uses the compiled kernels if Numba is installed, otherwise the same kernels as plain Python (slow, but the same code).
+# Covers empty microbial groups and, with an ensemble, different parameters at each point.
+# Returns the largest relative differences of the derivative and the Jacobian
+def compare_backends(params,initvals,npoints=50,seed=0):
+    from numpy import random,absolute,maximum
+    import CORPSE_array
+    rng=random.default_rng(seed)
+    model=CORPSE_array.get_model(params)
+    SOM=CORPSE_array.pack_pools(initvals,model['pools'])[:,[0]*npoints]*rng.uniform(0.5,1.5,(len(model['pools']),npoints))
+    T=rng.uniform(273.15,313.15,npoints)
+    theta=rng.uniform(0.0,1.0,npoints)
+    claymod=rng.uniform(0.5,2.0,npoints)
+    D0=CORPSE_array.CORPSE_deriv_array(SOM,T,theta,model,claymod=claymod)
+    D1=kernel_deriv(SOM,T,theta,model,claymod,deriv_points)
+    J0=CORPSE_array.CORPSE_jacobian_array(SOM,T,theta,model,claymod=claymod)
+    J1=kernel_jacobian(SOM,T,theta,model,claymod,jacobian_points)
+    diff=lambda a,b: float((absolute(a-b)/maximum(absolute(a).max(),1e-300)).max())
+    return {'deriv':diff(D0,D1),'jacobian':diff(J0,J1)}
@@ -0,0 +1,109 @@
+# Multi-layer soil columns: vertically stacked layers (e.g. O horizon on top of mineral soil layers), coupled by vertical C transport
+# Each layer runs the CORPSE model with its own temperature, moisture and clay (and parameters, with an ensemble axis; see CORPSE_ensemble).
+# run_models_ODE(..., layers=n_layers, transport=...) runs columns: the points are the layers of the columns, top layer first,
+# column by column (point = column*n_layers + layer). So all the other options (forcing, sinks, checkpoints, ...) work on columns too.
+#
+# transport is a dictionary of transport rates (1/year) for each pool that moves:
+#   {'advection': {'uFastC': 0.05, ...},    downward flux (e.g. leaching of dissolved C) of a fraction of the pool in the layer above
+#    'diffusion': {'pSlowC': 0.01, ...},    mixing between neighbouring layers (e.g. bioturbation), proportional to the difference between them
+#    'bottom': 'open'}                      'open': advection out of the bottom layer leaves the column, 'closed': it stays (default 'open')
+# Pools that are not listed don't move. Microbial biomass and CO2 normally stay in their layer.
+#
+# Transport only couples each pool with the same pool in the layers directly above and below, so the Jacobian of a column is
+# banded with bandwidth n_pools (LSODA banded storage), or sparse with the same structure. Solver cost grows linearly with the number of layers.
+
+
+# Transport rates as vectors with one value per pool (in the order of pools)
+# Returns a dictionary with 'advection' and 'diffusion' (n_pools,), 'open' (bottom boundary) and 'nlayers'
+def compile_transport(transport,pools,nlayers):
+    from numpy import zeros
+    if transport is None:
+        transport={}
+    unknown=[k for k in transport if k not in ('advection','diffusion','bottom')]
+    if len(unknown)>0:
+        raise ValueError('Unknown transport settings: %s'%unknown)
+    compiled={'nlayers':int(nlayers),'open':transport.get('bottom','open')=='open'}
+    if transport.get('bottom','open') not in ('open','closed'):
+        raise ValueError('transport bottom must be "open" or "closed", not %s'%transport['bottom'])
+    for name in ('advection','diffusion'):
+        rates=zeros(len(pools))
+        for pool,rate in transport.get(name,{}).items():
+            if pool not in pools:
+                raise ValueError('Transport of pool %s, which is not in the model'%pool)
+            rates[list(pools).index(pool)]=rate
+        compiled[name]=rates
+    return compiled
+
+# Transport rates for a subset of the pools (e.g. a pruned model, see CORPSE_array.prune_model)
+# Transport only moves C that is already there, so a pool that is zero in every layer stays zero and can still be pruned
+def select_pools(transport,keep):
+    sub=dict(transport)
+    sub['advection']=transport['advection'][keep]
+    sub['diffusion']=transport['diffusion'][keep]
+    return sub
+
+# Rate of change of each pool from vertical transport
+# SOM: packed state (n_pools, n_points) with points = column*n_layers + layer. Returns an array of the same shape
+def transport_deriv(SOM,transport):
+    from numpy import zeros
+    npools=SOM.shape[0]
+    C=SOM.reshape(npools,-1,transport['nlayers'])
+    adv=transport['advection'][:,None,None]
+    dif=transport['diffusion'][:,None,None]
+    # Downward flux out of each layer, into the layer below
+    F=zeros(C.shape)
+    F[:,:,:-1]=adv*C[:,:,:-1]+dif*(C[:,:,:-1]-C[:,:,1:])
+    if transport['open']:
+        F[:,:,-1]=adv[:,:,0]*C[:,:,-1]
+    deriv=-F
+    deriv[:,:,1:]+=F[:,:,:-1]
+    return deriv.reshape(SOM.shape)
+
+# Jacobian of transport_deriv, which is constant because transport is linear
+# Returns (diag, lower, upper), each (n_pools, n_points): the derivative of each point's rate with respect to the same pool
+# in the same point, the point above (previous point) and the point below (next point). Zero across column boundaries
+def transport_jacobian(transport,npoints):
+    from numpy import zeros
+    L=transport['nlayers']
+    adv=transport['advection'][:,None,None]
+    dif=transport['diffusion'][:,None,None]
+    shape=(len(transport['advection']),npoints//L,L)
+    diag=zeros(shape)
+    lower=zeros(shape)
+    upper=zeros(shape)
+    # Outflow to the layer below (and out of the bottom of the column if it is open)
+    diag[:,:,:-1]-=adv+dif
+    if transport['open']:
+        diag[:,:,-1]-=adv[:,:,0]
+    # Diffusion from the layer below
+    diag[:,:,1:]-=dif
+    upper[:,:,:-1]=dif
+    # Inflow from the layer above
+    lower[:,:,1:]=adv+dif
+    return diag.reshape(-1,npoints),lower.reshape(-1,npoints),upper.reshape(-1,npoints)
+
+# Sparsity pattern of the Jacobian of a stacked set of columns (for solve_ivp with finite difference Jacobians)
+def column_sparsity(model,transport,npoints):
+    from scipy.sparse import kron,identity,diags
+    import CORPSE_array
+    moving=diags(((transport['advection']!=0)|(transport['diffusion']!=0)).astype(float))
+    # Neighbouring layers within a column (not across column boundaries)
+    L=transport['nlayers']
+    neighbours=kron(identity(npoints//L),diags([1.0]*(L-1),1)+diags([1.0]*(L-1),-1))
+    return (kron(identity(npoints),CORPSE_array.jacobian_sparsity(model))+kron(neighbours,moving)).tocsc()!=0
+
+# C inputs of the columns as an array (n_pools, n_points)
+# inputs: a dictionary of input rates for every layer, or a list with one dictionary per layer (e.g. litter inputs only to the top layer)
+def pack_inputs(inputs,pools,nlayers,npoints):
+    from numpy import array,tile
+    import CORPSE_array
+    if isinstance(inputs,dict):
+        inputs=[inputs]*nlayers
+    if len(inputs)!=nlayers:
+        raise ValueError('There are inputs for %d layers but the columns have %d layers'%(len(inputs),nlayers))
+    layer_inputs=array([CORPSE_array.pack_inputs(i,pools) for i in inputs]).T
+    return tile(layer_inputs,npoints//nlayers)
+
+# Total C of each pool in each column, summed over layers: values (n_pools, n_points, ...) -> (n_pools, n_columns, ...)
+def column_totals(values,nlayers):
+    return values.reshape((values.shape[0],-1,nlayers)+values.shape[2:]).sum(axis=2)
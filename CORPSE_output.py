@@ -0,0 +1,148 @@
+# Output sinks for long simulations. Instead of keeping every pool at every time step in memory, the solvers
+# write their output to a sink in chunks of records. A sink keeps only every N-th record and only the selected pools.
+# OutputSink keeps the selected output in memory. NpyOutputSink streams it to one memory-mapped .npy file per pool on disk,
+# so memory use stays bounded no matter how long the run is.
+#
+# Stored output has the same layout as vector_iterate output: a dictionary of pools, each an array of shape (n_points, n_records).
+# So CORPSE_array.sumCtypes and CORPSE_solvers.totalCarbon work directly on it. Output loaded from disk with load_output
+# is memory-mapped, so data is only read when (and where) it is used.
+
+import logging
+log=logging.getLogger(__name__)
+
+
+class OutputSink:
+    '''Keeps every `every`-th output record of the selected pools in memory.
+       pools: list of pool names to keep (default all pools)
+       every: keep records 0, every, 2*every, ... of the requested output times'''
+
+    def __init__(self,pools=None,every=1):
+        self.pools=pools
+        self.every=int(every)
+        self.store=None
+        self.times=None
+
+    # Called by the solver before the first write
+    # model_pools: names of the pools in the order of the values that will be written
+    # full_pools: all pools of the model, if the solver only integrates some of them (see CORPSE_array.prune_model).
+    #             Pools that are not written stay zero
+    # resume: the run continues from a checkpoint (see CORPSE_checkpoint). Output already on disk is kept, and set_state
+    #         restores output kept in memory
+    def open(self,model_pools,npoints,times,full_pools=None,resume=False):
+        from numpy import asarray
+        if full_pools is None:
+            full_pools=model_pools
+        if self.pools is None:
+            self.pools=list(full_pools)
+        missing=[p for p in self.pools if p not in full_pools]
+        if len(missing)>0:
+            raise ValueError('Output pools not in model: %s'%missing)
+        self.pool_index=[list(model_pools).index(p) if p in model_pools else None for p in self.pools]
+        self.times=asarray(times)[::self.every]
+        self.store=self.allocate(npoints,len(self.times),resume)
+
+    def allocate(self,npoints,nrecords,resume=False):
+        from numpy import zeros
+        return dict([(p,zeros((npoints,nrecords))) for p in self.pools])
+
+    # Output stored so far, to be saved in a checkpoint, and restoring it when a run resumes
+    def get_state(self):
+        return self.store
+
+    def set_state(self,state):
+        self.store=state
+
+    # Write a block of output records
+    # values: array of shape (n_model_pools, n_points, n_records) for output times start to start+n_records
+    # points: the points that the values belong to (default all points)
+    def write(self,values,start,points=slice(None)):
+        from numpy import arange
+        records=arange(start,start+values.shape[2])
+        keep=records%self.every==0
+        if not keep.any():
+            return
+        out=records[keep]//self.every
+        for p,n in zip(self.pools,self.pool_index):
+            if n is not None:
+                self.store[p][points,out[0]:out[-1]+1]=values[n][:,keep]
+
+    def close(self):
+        pass
+
+    # Returns the stored output as a dictionary of pools, each of shape (n_points, n_records)
+    def result(self):
+        return self.store
+
+
+class NpyOutputSink(OutputSink):
+    '''Streams every `every`-th output record of the selected pools to memory-mapped .npy files in directory path.
+       One file per pool (<pool>.npy) plus times.npy. Read it back with load_output'''
+
+    def __init__(self,path,pools=None,every=1):
+        OutputSink.__init__(self,pools=pools,every=every)
+        self.path=path
+
+    # Create the files. They are only mapped into memory while a block of records is being written
+    # When resuming, the files written before the checkpoint are kept if they have the right shape
+    def allocate(self,npoints,nrecords,resume=False):
+        import os
+        from numpy import save
+        from numpy.lib.format import open_memmap
+        if resume and all([os.path.exists(os.path.join(self.path,p+'.npy')) for p in self.pools]):
+            if all([open_memmap(os.path.join(self.path,p+'.npy'),mode='r').shape==(npoints,nrecords) for p in self.pools]):
+                return None
+            log.warning('Output files in %s do not match the run, starting them again',self.path)
+        os.makedirs(self.path,exist_ok=True)
+        save(os.path.join(self.path,'times.npy'),self.times)
+        for p in self.pools:
+            open_memmap(os.path.join(self.path,p+'.npy'),mode='w+',dtype='float64',shape=(npoints,nrecords)).flush()
+        return None
+
+    def write(self,values,start,points=slice(None)):
+        import os
+        from numpy.lib.format import open_memmap
+        from numpy import arange
+        records=arange(start,start+values.shape[2])
+        keep=records%self.every==0
+        if not keep.any():
+            return
+        out=records[keep]//self.every
+        # One pool at a time: map the file, write, then push the pages to disk and unmap them so they don't accumulate in memory
+        for p,n in zip(self.pools,self.pool_index):
+            if n is None:
+                continue
+            store=open_memmap(os.path.join(self.path,p+'.npy'),mode='r+')
+            store[points,out[0]:out[-1]+1]=values[n][:,keep]
+            store.flush()
+            del store
+
+    # Output is flushed to disk after every write, so checkpoints don't need to save it
+    def get_state(self):
+        return None
+
+    def set_state(self,state):
+        pass
+
+    def result(self):
+        return load_output(self.path)
+
+
+# Load output written by NpyOutputSink as a dictionary of read-only memory-mapped pools, each of shape (n_points, n_records)
+# Nothing is read from disk until the values are used. points (a slice or index array) selects a subset of points,
+# which allows sumCtypes/totalCarbon to be calculated chunk by chunk on output that is too big for memory
+def load_output(path,points=None):
+    import os
+    from numpy import load
+    SOM={}
+    for f in sorted(os.listdir(path)):
+        if f.endswith('.npy') and f!='times.npy':
+            SOM[f[:-4]]=load(os.path.join(path,f),mmap_mode='r')
+            if points is not None:
+                SOM[f[:-4]]=SOM[f[:-4]][points]
+    return SOM
+
+# Output times of the records stored by NpyOutputSink
+def load_times(path):
+    import os
+    from numpy import load
+    return load(os.path.join(path,'times.npy'))
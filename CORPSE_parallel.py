@@ -0,0 +1,186 @@
+# Functions for running CORPSE scenarios and sites in parallel on a pool of worker processes
+# Scenarios and chunks of sites are independent, so they can be sent to separate processes.
+# Only compiled parameter arrays, packed initial values and environmental vectors are sent to the workers,
+# and results come back as arrays of shape (n_pools, n_points, n_times). Results (or DataFrames) are only built in the main process.
+
+import CORPSE_array
+import CORPSE_solvers
+import logging
+log=logging.getLogger(__name__)
+
+
+# Convert the environmental conditions of a scenario into one vector per variable
+# envir is a dictionary with Tmin, Tmax, thetamin, thetamax, clay and optionally inputs. Other keys (e.g. porosity) are ignored
+# Tmin, Tmax, thetamin and thetamax can be None (or left out) when the solver is given tabular forcing; they are then NaN
+def pack_envir(envir):
+    from numpy import atleast_1d,broadcast_to,nan
+    npoints=len(atleast_1d(envir['clay']))
+    packed=dict([(n,broadcast_to(atleast_1d(nan if envir.get(n) is None else envir[n]),(npoints,)).astype(float)) for n in ['Tmin','Tmax','thetamin','thetamax','clay']])
+    packed['inputs']=dict(envir.get('inputs',{}))
+    return packed
+
+# Convert one scenario (initvals, params, envir, times) into the compact task that is sent to a worker
+# The compiled model is a copy without its memos (see CORPSE_array.memo_keys), which earlier runs may have filled in this process
+def pack_scenario(initvals,params,envir,times):
+    from numpy import array,asarray
+    envir=pack_envir(envir)
+    ivals=array([CORPSE_solvers.get_initvals(initvals,point) for point in range(len(envir['clay']))])
+    model=CORPSE_array.reset_memos(dict(CORPSE_array.get_model(params)))
+    return (ivals,model,envir,asarray(times,dtype=float))
+
+# Worker function: runs one packed task and returns either ('ok', result array) or ('error', exception)
+# Exceptions are caught here so that one failed task doesn't stop the others
+def run_task(task):
+    ivals,model,envir,times,solver_kwargs=task
+    try:
+        result=CORPSE_solvers.run_models_ODE(Tmin=envir['Tmin'],Tmax=envir['Tmax'],thetamin=envir['thetamin'],thetamax=envir['thetamax'],
+                                             times=times,inputs=envir['inputs'],params=model,clay=envir['clay'],initvals=ivals,
+                                             output='array',**solver_kwargs)
+        return ('ok',result)
+    except Exception as err:
+        return ('error',err)
+
+# Run a list of tasks on nworkers processes and return their outcomes in the same order as the tasks
+# nworkers=1 runs everything in the current process, which is convenient for debugging
+# function is the worker function, which returns ('ok', value) or ('error', exception) for a task (default run_task)
+# A task whose worker process dies (e.g. killed for running out of memory) gets an ('error', exception) outcome like any other
+# failure. The pool can't run anything after a worker dies, so the tasks that hadn't finished are run again on a new pool.
+# Tasks that were running when it broke are run again on their own, to find the one that killed its worker
+def map_tasks(tasks,nworkers=None,function=None):
+    import os
+    if function is None:
+        function=run_task
+    if nworkers is None:
+        nworkers=os.cpu_count()
+    nworkers=max(1,min(nworkers,len(tasks)))
+    if nworkers==1:
+        return [function(task) for task in tasks]
+
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    outcomes=[None]*len(tasks)
+    pending=list(range(len(tasks)))
+    while len(pending)>0:
+        running,pending=run_pool(function,tasks,pending,outcomes,nworkers)
+        if len(running)==0 and len(pending)>0:
+            # The pool broke before any task started, so none of them can be run
+            for n in pending:
+                outcomes[n]=('error',BrokenProcessPool('Worker processes died before running the task'))
+            break
+        if len(running)>0:
+            log.error('Worker process died, running the tasks that were running on it on their own')
+        # Each task that was running gets a pool of its own (as many at once as there are workers)
+        with ThreadPoolExecutor(max_workers=max(1,min(nworkers,len(running)))) as threads:
+            list(threads.map(lambda n: run_pool(function,tasks,[n],outcomes,1),running))
+        for n in running:
+            if outcomes[n] is None:
+                log.error('Task %d killed its worker process',n)
+                outcomes[n]=('error',BrokenProcessPool('Worker process died while running the task'))
+    return outcomes
+
+# Run the tasks with indices in todo on a new pool of up to nworkers processes, with their outcomes stored in outcomes
+# Returns two lists of indices: tasks that were running when a worker process died, and tasks that hadn't started
+# (both are empty unless a worker died)
+def run_pool(function,tasks,todo,outcomes,nworkers):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    # Flags set by the workers when they start a task
+    started=multiprocessing.RawArray('b',len(tasks))
+    broken=False
+    with ProcessPoolExecutor(max_workers=min(nworkers,len(todo)),initializer=init_worker,initargs=(started,)) as executor:
+        futures=[executor.submit(run_flagged,function,n,tasks[n]) for n in todo]
+        for n,future in zip(todo,futures):
+            try:
+                outcomes[n]=future.result()
+            except BrokenProcessPool:
+                broken=True
+            except Exception as err:
+                outcomes[n]=('error',err)
+    if not broken:
+        return [],[]
+    unfinished=[n for n in todo if outcomes[n] is None]
+    return [n for n in unfinished if started[n]],[n for n in unfinished if not started[n]]
+
+# Flags of started tasks in a worker process (see run_pool)
+started_flags=None
+def init_worker(started):
+    global started_flags
+    started_flags=started
+
+def run_flagged(function,n,task):
+    started_flags[n]=1
+    return function(task)
+
+# Convert a (n_pools, n_points, n_times) result array into a list with one DataFrame per point, like run_models_ODE(output='dataframes')
+def to_dataframes(result,times):
+    return CORPSE_solvers.make_output(result,times,'dataframes')
+
+# Run several scenarios in parallel
+# scenarios is a dictionary (or list) of (initvals, params, envir, times) tuples. See pack_envir for the contents of envir
+# Other keyword arguments (method, jac, batch, rtol, ...) are passed on to run_models_ODE
+# output is the type of each result, as in run_models_ODE ('dataframes', 'results' or 'array')
+# Returns two dictionaries, keyed like scenarios (or by list position): results of the scenarios that worked, and the exceptions
+# of the scenarios that failed
+def run_scenarios(scenarios,nworkers=None,output='dataframes',**solver_kwargs):
+    if isinstance(scenarios,dict):
+        names=list(scenarios.keys())
+        scenario_list=[scenarios[name] for name in names]
+    else:
+        names=list(range(len(scenarios)))
+        scenario_list=list(scenarios)
+
+    tasks=[]
+    errors={}
+    for name,(initvals,params,envir,times) in zip(names,scenario_list):
+        try:
+            tasks.append((name,pack_scenario(initvals,params,envir,times)+(solver_kwargs,)))
+        except Exception as err:
+            errors[name]=err
+
+    results={}
+    outcomes=map_tasks([task for name,task in tasks],nworkers)
+    for (name,task),(status,value) in zip(tasks,outcomes):
+        if status=='ok':
+            results[name]=CORPSE_solvers.make_output(value,task[3],output)
+        else:
+            errors[name]=value
+    for name in errors:
+        log.warning('Scenario %s failed: %r',name,errors[name])
+
+    # Keep the results in the same order as the scenarios
+    results=dict([(name,results[name]) for name in names if name in results])
+    return results,errors
+
+# Run many points in parallel by splitting them into chunks. Each chunk is run as one batched system on a worker (batch=True by default)
+# Arguments are the same as run_models_ODE. chunksize defaults to spreading the points evenly over the workers
+# Tabular forcing (forcing=CORPSE_forcing.Forcing) is split into chunks too. Memory-mapped forcing is sent to the workers by file name
+# Returns the same output as run_models_ODE, with points in their original order. Raises an error if any chunk failed
+def run_sites_parallel(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals,nworkers=None,chunksize=None,output='dataframes',**solver_kwargs):
+    import os
+    from numpy import concatenate,asarray
+    ivals,model,envir,times=pack_scenario(initvals,params,{'Tmin':Tmin,'Tmax':Tmax,'thetamin':thetamin,'thetamax':thetamax,'clay':clay,'inputs':inputs},times)
+    solver_kwargs.setdefault('batch',True)
+    npoints=len(envir['clay'])
+    if nworkers is None:
+        nworkers=os.cpu_count()
+    if chunksize is None:
+        chunksize=-(-npoints//max(1,nworkers))
+
+    tasks=[]
+    for start in range(0,npoints,chunksize):
+        chunk=slice(start,min(start+chunksize,npoints))
+        chunk_envir=dict([(n,v[chunk]) for n,v in envir.items() if n!='inputs'])
+        chunk_envir['inputs']=envir['inputs']
+        chunk_kwargs=solver_kwargs
+        if solver_kwargs.get('forcing') is not None:
+            chunk_kwargs=dict(solver_kwargs,forcing=solver_kwargs['forcing'].select(chunk))
+        tasks.append((ivals[chunk],CORPSE_array.select_members(model,chunk),chunk_envir,times,chunk_kwargs))
+
+    outcomes=map_tasks(tasks,nworkers)
+    for n,(status,value) in enumerate(outcomes):
+        if status=='error':
+            raise RuntimeError('Chunk starting at point %d failed: %r'%(n*chunksize,value)) from value
+
+    result=concatenate([value for status,value in outcomes],axis=1)
+    return CORPSE_solvers.make_output(result,asarray(times),output)
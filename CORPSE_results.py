@@ -0,0 +1,133 @@
+# Columnar container for simulation results
+# The solvers return all pools of all points at all output times as one array of shape (n_pools, n_points, n_times),
+# with the pool names, output times and (optionally) point labels along its axes, when they are called with output='results'.
+# It is an alternative to their default list of one pandas DataFrame per point: building thousands of small DataFrames can take
+# longer than a short simulation.
+#
+# Results works like the dictionaries of pools returned by vector_iterate and the output sinks: results['CO2'] is an array of
+# shape (n_points, n_times), so CORPSE_array.sumCtypes and CORPSE_solvers.totalCarbon work on it directly.
+# Pools, points and subsets of points are views of the same array, nothing is copied. Diagnostics (sum_ctypes, total_carbon,
+# flux) are calculated for all points at once. save/load_results store everything in one .npz file.
+
+
+class Results:
+    '''Simulation output with named axes.
+       values: array of shape (n_pools, n_points, n_times)
+       pools: pool names, in the order of the first axis
+       times: output times (years)
+       points: optional labels of the points (e.g. site names), default 0..n_points-1'''
+
+    dims=('pool','point','time')
+
+    def __init__(self,values,pools,times,points=None):
+        from numpy import asarray,arange
+        self.values=asarray(values)
+        self.pools=list(pools)
+        self.times=asarray(times)
+        if self.values.ndim!=3:
+            raise ValueError('Results values must have 3 dimensions (pools, points, times), not %d'%self.values.ndim)
+        self.points=arange(self.values.shape[1]) if points is None else asarray(points)
+        expected=(len(self.pools),len(self.points),len(self.times))
+        if self.values.shape!=expected:
+            raise ValueError('Results values have shape %s, expected %s from pools, points and times'%(self.values.shape,expected))
+        self.index=dict([(p,n) for n,p in enumerate(self.pools)])
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def npoints(self):
+        return self.values.shape[1]
+
+    # Dictionary interface: one pool for all points, an array of shape (n_points, n_times)
+    # An integer gives one point instead (see point), so results[0]['CO2'] works as it does with the list of DataFrames
+    def __getitem__(self,pool):
+        from numbers import Integral
+        if isinstance(pool,Integral):
+            return self.point(pool)
+        if pool not in self.index:
+            raise KeyError(pool)
+        return self.values[self.index[pool]]
+
+    def __contains__(self,pool):
+        return pool in self.index
+
+    def __iter__(self):
+        return iter(self.pools)
+
+    def __len__(self):
+        return len(self.pools)
+
+    def keys(self):
+        return list(self.pools)
+
+    def items(self):
+        return [(p,self[p]) for p in self.pools]
+
+    def __repr__(self):
+        return '<Results: %d pools x %d points x %d times>'%self.shape
+
+    # One point as a dictionary of pools, each an array of its values at the output times (like the columns of the DataFrames)
+    def point(self,n):
+        return dict([(p,self.values[i,n]) for i,p in enumerate(self.pools)])
+
+    # Results for a subset of the points. A slice (or a single point) gives a view of the same array, an index array a copy
+    def select(self,points):
+        if isinstance(points,int):
+            points=slice(points,points+1)
+        return Results(self.values[:,points],self.pools,self.times,self.points[points])
+
+    # Sum of the pools of all chem types with prefix ('u' unprotected, 'p' protected), shape (n_points, n_times)
+    def sum_ctypes(self,prefix):
+        import CORPSE_array
+        return self.sum_pools([prefix+t+'C' for t in CORPSE_array.chem_types])
+
+    # Total C in the soil: unprotected, protected and microbial pools (CO2 is not included), shape (n_points, n_times)
+    def total_carbon(self):
+        import CORPSE_array
+        return self.sum_pools([p for p in self.pools if p[0] in 'up' and p[1:-1] in CORPSE_array.chem_types]+
+                              [m for m in CORPSE_array.microbial_pools if m in self.index])
+
+    # Sum of a list of pools, reduced over the pool axis in one step
+    def sum_pools(self,pools):
+        return self.values[[self.index[p] for p in pools]].sum(axis=0)
+
+    # Rate of change of a pool (per year) between output times, shape (n_points, n_times). With the default pool, CO2,
+    # this is the respiration flux. The first record is NaN, as with DataFrame.diff
+    # relative_to: divide by this (e.g. initial total C, one value per point) to get the rate as a fraction of it
+    def flux(self,pool='CO2',relative_to=None):
+        from numpy import full,nan,diff,asarray
+        out=full(self[pool].shape,nan)
+        out[:,1:]=diff(self[pool],axis=1)/diff(self.times)
+        if relative_to is not None:
+            out/=asarray(relative_to).reshape(-1,1)
+        return out
+
+    # The output as a list with one pandas DataFrame per point, indexed by time, as run_models_ODE returns it by default
+    def to_dataframes(self):
+        import pandas
+        return [pandas.DataFrame(self.values[:,n,:].T,columns=self.pools,index=self.times) for n in range(self.npoints)]
+
+    # Save to one .npz file. dtype (e.g. 'float32') stores the values at a lower precision to save space,
+    # compress=True compresses the file (slower to write and read)
+    def save(self,path,dtype=None,compress=False):
+        from numpy import savez,savez_compressed,asarray
+        values=self.values if dtype is None else self.values.astype(dtype)
+        (savez_compressed if compress else savez)(path,values=values,pools=asarray(self.pools),times=self.times,points=self.points)
+
+
+# Load results saved by Results.save
+def load_results(path):
+    from numpy import load
+    with load(path,allow_pickle=False) as data:
+        return Results(data['values'],[str(p) for p in data['pools']],data['times'],data['points'])
+
+# Join results of the same pools and times along the point axis (e.g. chunks of sites run in parallel)
+def concatenate(results):
+    from numpy import concatenate as join
+    first=results[0]
+    for r in results[1:]:
+        if r.pools!=first.pools or len(r.times)!=len(first.times) or (r.times!=first.times).any():
+            raise ValueError('Results to concatenate must have the same pools and times')
+    return Results(join([r.values for r in results],axis=1),first.pools,first.times,join([r.points for r in results]))
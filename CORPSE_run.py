@@ -0,0 +1,249 @@
+# Command line entry point for running CORPSE scenarios from a JSON or TOML configuration file, without a display
+# Results go to one directory per scenario, stats.json has the solver stats (see CORPSE_instrument).
+# Only numpy and scipy are needed to run scenarios; matplotlib is only imported for --plot (with a non-interactive backend).
+# Without matplotlib, --plot logs a warning and the scenarios run as usual.
+#
+#   python CORPSE_run.py scenarios.toml --out results
+#   python CORPSE_run.py scenarios.json --out results --scenario "high sev burn sandy soil" --format csv --plot
+#   python CORPSE_run.py scenarios.toml --out results --checkpoint 600     checkpoints every 10 minutes; run it again to resume
+#
+# Configuration file layout (JSON shown; TOML has the same structure):
+#   {"defaults": {...},                  optional, settings shared by all scenarios (merged into each scenario)
+#    "scenarios": {"name": {
+#        "initvals": {"uFastC": 3.0, ...},                             initial pools. Values can be lists with one value per point
+#        "params": {"vmaxref": {"MBC_1": {"Fast": 6.9, ...}}, ...},    parameter dictionary, as in Whitman_sims.py
+#        "envir": {"Tmin": 18, "Tmax": 24, "thetamin": 0.5, "thetamax": 0.7, "clay": 2.5, "inputs": {}},   values can be lists (one per point)
+#                 or {"forcing": "path/to/forcing", "clay": 2.5}: tabular forcing saved by CORPSE_forcing.save_forcing, instead of the cosine cycle
+#        "times": {"start": 0, "stop": 0.19, "step": 0.00274},       years, as numpy.arange. Or a list of times
+#        "solver": "ode",                                            "ode" (run_models_ODE) or "iterator" (run_models_iterator)
+#        "solver_options": {"method": "odeint", "batch": false},     passed on to the solver
+#        "output": {"pools": ["CO2"], "every": 1}}}}                 pools and records to keep (default all)
+# Whitman_sims.json has the scenarios of Whitman_sims.py in this format.
+
+import logging
+log=logging.getLogger(__name__)
+
+
+# Read a configuration file. The format comes from the file extension (.toml, otherwise JSON)
+def load_config(path):
+    if path.endswith('.toml'):
+        try:
+            import tomllib
+        except ImportError:
+            # Python before 3.11
+            import tomli as tomllib
+        with open(path,'rb') as f:
+            return tomllib.load(f)
+    import json
+    with open(path) as f:
+        return json.load(f)
+
+# Save scenarios as a JSON configuration file. Numpy arrays and numbers are converted to lists and floats
+def write_config(path,scenarios,defaults=None):
+    import json
+    config={'scenarios':scenarios}
+    if defaults is not None:
+        config={'defaults':defaults,'scenarios':scenarios}
+    with open(path,'w') as f:
+        json.dump(jsonable(config),f,indent=1)
+
+# Convert numpy values in nested dictionaries and lists to plain Python values that json can write
+def jsonable(val):
+    from numpy import ndarray,generic
+    if isinstance(val,dict):
+        return dict([(k,jsonable(v)) for k,v in val.items()])
+    if isinstance(val,(list,tuple)):
+        return [jsonable(v) for v in val]
+    if isinstance(val,ndarray):
+        return val.tolist()
+    if isinstance(val,generic):
+        return val.item()
+    return val
+
+# Recursively merge override into a copy of base
+def merge(base,override):
+    import copy
+    merged=copy.deepcopy(base)
+    for k,v in override.items():
+        if isinstance(v,dict) and isinstance(merged.get(k),dict):
+            merged[k]=merge(merged[k],v)
+        else:
+            merged[k]=copy.deepcopy(v)
+    return merged
+
+# The scenarios of a configuration, with the defaults merged in, in the order of the file
+def get_scenarios(config):
+    defaults=config.get('defaults',{})
+    return dict([(name,merge(defaults,scenario)) for name,scenario in config['scenarios'].items()])
+
+# Output times from a list, or a dictionary with start, stop and step (years, as numpy.arange)
+def make_times(spec):
+    from numpy import arange,asarray
+    if isinstance(spec,dict):
+        return arange(spec.get('start',0.0),spec['stop'],spec['step'])
+    return asarray(spec,dtype=float)
+
+# Convert the lists of a parameter dictionary from a config file to arrays, so parameters with one value per
+# ensemble member work as in CORPSE_ensemble
+def make_params(params):
+    from numpy import asarray
+    if isinstance(params,dict):
+        return dict([(k,make_params(v)) for k,v in params.items()])
+    if isinstance(params,list):
+        return asarray(params,dtype=float)
+    return params
+
+# Run one scenario and write its output to directory out
+# fmt='npy' streams each pool to a .npy file (n_points, n_records) with CORPSE_output.NpyOutputSink.
+# fmt='csv' writes one CSV file per point, with a time column and one column per pool
+# checkpoint: minimum time (s) between checkpoints of the run, saved in out/checkpoint (ODE solver only, see CORPSE_checkpoint).
+#   Running the scenario again with the same output directory then continues from the latest checkpoint. If the scenario
+#   was changed in between, the run fails instead (remove out/checkpoint to start it again)
+# Returns the run stats
+def run_scenario(name,scenario,out,fmt='npy',plot=False,profile=False,checkpoint=None):
+    import os
+    import CORPSE_solvers
+    import CORPSE_output
+
+    times=make_times(scenario['times'])
+    envir=scenario['envir']
+    output=scenario.get('output',{})
+    os.makedirs(out,exist_ok=True)
+    if fmt=='npy':
+        sink=CORPSE_output.NpyOutputSink(out,pools=output.get('pools'),every=output.get('every',1))
+    elif fmt=='csv':
+        sink=CORPSE_output.OutputSink(pools=output.get('pools'),every=output.get('every',1))
+    else:
+        raise ValueError('Unknown output format: %s'%fmt)
+
+    solver=scenario.get('solver','ode')
+    if solver=='ode':
+        run=CORPSE_solvers.run_models_ODE
+    elif solver=='iterator':
+        run=CORPSE_solvers.run_models_iterator
+    else:
+        raise ValueError('Unknown solver: %s'%solver)
+
+    options=dict(scenario.get('solver_options',{}))
+    if checkpoint is not None:
+        if solver!='ode':
+            raise ValueError('Checkpoints are only supported by the ode solver')
+        options.update(checkpoint=os.path.join(out,'checkpoint'),checkpoint_interval=checkpoint)
+
+    forcing=None
+    if envir.get('forcing') is not None:
+        import CORPSE_forcing
+        forcing=CORPSE_forcing.load_forcing(envir['forcing'])
+
+    log.info('Scenario %s',name)
+    SOM,stats=run(Tmin=envir.get('Tmin'),Tmax=envir.get('Tmax'),thetamin=envir.get('thetamin'),thetamax=envir.get('thetamax'),times=times,
+                  inputs=envir.get('inputs',{}),params=make_params(scenario['params']),clay=envir['clay'],initvals=scenario['initvals'],
+                  sink=sink,full_output=True,profile=os.path.join(out,'profile.prof') if profile else False,forcing=forcing,
+                  **options)
+
+    if fmt=='csv':
+        write_csv(SOM,sink.times,out)
+    if plot:
+        # The output is already written, so a plot that fails (e.g. without matplotlib) doesn't fail the scenario
+        try:
+            plot_scenario(name,SOM,sink.times,os.path.join(out,'plot.png'))
+        except Exception as err:
+            log.warning('Scenario %s: no plot (%s: %s)',name,type(err).__name__,err)
+
+    import json
+    stats=dict([(k,v) for k,v in stats.items() if k not in ('solves','profile')])
+    with open(os.path.join(out,'stats.json'),'w') as f:
+        json.dump(jsonable(stats),f,indent=1)
+    return stats
+
+# Write output (dictionary of pools, each (n_points, n_records)) as one CSV file per point
+def write_csv(SOM,times,out):
+    import os
+    from numpy import column_stack,savetxt
+    pools=list(SOM.keys())
+    for point in range(SOM[pools[0]].shape[0]):
+        savetxt(os.path.join(out,'point_%d.csv'%point),column_stack([times]+[SOM[p][point] for p in pools]),
+                delimiter=',',header=','.join(['time']+pools),comments='')
+
+# Save a plot of the stored pools of every point against time (days), without a display
+def plot_scenario(name,SOM,times,filename):
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot
+    pools=list(SOM.keys())
+    fig,ax=pyplot.subplots(nrows=len(pools),ncols=1,squeeze=False,figsize=(6,2*len(pools)))
+    for n,p in enumerate(pools):
+        ax[n,0].plot(times*365,SOM[p][:].T)
+        ax[n,0].set_ylabel(p)
+    ax[-1,0].set_xlabel('Time (days)')
+    ax[0,0].set_title(name)
+    fig.savefig(filename)
+    pyplot.close(fig)
+
+# Worker for run_config: runs one scenario and returns ('ok', stats) or ('error', message), so one failed scenario doesn't stop the others
+def run_task(task):
+    name,scenario,out,fmt,plot,profile,checkpoint=task
+    try:
+        return ('ok',run_scenario(name,scenario,out,fmt,plot,profile,checkpoint))
+    except Exception as err:
+        log.exception('Scenario %s failed',name)
+        return ('error','%s: %s'%(type(err).__name__,err))
+
+# Run the scenarios of a configuration (all, or those named in select), each into its own subdirectory of out
+# workers>1 runs scenarios in parallel processes. Returns a dictionary of scenario name -> ('ok', stats) or ('error', message)
+def run_config(config,out,select=None,fmt='npy',workers=1,plot=False,profile=False,checkpoint=None):
+    import os
+    scenarios=get_scenarios(config)
+    if select is not None:
+        missing=[name for name in select if name not in scenarios]
+        if len(missing)>0:
+            raise ValueError('Scenarios not in configuration: %s'%missing)
+        scenarios=dict([(name,scenarios[name]) for name in select])
+    tasks=[(name,scenario,os.path.join(out,scenario_dir(name)),fmt,plot,profile,checkpoint) for name,scenario in scenarios.items()]
+    if workers>1 and len(tasks)>1:
+        # A scenario that kills its worker process fails on its own, the others are run again on a new pool
+        import CORPSE_parallel
+        outcomes=CORPSE_parallel.map_tasks(tasks,workers,run_task)
+        outcomes=[(status,val if status=='ok' or isinstance(val,str) else '%s: %s'%(type(val).__name__,val)) for status,val in outcomes]
+    else:
+        outcomes=[run_task(task) for task in tasks]
+    return dict(zip(scenarios.keys(),outcomes))
+
+# Directory name for a scenario: spaces and path separators become underscores
+def scenario_dir(name):
+    import re
+    return re.sub(r'[\s/\\:]+','_',str(name))
+
+def main(argv=None):
+    import argparse
+    parser=argparse.ArgumentParser(description='Run CORPSE scenarios from a JSON or TOML configuration file')
+    parser.add_argument('config',help='Configuration file (.json or .toml)')
+    parser.add_argument('--out',default='CORPSE_output',help='Output directory (one subdirectory per scenario)')
+    parser.add_argument('--scenario',action='append',help='Scenario to run (default all). Can be repeated')
+    parser.add_argument('--format',default='npy',choices=['npy','csv'],help='Output format')
+    parser.add_argument('--workers',type=int,default=1,help='Number of scenarios to run in parallel processes')
+    parser.add_argument('--plot',action='store_true',help='Also save a plot of each scenario (plot.png)')
+    parser.add_argument('--profile',action='store_true',help='Run under cProfile and save profile.prof in each scenario directory')
+    parser.add_argument('--checkpoint',type=float,metavar='SECONDS',help='Save a checkpoint of each run at most every SECONDS. '+
+                        'Running the same command again continues interrupted runs from their checkpoints')
+    parser.add_argument('--list',action='store_true',help='List the scenarios in the configuration and exit')
+    parser.add_argument('--log-level',default='INFO',help='Logging level (DEBUG, INFO, WARNING, ...)')
+    args=parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(),format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    config=load_config(args.config)
+    if args.list:
+        for name in get_scenarios(config):
+            print(name)
+        return 0
+
+    outcomes=run_config(config,args.out,args.scenario,args.format,args.workers,args.plot,args.profile,args.checkpoint)
+    failed=[name for name,(status,value) in outcomes.items() if status=='error']
+    for name in failed:
+        log.error('Scenario %s failed: %s',name,outcomes[name][1])
+    log.info('%d scenarios run, %d failed',len(outcomes),len(failed))
+    return 1 if len(failed)>0 else 0
+
+if __name__=='__main__':
+    import sys
+    sys.exit(main())
@@ -0,0 +1,304 @@
+# Forward sensitivities of CORPSE simulations to the model parameters, and gradient-based calibration
+# run_sensitivities integrates the sensitivity equations dS/dt = J S + df/dp alongside the pools, where J is the analytical
+# Jacobian of the model (CORPSE_array.CORPSE_jacobian_array) and df/dp the analytical partial derivatives of the rates of
+# change with respect to each parameter (param_derivs). One solver run gives the pools and their derivatives with respect to
+# all the parameters, instead of one extra run per parameter for finite differences.
+#
+# The state of each point is stacked with its sensitivities: [pools, dpools/dp1, dpools/dp2, ...]. The Jacobian of the
+# sensitivity equations with respect to the pools is left out of the solver's Jacobian (as in CVODES' simultaneous corrector),
+# so it is block diagonal with the model Jacobian in every block and the solver can use banded storage. This only changes
+# the solver's Newton iterations, not the accuracy of the solution: sensitivities are under the same error control as the pools.
+#
+# Parameters are named by their path in the parameter dictionary, as in CORPSE_ensemble: 'vmaxref.MBC_1.Fast', 'Tmic.MBC_2',
+# 'tProtected'. A partial path stands for all the parameters under it: 'vmaxref' is every microbe and chem type, 'eup.MBC_1'
+# every chem type of MBC_1. Parameters of pools that stay zero (e.g. an empty microbial group) have zero sensitivity.
+#
+# calibrate fits parameters to observations (e.g. CO2 flux of post-fire incubations) with scipy.optimize.least_squares,
+# using the sensitivities for the Jacobian of the residuals.
+
+import CORPSE_array
+import CORPSE_solvers
+import CORPSE_kernel
+import logging
+log=logging.getLogger(__name__)
+
+# Parameters that sensitivities can be calculated for, and whether they are by microbe and chem type, by microbe, by chem type or scalar
+sensitivity_params={'vmaxref':('microbe','chem'),'kC':('microbe','chem'),'eup':('microbe','chem'),'Ea':('chem',),
+                    'protection_rate':('chem',),'minMicrobeC':('microbe',),'Tmic':('microbe',),'et':('microbe',),'tProtected':()}
+
+
+# Full dot-separated paths of the parameters in names, with partial paths expanded (see above)
+def expand_names(names):
+    import CORPSE_ensemble
+    if isinstance(names,str):
+        names=[names]
+    expanded=[]
+    for name in names:
+        path=CORPSE_ensemble.param_path(name)
+        if path[0] not in sensitivity_params:
+            raise ValueError('Sensitivities to %s are not supported. Supported parameters: %s'%(path[0],list(sensitivity_params)))
+        dims=sensitivity_params[path[0]]
+        if len(path)>len(dims)+1:
+            raise ValueError('Parameter %s has too many parts'%'.'.join(path))
+        for label,dim in zip(path[1:],dims):
+            if label not in (CORPSE_array.microbial_pools if dim=='microbe' else CORPSE_array.chem_types):
+                raise ValueError('Parameter %s: %s is not a %s'%('.'.join(path),label,'microbial pool' if dim=='microbe' else 'chem type'))
+        paths=[path]
+        for n in range(len(path)-1,len(dims)):
+            labels=CORPSE_array.microbial_pools if dims[n]=='microbe' else CORPSE_array.chem_types
+            paths=[p+(label,) for p in paths for label in labels]
+        expanded+=['.'.join(p) for p in paths]
+    return expanded
+
+# Position of a parameter in a compiled model: (key, index of the microbe and/or chem type), or None if the model was pruned
+# without that microbe or chem type
+def param_index(model,name):
+    path=name.split('.')
+    index=[]
+    for label,dim in zip(path[1:],sensitivity_params[path[0]]):
+        labels=model['microbial_pools'] if dim=='microbe' else model['chem_types']
+        if label not in labels:
+            return None
+        index.append(labels.index(label))
+    return (path[0],tuple(index))
+
+# Partial derivatives of the rates of change (CORPSE_array.CORPSE_deriv_array) with respect to parameters
+# SOM: packed state (n_pools, n_points). index: list of param_index results
+# Returns array of shape (n_params, n_pools, n_points)
+def param_derivs(SOM,T,theta,model,index,claymod=1.0):
+    from numpy import asarray,atleast_1d,clip,exp,where,errstate,zeros,arange,broadcast_shapes
+    SOM=asarray(SOM,dtype=float)
+    nc=model['nchem']; nm=model['nmic']; npr=model['nprot']
+    uC=SOM[:nc]
+    pC=SOM[nc:nc+npr]
+    MBC=SOM[nc+npr:nc+npr+nm]
+    ib=nc+npr; ico2=nc+npr+nm
+    theta=clip(atleast_1d(theta),0.0,1.0)
+    T=atleast_1d(T)
+    totalU=uC.sum(axis=0)
+    totalMBC=MBC.sum(axis=0)
+
+    # Decomposition D[m,c]=vmaxref*Tfac*moisture*u*B/den, and dD/dvmaxref (the same without vmaxref)
+    Tfac=exp(-model['Ea']*(1.0/(CORPSE_array.Rugas*T)-1.0/(CORPSE_array.Rugas*CORPSE_array.Tref)))
+    moisture=theta**model['substrate_diffusion_exp']*(1.0-theta)**model['gas_diffusion_exp']/model['aerobic_max']
+    den=totalU*model['kC']+totalMBC
+    valid=((totalU!=0.0)&(theta!=0.0)&(MBC!=0.0))[:,None,:]
+    with errstate(divide='ignore',invalid='ignore'):
+        D_v=where(valid,Tfac*moisture*uC*MBC[:,None,:]/den,0.0)
+    D=model['vmaxref']*D_v
+    eup=model['eup']
+    # Microbial turnover tau[m]=(B-minMicrobeC*U)/Tmic where it is positive
+    active=(MBC>0)&(MBC-model['minMicrobeC']*totalU>0)
+    tau=where(active,(MBC-model['minMicrobeC']*totalU)/model['Tmic'],0.0)
+    claymod=asarray(claymod,dtype=float)
+    protected=arange(nc)[model['prot']]
+
+    npts=broadcast_shapes(D.shape[-1:],tau.shape[-1:],SOM.shape[-1:],claymod.shape[-1:] if claymod.ndim>0 else (1,))[0]
+    out=zeros((len(index),len(model['pools']),npts))
+    for k,param in enumerate(index):
+        if param is None:
+            continue
+        key,idx=param
+        if key in ('vmaxref','kC','Ea'):
+            # Derivative of D, distributed to the pools like decomposition is
+            if key=='vmaxref':
+                m,c=idx
+                dD=D_v[m,c]
+            elif key=='kC':
+                m,c=idx
+                with errstate(divide='ignore',invalid='ignore'):
+                    dD=where(valid[m,0],-D[m,c]*totalU/den[m,c],0.0)
+            else:
+                c,=idx
+                dD=-D[:,c]*(1.0/(CORPSE_array.Rugas*T)-1.0/(CORPSE_array.Rugas*CORPSE_array.Tref))
+            if key=='Ea':
+                out[k,c]-=dD.sum(axis=0)
+                out[k,ib:ib+nm]+=eup[:,c]*dD
+                out[k,ico2]+=((1.0-eup[:,c])*dD).sum(axis=0)
+            else:
+                out[k,c]-=dD
+                out[k,ib+m]+=eup[m,c]*dD
+                out[k,ico2]+=(1.0-eup[m,c])*dD
+        elif key=='eup':
+            m,c=idx
+            out[k,ib+m]+=D[m,c]
+            out[k,ico2]-=D[m,c]
+        elif key in ('Tmic','minMicrobeC'):
+            m,=idx
+            if key=='Tmic':
+                dtau=-tau[m]/model['Tmic'][m]
+            else:
+                dtau=where(active[m],-totalU/model['Tmic'][m],0.0)
+            out[k,ib+m]-=dtau
+            out[k,model['necro']]+=model['et'][m]*dtau
+            out[k,ico2]+=(1.0-model['et'][m])*dtau
+        elif key=='et':
+            m,=idx
+            out[k,model['necro']]+=tau[m]
+            out[k,ico2]-=tau[m]
+        elif key=='protection_rate':
+            c,=idx
+            out[k,c]-=uC[c]*claymod
+            if c in protected:
+                out[k,nc+list(protected).index(c)]+=uC[c]*claymod
+        elif key=='tProtected':
+            dturn=pC/model['tProtected']**2
+            out[k,protected]-=dturn
+            out[k,nc:nc+npr]+=dturn
+    return out
+
+# Temperature (K) and moisture at time: the sinusoidal cycle of ode_wrapper from (Tmax, Tmin, thetamax, thetamin), or (forcing,)
+def conditions(time,envir):
+    from numpy import cos,pi
+    if len(envir)==1:
+        T,theta=envir[0](time)
+        return T+273.15,theta
+    Tmax,Tmin,thetamax,thetamin=envir
+    T=(cos(time*2*pi)+1)*(Tmax-Tmin)/2+Tmin
+    theta=(cos(time*2*pi)+1)*(thetamax-thetamin)/2+thetamin
+    return T,theta
+
+# Rates of change of the stacked state [pools, sensitivities] of all points, for the ODE solver
+def sensitivity_wrapper(Y,time,envir,inputs,claymod,model,index):
+    from numpy import einsum,empty
+    T,theta=conditions(time,envir)
+    npools=len(model['pools'])
+    Y=Y.reshape(-1,1+len(index),npools)
+    SOM=Y[:,0,:].T
+    J=CORPSE_kernel.jacobian(SOM,T,theta,model,claymod=claymod)
+    if J.ndim==2:
+        J=J[:,:,None]
+    out=empty(Y.shape)
+    out[:,0,:]=(CORPSE_kernel.deriv(SOM,T,theta,model,claymod=claymod)+inputs[:,None]).T
+    out[:,1:,:]=einsum('ijp,pkj->pki',J,Y[:,1:,:])+param_derivs(SOM,T,theta,model,index,claymod).transpose(2,0,1)
+    return out.ravel()
+
+# Solver Jacobian of the stacked state: the model Jacobian of each point, repeated for its sensitivities (see above)
+def sensitivity_jacobian(Y,time,envir,inputs,claymod,model,index,form='banded'):
+    from numpy import repeat
+    T,theta=conditions(time,envir)
+    npools=len(model['pools'])
+    SOM=Y.reshape(-1,1+len(index),npools)[:,0,:].T
+    J=CORPSE_kernel.jacobian(SOM,T,theta,model,claymod=claymod)
+    if J.ndim==2:
+        J=J[:,:,None]
+    return CORPSE_solvers.block_jacobian(repeat(J.transpose(2,0,1),1+len(index),axis=0),form)
+
+# Run a simulation with the sensitivities of all pools to parameters
+# Arguments are as in CORPSE_solvers.run_models_ODE (all points are integrated together, as in its batch mode).
+# parameters: names of the parameters (see above). method: 'odeint' (default) or a solve_ivp method
+# Returns (results, sensitivities): the CORPSE_results.Results of the simulation, and a dictionary of parameter name ->
+# Results with the derivatives of every pool with respect to that parameter. Sensitivities are Results too, so their
+# diagnostics are the derivatives of the diagnostics: sensitivities['vmaxref.MBC_1.Fast'].flux('CO2') is d(CO2 flux)/d(vmaxref)
+# full_output=True also returns the solver stats (CORPSE_instrument)
+def run_sensitivities(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals,parameters,method='odeint',rtol=None,atol=None,
+                      forcing=None,prune=True,full_output=False):
+    from numpy import array,zeros
+    import CORPSE_instrument,CORPSE_results
+    names=expand_names(parameters)
+    model=CORPSE_array.get_model(params)
+    npoints,Tmax,Tmin,thetamax,thetamin,clay=CORPSE_solvers.point_envir(Tmin,Tmax,thetamin,thetamax,clay,forcing)
+    CORPSE_array.check_ensemble(model,npoints)
+    input_vals=CORPSE_array.pack_inputs(inputs,model['pools'])
+    full_pools=model['pools']
+    initial=array([CORPSE_solvers.get_initvals(initvals,point) for point in range(npoints)])
+    keep=list(range(len(full_pools)))
+    if prune:
+        # A protected pool that is pruned because its protection_rate is zero still has a sensitivity to that rate
+        live=zeros(len(full_pools))
+        for name in names:
+            if name.startswith('protection_rate.'):
+                live[full_pools.index('p'+name.split('.')[1]+'C')]=1.0
+        model,keep=CORPSE_solvers.prune_pools(model,initial,input_vals,live)
+        initial=initial[:,keep]
+        input_vals=input_vals[keep]
+    index=[param_index(model,name) for name in names]
+    npools=len(keep)
+
+    Y0=zeros((npoints,1+len(names),npools))
+    Y0[:,0,:]=initial
+    envir=(Tmax,Tmin,thetamax,thetamin) if forcing is None else (forcing,)
+    if method in ('odeint','LSODA'):
+        form,band='banded',npools-1
+    else:
+        form,band='sparse',None
+    stats=CORPSE_instrument.new_stats()
+    Y=CORPSE_solvers.integrate_ODE(sensitivity_wrapper,lambda Y,t,*args: sensitivity_jacobian(Y,t,*args,form=form),Y0.ravel(),times,
+                                   args=(envir,input_vals,CORPSE_array.clay_modifier(clay),model,index),
+                                   method=method,rtol=rtol,atol=atol,band=band,stats=stats)
+    log.debug('Sensitivities to %d parameters: %s',len(names),CORPSE_instrument.format_stats(stats))
+    Y=Y.reshape(len(times),npoints,1+len(names),npools)
+
+    values=zeros((len(full_pools),npoints,len(times)))
+    values[keep]=Y[:,:,0,:].transpose(2,1,0)
+    sens=zeros((len(names),len(full_pools),npoints,len(times)))
+    sens[:,keep]=Y[:,:,1:,:].transpose(2,3,1,0)
+    results=CORPSE_results.Results(values,CORPSE_solvers.fields,times)
+    sensitivities=dict([(name,CORPSE_results.Results(sens[k],CORPSE_solvers.fields,times)) for k,name in enumerate(names)])
+    if full_output:
+        return results,sensitivities,CORPSE_instrument.summarize([stats])
+    return results,sensitivities
+
+# The simulated quantity that is compared with observations: the flux of a pool (per year, as Results.flux; e.g. CO2 respiration)
+# or its amount, shape (n_points, n_times)
+def observable(results,pool='CO2',flux=True):
+    if flux:
+        return results.flux(pool)
+    return results[pool]
+
+# Fit parameters to observations with scipy.optimize.least_squares, with the Jacobian of the residuals from run_sensitivities
+# observed: array (n_points, n_times) of the observable (see observable) at the simulation times, NaN where there is no observation.
+#   The first record of a flux is not defined and is always left out
+# parameters: names of the parameters to fit (see above). params: parameter dictionary with their starting values (not changed)
+# run_kwargs: the other arguments of run_sensitivities (Tmin, Tmax, thetamin, thetamax, times, inputs, clay, initvals, ...)
+# sigma: uncertainty of the observations (a number, or an array like observed); residuals are (simulated-observed)/sigma
+# log_scale=True fits the logarithm of the parameters, which keeps them positive and evens out their scales.
+# bounds: optional (low, high) arrays of parameter values. Other options are passed to least_squares
+# Returns a dictionary with the fitted parameter dictionary ('params'), the fitted values by name ('values'), the number
+# of simulations run ('runs') and the least_squares result ('result')
+def calibrate(observed,parameters,params,run_kwargs,pool='CO2',flux=True,sigma=1.0,log_scale=True,bounds=None,**options):
+    import copy
+    from numpy import asarray,isnan,array,exp,inf,array_equal,maximum,errstate
+    from numpy import log as ln
+    from scipy.optimize import least_squares
+    import CORPSE_ensemble
+    names=expand_names(parameters)
+    observed=asarray(observed,dtype=float)
+    use=~isnan(observed)
+    if flux:
+        use[:,0]=False
+    sigma=asarray(sigma,dtype=float)+0*observed
+
+    def params_at(x):
+        fitted=copy.deepcopy(params)
+        vals=exp(x) if log_scale else x
+        for name,val in zip(names,vals):
+            CORPSE_ensemble.set_param(fitted,name,float(val))
+        return fitted
+
+    # One simulation gives both the residuals and their Jacobian. least_squares asks for them separately, so the last one is kept
+    last={}
+    def evaluate(x):
+        if 'x' in last and array_equal(last['x'],x):
+            return last
+        results,sens=run_sensitivities(params=params_at(x),parameters=names,**run_kwargs)
+        residuals=((observable(results,pool,flux)-observed)/sigma)[use]
+        jac=array([(observable(sens[name],pool,flux)/sigma)[use] for name in names]).T
+        if log_scale:
+            jac=jac*exp(x)
+        last.update(x=x.copy(),residuals=residuals,jac=jac,runs=last.get('runs',0)+1)
+        log.debug('Calibration run %d: cost %g',last['runs'],0.5*(residuals**2).sum())
+        return last
+
+    x0=array([float(CORPSE_ensemble.get_param(params,name)) for name in names])
+    if bounds is None:
+        bounds=(-inf,inf)
+    bounds=[asarray(b,dtype=float)+0*x0 for b in bounds]
+    if log_scale:
+        x0=ln(x0)
+        with errstate(divide='ignore'):
+            bounds=[ln(maximum(b,0.0)) for b in bounds]
+    fit=least_squares(lambda x: evaluate(x)['residuals'],x0,jac=lambda x: evaluate(x)['jac'],bounds=bounds,**options)
+    values=exp(fit.x) if log_scale else fit.x
+    log.info('Calibration of %d parameters: cost %g after %d simulations (%s)',len(names),fit.cost,last['runs'],fit.message)
+    return {'params':params_at(fit.x),'values':dict(zip(names,values)),'runs':last['runs'],'result':fit}
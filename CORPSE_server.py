@@ -0,0 +1,432 @@
+# Local simulation service that runs many small simulation requests together
+# Notebooks and dashboards that each call run_models_ODE for a single site pay the setup and per-point solver overhead every time.
+# The server takes simulation requests from any number of clients, collects the requests that arrive within a short window,
+# and runs requests with the same parameters, times, inputs and solver options as one batch (one point per site, see
+# run_models_ODE batch mode) on a pool of worker processes. Each request carries a hash of its parameters, so the workers
+# compile each parameter set once and keep the compiled model for later batches (see worker_model).
+# Results are returned by job ID.
+#
+#   python CORPSE_server.py --socket /tmp/corpse.sock --workers 4      or --port 8765 (localhost only)
+#
+#   client=CORPSE_server.Client('/tmp/corpse.sock')                     or Client(port=8765)
+#   results=client.run({'initvals':..., 'params':..., 'envir':..., 'times':...})    a CORPSE_results.Results
+#   job=client.submit(simulation); ...; results=client.result(job)
+#   client.metrics()                                                    queue depth, batch sizes and latencies
+#
+# A simulation request has the layout of a scenario in a CORPSE_run configuration file (initvals, params, envir, times,
+# solver_options), with envir values that can be lists for several sites. Tabular forcing files are not supported.
+# The protocol is one JSON object per line in each direction, over a Unix socket or TCP on localhost:
+#   {"op": "submit", "simulation": {...}}                   -> {"ok": true, "job": "..."}
+#   {"op": "result", "job": "...", "wait": true}            -> {"ok": true, "status": "done", "pools": [...], "times": [...], "values": [...]}
+#   {"op": "run", "simulation": {...}}                      submit and wait for the result
+#   {"op": "status", "job": "..."}, {"op": "metrics"}
+# Errors come back as {"ok": false, "error": "..."}. Results are removed from the server once they have been returned, or when
+# they expire: after result_ttl seconds, or when more than history finished jobs are waiting (e.g. of clients that disconnected).
+# If a worker process dies (e.g. killed for running out of memory), the jobs of its batch fail and the worker pool is replaced.
+
+import logging
+log=logging.getLogger(__name__)
+
+# Solver options that the server sets itself
+server_options=['batch','output','sink','full_output','cache','checkpoint','profile','trace_memory']
+
+
+# A simulation request converted to what the workers need: initial values (n_points, n_pools), the environmental
+# vectors of its points (CORPSE_parallel.pack_envir), and the settings it shares with the other requests of a batch
+# Returns (key, job) where key is a hash of the shared settings: requests with the same key are run together.
+# The shared settings also have model_key, a hash of the parameters alone, which the workers keep their compiled models by
+def pack_request(simulation):
+    import hashlib
+    from numpy import array
+    import CORPSE_run,CORPSE_parallel,CORPSE_solvers,CORPSE_cache
+    unknown=[k for k in simulation if k not in ('initvals','params','envir','times','solver_options')]
+    if len(unknown)>0:
+        raise ValueError('Unknown simulation settings: %s'%unknown)
+    envir=simulation['envir']
+    if envir.get('forcing') is not None:
+        raise ValueError('The simulation server does not support tabular forcing')
+    options=dict(simulation.get('solver_options',{}))
+    not_allowed=[k for k in options if k in server_options]
+    if len(not_allowed)>0:
+        raise ValueError('Solver options set by the server: %s'%not_allowed)
+    envir=CORPSE_parallel.pack_envir(envir)
+    ivals=array([CORPSE_solvers.get_initvals(simulation['initvals'],point) for point in range(len(envir['clay']))])
+    shared={'params':CORPSE_run.make_params(simulation['params']),'times':CORPSE_run.make_times(simulation['times']),
+            'inputs':envir.pop('inputs'),'solver_options':options}
+    h=hashlib.blake2b(digest_size=16)
+    CORPSE_cache.update_hash(h,shared)
+    model_hash=hashlib.blake2b(digest_size=16)
+    CORPSE_cache.update_hash(model_hash,shared['params'])
+    shared['model_key']=model_hash.hexdigest()
+    return h.hexdigest(),{'ivals':ivals,'envir':envir,'shared':shared}
+
+# Compiled models of this (worker) process by model_key, most recently used last. The parameters of every batch arrive as
+# a new unpickled dictionary, so CORPSE_array.get_model, which keeps compiled models by dictionary, would compile them again
+worker_models={}
+max_worker_models=32
+
+# Compiled model for the parameters of a batch, compiling them only the first time this process sees model_key
+def worker_model(model_key,params):
+    import CORPSE_array
+    model=worker_models.pop(model_key,None)
+    if model is None:
+        model=CORPSE_array.compile_params(params)
+    if len(worker_models)>=max_worker_models:
+        worker_models.pop(next(iter(worker_models)))
+    worker_models[model_key]=model
+    return model
+
+# Worker function: run the jobs of one batch as one vectorized simulation, with their points stacked
+# Returns ('ok', a list with the result array (n_pools, n_points, n_times) of each job) or ('error', message)
+def run_batch(jobs):
+    from numpy import concatenate,cumsum
+    import CORPSE_solvers
+    try:
+        shared=jobs[0]['shared']
+        envir=dict([(k,concatenate([j['envir'][k] for j in jobs])) for k in ('Tmin','Tmax','thetamin','thetamax','clay')])
+        result=CORPSE_solvers.run_models_ODE(Tmin=envir['Tmin'],Tmax=envir['Tmax'],thetamin=envir['thetamin'],thetamax=envir['thetamax'],
+                                             times=shared['times'],inputs=shared['inputs'],params=worker_model(shared['model_key'],shared['params']),
+                                             clay=envir['clay'],
+                                             initvals=concatenate([j['ivals'] for j in jobs]),batch=True,output='array',
+                                             **shared['solver_options'])
+    except Exception as err:
+        log.exception('Batch of %d jobs failed',len(jobs))
+        return ('error','%s: %s'%(type(err).__name__,err))
+    ends=cumsum([len(j['ivals']) for j in jobs])
+    return ('ok',[result[:,end-len(j['ivals']):end] for j,end in zip(jobs,ends)])
+
+
+class SimulationServer:
+    '''Collects simulation requests and runs them in batches.
+       window: time (s) to wait for more requests after the first one arrives, before running a batch
+       max_points: largest number of points (sites) in one batch
+       workers: number of worker processes. 0 runs batches in a thread of the server process (for debugging)
+       history: number of recent jobs and batches kept for the metrics, and largest number of finished jobs whose results are kept
+       result_ttl: time (s) that the result of a finished job is kept for a client to fetch it'''
+
+    def __init__(self,window=0.05,max_points=10000,workers=1,history=1000,result_ttl=3600.0):
+        from collections import deque,OrderedDict
+        self.window=window
+        self.max_points=max_points
+        self.workers=workers
+        self.history=history
+        self.result_ttl=result_ttl
+        self.jobs={}
+        self.pending=[]
+        self.running=0
+        # IDs of finished jobs whose results haven't been fetched, in the order they finished, for expiring them
+        self.finished=OrderedDict()
+        self.counts={'submitted':0,'done':0,'failed':0,'batches':0,'expired':0,'worker_restarts':0}
+        self.latency=deque(maxlen=history)
+        self.queue_wait=deque(maxlen=history)
+        self.batch_jobs=deque(maxlen=history)
+        self.batch_time=deque(maxlen=history)
+        self.next_id=0
+        self.executor=None
+        self.server=None
+
+    # Start listening on a Unix socket (path) or on TCP port of host, and start the batching loop
+    async def start(self,path=None,host='127.0.0.1',port=0):
+        import asyncio
+        from time import perf_counter
+        if self.workers>0:
+            self.executor=self.new_executor()
+        self.started=perf_counter()
+        self.wakeup=asyncio.Event()
+        self.batcher=asyncio.ensure_future(self.batch_loop())
+        # Results can be long lines
+        if path is not None:
+            self.server=await asyncio.start_unix_server(self.handle,path=path,limit=2**30)
+            log.info('Simulation server listening on %s',path)
+        else:
+            self.server=await asyncio.start_server(self.handle,host=host,port=port,limit=2**30)
+            log.info('Simulation server listening on %s:%d',host,self.port())
+        return self
+
+    # Pool of worker processes that run the batches (also used to replace a pool whose worker died)
+    def new_executor(self):
+        from concurrent.futures import ProcessPoolExecutor
+        return ProcessPoolExecutor(max_workers=self.workers)
+
+    # TCP port the server listens on (useful with port=0, which picks a free port)
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.batcher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    # Queue a simulation request. Returns its job ID
+    def submit(self,simulation):
+        import asyncio
+        from time import perf_counter
+        self.expire()
+        key,job=pack_request(simulation)
+        self.next_id+=1
+        job_id='%d'%self.next_id
+        job.update(id=job_id,key=key,status='queued',submitted=perf_counter(),done=asyncio.Event())
+        self.jobs[job_id]=job
+        self.pending.append(job)
+        self.counts['submitted']+=1
+        self.wakeup.set()
+        return job_id
+
+    # Wait for a job to finish and return it (removed from the server)
+    async def result(self,job_id,wait=True):
+        job=self.get_job(job_id)
+        if wait:
+            await job['done'].wait()
+        if job['status'] in ('done','failed'):
+            # (a job can expire while its client waits for it, if many others finish at the same time)
+            self.jobs.pop(job_id,None)
+            self.finished.pop(job_id,None)
+        return job
+
+    def get_job(self,job_id):
+        if job_id not in self.jobs:
+            raise KeyError('No job %s (or its result has expired)'%job_id)
+        return self.jobs[job_id]
+
+    # Remove the results of finished jobs that were not fetched within result_ttl, and the oldest ones beyond history
+    def expire(self):
+        from time import perf_counter
+        now=perf_counter()
+        while len(self.finished)>0:
+            job_id=next(iter(self.finished))
+            if len(self.finished)<=self.history and now-self.jobs[job_id]['finished']<self.result_ttl:
+                break
+            del self.finished[job_id]
+            del self.jobs[job_id]
+            self.counts['expired']+=1
+            log.debug('Result of job %s expired',job_id)
+
+    # Queue depth, throughput and latency statistics
+    def metrics(self):
+        from time import perf_counter
+        from numpy import percentile,mean
+        self.expire()
+        def summary(values):
+            if len(values)==0:
+                return None
+            return {'mean':float(mean(values)),'p50':float(percentile(values,50)),'p95':float(percentile(values,95)),'max':float(max(values))}
+        return dict(self.counts,queued=len(self.pending),queued_points=sum([len(j['ivals']) for j in self.pending]),running=self.running,
+                    waiting_results=len(self.finished),
+                    uptime=perf_counter()-self.started,batch_jobs=summary(self.batch_jobs),batch_time=summary(self.batch_time),
+                    queue_wait=summary(self.queue_wait),latency=summary(self.latency))
+
+    # Wait for requests, give more of them the window to arrive, then run the pending jobs as batches
+    async def batch_loop(self):
+        import asyncio
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.window)
+            self.wakeup.clear()
+            jobs,self.pending=self.pending,[]
+            for batch in make_batches(jobs,self.max_points):
+                asyncio.ensure_future(self.run(batch))
+
+    # Run one batch on the worker pool and hand the results to its jobs
+    async def run(self,batch):
+        import asyncio
+        from time import perf_counter
+        from concurrent.futures.process import BrokenProcessPool
+        t0=perf_counter()
+        for job in batch:
+            job['status']='running'
+            if 'started' not in job:
+                job['started']=t0
+                self.queue_wait.append(t0-job['submitted'])
+        self.running+=len(batch)
+        packed=[dict([(k,job[k]) for k in ('ivals','envir','shared')]) for job in batch]
+        executor=self.executor
+        crashed=False
+        try:
+            status,value=await asyncio.get_running_loop().run_in_executor(executor,run_batch,packed)
+        except BrokenProcessPool as err:
+            # A worker process died. The pool can't run anything after that, so it is replaced (once, even if several
+            # batches were running on it), and only the jobs of the batches that were on it fail
+            status,value='error','Worker process died while running the batch (%s)'%err
+            crashed=True
+            if self.executor is executor:
+                log.error('Worker process died, starting a new worker pool')
+                executor.shutdown(wait=False)
+                self.executor=self.new_executor()
+                self.counts['worker_restarts']+=1
+        except Exception as err:
+            status,value='error','%s: %s'%(type(err).__name__,err)
+        self.running-=len(batch)
+        # One bad request (e.g. invalid initial values) shouldn't fail the others: run the jobs of a failed batch one by one
+        # (not after a crash, which a job that e.g. runs out of memory would only repeat)
+        if status=='error' and len(batch)>1 and not crashed:
+            log.warning('Batch of %d jobs failed (%s), running them separately',len(batch),value)
+            for job in batch:
+                job['status']='queued'
+                asyncio.ensure_future(self.run([job]))
+            return
+        t1=perf_counter()
+        self.counts['batches']+=1
+        self.batch_jobs.append(len(batch))
+        self.batch_time.append(t1-t0)
+        log.debug('Batch of %d jobs (%d points) in %1.3f s',len(batch),sum([len(j['ivals']) for j in batch]),t1-t0)
+        for n,job in enumerate(batch):
+            if status=='ok':
+                job.update(status='done',result=value[n])
+                self.counts['done']+=1
+            else:
+                job.update(status='failed',error=value)
+                self.counts['failed']+=1
+            self.latency.append(t1-job['submitted'])
+            job['finished']=t1
+            self.finished[job['id']]=None
+            job['done'].set()
+        self.expire()
+
+    # One client connection: answer each request line with one response line
+    async def handle(self,reader,writer):
+        import json
+        while True:
+            line=await reader.readline()
+            if not line:
+                break
+            try:
+                response=await self.respond(json.loads(line))
+            except Exception as err:
+                response={'ok':False,'error':'%s: %s'%(type(err).__name__,err)}
+            writer.write(json.dumps(response).encode()+b'\n')
+            await writer.drain()
+        writer.close()
+
+    async def respond(self,request):
+        op=request.get('op')
+        if op=='submit':
+            return {'ok':True,'job':self.submit(request['simulation'])}
+        elif op in ('result','run'):
+            job_id=request['job'] if op=='result' else self.submit(request['simulation'])
+            return job_response(await self.result(job_id,request.get('wait',True)))
+        elif op=='status':
+            return {'ok':True,'job':request['job'],'status':self.get_job(request['job'])['status']}
+        elif op=='metrics':
+            return {'ok':True,'metrics':self.metrics()}
+        raise ValueError('Unknown operation: %s'%op)
+
+
+# Split jobs into batches of jobs with the same settings, with at most max_points points each (a job is never split)
+def make_batches(jobs,max_points):
+    groups={}
+    for job in jobs:
+        groups.setdefault(job['key'],[]).append(job)
+    batches=[]
+    for group in groups.values():
+        batch,points=[],0
+        for job in group:
+            if len(batch)>0 and points+len(job['ivals'])>max_points:
+                batches.append(batch)
+                batch,points=[],0
+            batch.append(job)
+            points+=len(job['ivals'])
+        batches.append(batch)
+    return batches
+
+# Response to a result request: the output of a finished job, or its status
+def job_response(job):
+    import CORPSE_solvers
+    response={'ok':job['status']!='failed','job':job['id'],'status':job['status']}
+    if job['status']=='done':
+        response.update(pools=CORPSE_solvers.fields,times=job['shared']['times'].tolist(),values=job['result'].tolist())
+    elif job['status']=='failed':
+        response['error']=job['error']
+    return response
+
+
+class Client:
+    '''Blocking client for a SimulationServer, on a Unix socket (path) or TCP port on localhost'''
+
+    def __init__(self,path=None,host='127.0.0.1',port=None):
+        import socket
+        if path is not None:
+            self.socket=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            self.socket.connect(path)
+        else:
+            self.socket=socket.create_connection((host,port))
+        self.stream=self.socket.makefile('rwb')
+
+    def request(self,**request):
+        import json
+        self.stream.write(json.dumps(request,default=to_json).encode()+b'\n')
+        self.stream.flush()
+        response=json.loads(self.stream.readline())
+        if not response['ok']:
+            raise RuntimeError('Simulation server: %s'%response['error'])
+        return response
+
+    # Queue a simulation and return its job ID
+    def submit(self,simulation):
+        return self.request(op='submit',simulation=simulation)['job']
+
+    # Result of a job as CORPSE_results.Results. wait=False returns None if the job hasn't finished
+    def result(self,job,wait=True):
+        return results(self.request(op='result',job=job,wait=wait))
+
+    # Submit a simulation and wait for its result
+    def run(self,simulation):
+        return results(self.request(op='run',simulation=simulation))
+
+    def status(self,job):
+        return self.request(op='status',job=job)['status']
+
+    def metrics(self):
+        return self.request(op='metrics')['metrics']
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+# Numpy arrays and numbers in simulation requests, for json
+def to_json(val):
+    import CORPSE_run
+    converted=CORPSE_run.jsonable(val)
+    if converted is val:
+        raise TypeError('Cannot convert %s to JSON'%type(val).__name__)
+    return converted
+
+def results(response):
+    import CORPSE_results
+    if response['status']!='done':
+        return None
+    return CORPSE_results.Results(response['values'],response['pools'],response['times'])
+
+# Run a server until it is interrupted
+def serve(path=None,host='127.0.0.1',port=8765,**kwargs):
+    import asyncio
+    async def main():
+        server=await SimulationServer(**kwargs).start(path,host,port)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+def main(argv=None):
+    import argparse
+    parser=argparse.ArgumentParser(description='Local CORPSE simulation server that runs concurrent requests in vectorized batches')
+    parser.add_argument('--socket',help='Unix socket to listen on (default TCP on localhost)')
+    parser.add_argument('--port',type=int,default=8765,help='TCP port on localhost, if no socket is given')
+    parser.add_argument('--window',type=float,default=0.05,help='Time (s) to collect requests into a batch')
+    parser.add_argument('--max-points',type=int,default=10000,help='Largest number of sites in one batch')
+    parser.add_argument('--workers',type=int,default=1,help='Number of worker processes')
+    parser.add_argument('--result-ttl',type=float,default=3600.0,help='Time (s) the result of a job is kept for its client to fetch it')
+    parser.add_argument('--log-level',default='INFO',help='Logging level (DEBUG, INFO, WARNING, ...)')
+    args=parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(),format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    try:
+        serve(args.socket,port=args.port,window=args.window,max_points=args.max_points,workers=args.workers,result_ttl=args.result_ttl)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__=='__main__':
+    import sys
+    sys.exit(main())
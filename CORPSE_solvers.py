@@ -1,34 +1,33 @@
 import CORPSE_array as CORPSE_deriv
-import numpy
-fields = CORPSE_deriv.expected_pools
-fields.remove('originalC')
+import CORPSE_instrument
+import CORPSE_kernel
+import logging
+log=logging.getLogger(__name__)
+# Pools integrated by the solvers (originalC is not). This is a new list, so CORPSE_array.expected_pools is left unchanged
+fields = [f for f in CORPSE_deriv.expected_pools if f!='originalC']
 
 # This is a function that translates the CORPSE model pools to/from the format that the equation solver expects
-# The solver will call it multiple times and passes it a list of parameters that needs to be converted to a named "dictionary" that CORPSE expects
+# The solver will call it multiple times and passes it a flat array of pool values in the order of "fields"
+# params can be a parameter dictionary or a compiled model spec (CORPSE_array.compile_params), and inputs can be a dictionary
+# or an already packed vector of input rates. Passing compiled versions avoids rebuilding them on every call
+# SOM_list can also hold several stacked layers (e.g. mineral soil followed by the O horizon), each with all the pools.
+# T, theta and clay can then have one value per layer. The layers are not coupled here; run_models_ODE with layers and transport
+# adds vertical transport between them (see CORPSE_layers)
 def fsolve_wrapper(SOM_list,T,theta,inputs,clay,params):
-    from numpy import atleast_1d,concatenate
+    from numpy import asarray
 
-    # Make an empty dictionary and fill it with the right values
-    # Values are in the correct order because we use the same "fields" list of pools
-    SOM_dict={}
-    for n in range(len(fields)):
-        SOM_dict[fields[n]]=atleast_1d(SOM_list[n])
-        #SOM_dict[fields[n]]=atleast_1d(SOM_list[fields[n]])
+    model=CORPSE_deriv.get_model(params)
+    if isinstance(inputs,dict):
+        inputs=CORPSE_deriv.pack_inputs(inputs,model['pools'])
+    SOM_list=asarray(SOM_list,dtype=float)
+    npools=len(model['pools'])
 
+    if len(SOM_list)>npools:
+        return batch_deriv(SOM_list,T,theta,inputs,CORPSE_deriv.clay_modifier(clay),model)
 
     # Call the CORPSE model function that returns the derivative (with time) of each pool
-    deriv=CORPSE_deriv.CORPSE_deriv(SOM_dict,atleast_1d([T]),atleast_1d([theta]),params,claymod=CORPSE_deriv.prot_clay(clay)/CORPSE_deriv.prot_clay(20))
-
     # Since we have carbon inputs, these also need to be added to those rates of change with time
-    for pool in inputs.keys():
-        deriv[pool]+=inputs[pool]
-
-
-    # Put the CORPSE pools back into a list that the equation solver can deal with
-    vals=list(concatenate([deriv[f] for f in fields]))
-
-    if len(SOM_list)==len(fields)*2:
-        vals=vals+vals_Ohorizon
+    vals=CORPSE_kernel.deriv(SOM_list,T,theta,model,claymod=CORPSE_deriv.clay_modifier(clay))+inputs
 
     return vals
 
@@ -41,59 +40,339 @@ def ode_wrapper(SOM_list,time,Tmax,Tmin,thetamax,thetamin,*args,**kwargs):
     theta=(cos(time*2*pi)+1)*(thetamax-thetamin)/2+thetamin
     return fsolve_wrapper(SOM_list,T,theta,*args,**kwargs)
 
+# Analytical Jacobian versions of fsolve_wrapper and ode_wrapper, with the same arguments so implicit solvers can share them
+# Carbon inputs are constant so they don't enter the Jacobian
+def fsolve_jacobian(SOM_list,T,theta,inputs,clay,params):
+    from numpy import asarray
+    model=CORPSE_deriv.get_model(params)
+    npools=len(model['pools'])
+    if len(SOM_list)>npools:
+        return block_jacobian(batch_jacobian(SOM_list,T,theta,CORPSE_deriv.clay_modifier(clay),model)).toarray()
+    return CORPSE_kernel.jacobian(asarray(SOM_list,dtype=float),T,theta,model,claymod=CORPSE_deriv.clay_modifier(clay))
+
+def ode_jacobian(SOM_list,time,Tmax,Tmin,thetamax,thetamin,*args,**kwargs):
+    from numpy import cos,pi
+    T=(cos(time*2*pi)+1)*(Tmax-Tmin)/2+Tmin
+    theta=(cos(time*2*pi)+1)*(thetamax-thetamin)/2+thetamin
+    return fsolve_jacobian(SOM_list,T,theta,*args,**kwargs)
+
+# Versions of ode_wrapper and ode_jacobian driven by tabular forcing (CORPSE_forcing.Forcing) instead of the cosine cycle
+# point is the index of the point in the forcing records. Forcing temperatures are in C
+def forcing_ode_wrapper(SOM_list,time,forcing,point,*args,**kwargs):
+    T,theta=forcing(time,point)
+    return fsolve_wrapper(SOM_list,T+273.15,theta,*args,**kwargs)
+
+def forcing_ode_jacobian(SOM_list,time,forcing,point,*args,**kwargs):
+    T,theta=forcing(time,point)
+    return fsolve_jacobian(SOM_list,T+273.15,theta,*args,**kwargs)
+
+# Batched versions of ode_wrapper and ode_jacobian. All points are stacked point by point into one state vector
+# (point 0 pools, point 1 pools, ...), so the Jacobian of the whole system is block diagonal.
+# Tmax, Tmin, thetamax, thetamin and claymod (see CORPSE_array.clay_modifier) are vectors with one value per point
+# inputs has one value per pool, or is an array (n_pools, n_points) with inputs for each point
+# transport is optional vertical transport between the points, when they are layers of soil columns (see CORPSE_layers.compile_transport)
+def batch_ode_wrapper(SOM_vector,time,Tmax,Tmin,thetamax,thetamin,inputs,claymod,params,transport=None):
+    from numpy import cos,pi
+    T=(cos(time*2*pi)+1)*(Tmax-Tmin)/2+Tmin
+    theta=(cos(time*2*pi)+1)*(thetamax-thetamin)/2+thetamin
+    return batch_deriv(SOM_vector,T,theta,inputs,claymod,params,transport)
+
+# Returns the diagonal blocks of the batched Jacobian, shape (n_points, n_pools, n_pools)
+# Transport is linear, so its part of the Jacobian is constant and added by block_jacobian
+def batch_ode_jacobian(SOM_vector,time,Tmax,Tmin,thetamax,thetamin,inputs,claymod,params,transport=None):
+    from numpy import cos,pi
+    T=(cos(time*2*pi)+1)*(Tmax-Tmin)/2+Tmin
+    theta=(cos(time*2*pi)+1)*(thetamax-thetamin)/2+thetamin
+    return batch_jacobian(SOM_vector,T,theta,claymod,params)
+
+# Batched versions driven by tabular forcing, with all points in the forcing records
+def forcing_batch_wrapper(SOM_vector,time,forcing,inputs,claymod,params,transport=None):
+    T,theta=forcing(time)
+    return batch_deriv(SOM_vector,T+273.15,theta,inputs,claymod,params,transport)
+
+def forcing_batch_jacobian(SOM_vector,time,forcing,inputs,claymod,params,transport=None):
+    T,theta=forcing(time)
+    return batch_jacobian(SOM_vector,T+273.15,theta,claymod,params)
+
+# Derivative and Jacobian blocks of the stacked system for temperature T (K) and moisture theta at each point
+def batch_deriv(SOM_vector,T,theta,inputs,claymod,params,transport=None):
+    from numpy import asarray
+    model=CORPSE_deriv.get_model(params)
+    SOM=asarray(SOM_vector,dtype=float).reshape(-1,len(model['pools'])).T
+    deriv=CORPSE_kernel.deriv(SOM,T,theta,model,claymod=claymod)+(inputs if inputs.ndim==2 else inputs[:,None])
+    if transport is not None:
+        import CORPSE_layers
+        deriv+=CORPSE_layers.transport_deriv(SOM,transport)
+    return deriv.T.ravel()
+
+def batch_jacobian(SOM_vector,T,theta,claymod,params):
+    from numpy import asarray
+    model=CORPSE_deriv.get_model(params)
+    SOM=asarray(SOM_vector,dtype=float).reshape(-1,len(model['pools'])).T
+    J=CORPSE_kernel.jacobian(SOM,T,theta,model,claymod=claymod)
+    if J.ndim==2:
+        J=J[:,:,None]
+    return J.transpose(2,0,1)
+
+# Assemble diagonal blocks (n_points, n, n) into the full Jacobian of the stacked system
+# form='sparse' gives a scipy.sparse CSC matrix (for solve_ivp BDF/Radau), form='banded' gives LSODA banded storage
+# with bandwidth n-1, where banded[i-j+n-1, j] holds d(deriv_i)/d(pool_j)
+# coupling is the optional (diag, lower, upper) Jacobian of transport between neighbouring points (see CORPSE_layers.transport_jacobian).
+# It couples each pool with the same pool of the previous and next point, so the bandwidth is then n
+def block_jacobian(blocks,form='sparse',coupling=None):
+    from numpy import arange,zeros,broadcast_to
+    npts,n,_=blocks.shape
+    r=arange(n)[:,None]
+    c=arange(n)[None,:]
+    offset=(arange(npts)*n)[:,None,None]
+    band=n-1
+    if coupling is not None:
+        diag,lower,upper=coupling
+        blocks=blocks.copy()
+        blocks[:,arange(n),arange(n)]+=diag.T
+        band=n
+        # Position of each pool of each point in the stacked state, shape (n, n_points)
+        pos=(arange(npts)[None,:]*n+arange(n)[:,None])
+    if form=='banded':
+        banded=zeros((2*band+1,npts*n))
+        banded[broadcast_to(r-c+band,blocks.shape),broadcast_to(offset+c,blocks.shape)]=blocks
+        if coupling is not None:
+            # d(deriv of point k)/d(point k+1) is at row i-j+band = 0, d(deriv of point k)/d(point k-1) at row 2*band
+            banded[0,pos[:,1:]]=upper[:,:-1]
+            banded[2*band,pos[:,:-1]]=lower[:,1:]
+        return banded
+    else:
+        from numpy import concatenate
+        from scipy.sparse import csc_matrix
+        rows=broadcast_to(offset+r,blocks.shape).ravel()
+        cols=broadcast_to(offset+c,blocks.shape).ravel()
+        vals=blocks.ravel()
+        if coupling is not None:
+            rows=concatenate([rows,pos[:,:-1].ravel(),pos[:,1:].ravel()])
+            cols=concatenate([cols,pos[:,1:].ravel(),pos[:,:-1].ravel()])
+            vals=concatenate([vals,upper[:,:-1].ravel(),lower[:,1:].ravel()])
+        return csc_matrix((vals,(rows,cols)),shape=(npts*n,npts*n))
+
+# Integrate one set of initial values over times with the selected solver backend. Returns array of shape (len(times), n_pools)
+# method='odeint' uses scipy.integrate.odeint (LSODA), any other method name (BDF, Radau, LSODA, ...) is passed to scipy.integrate.solve_ivp
+# jac=True supplies the analytical Jacobian; otherwise the solver estimates it by finite differences, using jac_sparsity if it is given.
+#   Only implicit steps use a Jacobian: BDF and Radau whenever they refresh it, where the analytical one replaces a finite difference
+#   estimate (one derivative call per state variable). LSODA (odeint) only uses it after switching to its stiff method, which the
+#   Whitman_sims incubations never do, so there jac makes no difference (Whitman_sims.solver_options runs them with BDF instead)
+# band sets the lower and upper bandwidth of the Jacobian for LSODA (odeint or solve_ivp). jacfun must then return it in banded storage
+# stats is an optional dictionary from CORPSE_instrument.new_stats, which is filled with call counts, timings and solver diagnostics
+def integrate_ODE(fun,jacfun,ivals,times,args,method='odeint',jac=True,jac_sparsity=None,rtol=None,atol=None,band=None,stats=None):
+    from time import perf_counter
+    t0=perf_counter()
+    if stats is not None:
+        fun=CORPSE_instrument.counted(fun,stats,'nfev','time_deriv')
+        jacfun=CORPSE_instrument.counted(jacfun,stats,'njev','time_jac')
+
+    tols={}
+    if rtol is not None:
+        tols['rtol']=rtol
+    if atol is not None:
+        tols['atol']=atol
+
+    if method=='odeint':
+        from scipy.integrate import odeint
+        if band is not None:
+            tols['ml']=tols['mu']=band
+        if stats is None:
+            return odeint(fun,ivals,times,args=args,Dfun=jacfun if jac else None,**tols)
+        result,infodict=odeint(fun,ivals,times,args=args,Dfun=jacfun if jac else None,full_output=True,**tols)
+        CORPSE_instrument.odeint_stats(stats,infodict)
+    else:
+        from scipy.integrate import solve_ivp
+        if band is not None and method=='LSODA':
+            tols['lband']=tols['uband']=band
+        if jac:
+            tols['jac']=lambda t,y: jacfun(y,t,*args)
+        elif jac_sparsity is not None:
+            tols['jac_sparsity']=jac_sparsity
+        if stats is not None:
+            tols['events']=CORPSE_instrument.step_counter(stats)
+        sol=solve_ivp(lambda t,y: fun(y,t,*args),(times[0],times[-1]),ivals,method=method,t_eval=times,**tols)
+        if not sol.success:
+            raise RuntimeError('solve_ivp (%s) failed: %s'%(method,sol.message))
+        result=sol.y.T
+        if stats is not None:
+            CORPSE_instrument.solve_ivp_stats(stats,sol)
+
+    if stats is not None:
+        stats['time_total']=perf_counter()-t0
+        stats['time_solver']=stats['time_total']-stats['time_deriv']-stats['time_jac']
+    return result
+
 # Uses an alternate method: Iterating through time steps but loading all points into a vector for more efficient calculation
 # May run faster for large number of points, but potentially less accurate depending on time step
-def vector_iterate(SOM_init,params,T,theta,inputs,clay,times):
+# sink is an optional output sink from CORPSE_output. Steps are then written to it every chunk_records steps instead of being kept in memory,
+# and sink.result() is returned
+# forcing is optional tabular forcing (CORPSE_forcing.Forcing), interpolated at each step, instead of T (K) and theta arrays.
+# T and theta are then ignored, so forcing records don't have to be expanded to one value per step and point
+# prune=True leaves out pools that stay zero (see run_models_ODE); they are returned as zeros
+# checkpoint and checkpoint_interval work as in run_models_ODE. Checkpoints are taken every chunk_records steps
+def vector_iterate(SOM_init,params,T,theta,inputs,clay,times,sink=None,chunk_records=1000,forcing=None,prune=True,checkpoint=None,checkpoint_interval=60.0):
+    call=dict(locals())
     from numpy import zeros,atleast_1d
     # totaltime and dt in units of years
     nsteps=len(times)
-    if len(T.shape)>1:
+    if forcing is not None:
+        npoints=len(clay)
+    elif len(T.shape)>1:
         npoints=T.shape[1]
     else:
         npoints=len(T)
     nrecords=nsteps
 
-    # Set up pools
-    SOM={}
-    SOM_out={}
+    model=CORPSE_deriv.get_model(params)
+    pools=model['pools']
+    input_vals=CORPSE_deriv.pack_inputs(inputs,pools)[:,None]
+    claymod=CORPSE_deriv.clay_modifier(clay.values,2.5)
+    CORPSE_deriv.check_ensemble(model,npoints)
+
+    # Set up pools. The state is one packed (n_pools, n_points) array
+    SOM_dict={}
     for field in SOM_init.keys():
-        SOM_out[field]=zeros((npoints,nrecords))
-        if len(atleast_1d(SOM_init['uFastC'])) == 1: 
-            SOM[field]=zeros(npoints)+SOM_init[field]
+        if len(atleast_1d(SOM_init['uFastC'])) == 1:
+            SOM_dict[field]=zeros(npoints)+SOM_init[field]
         else:
-            SOM[field]=SOM_init[field].values
+            SOM_dict[field]=SOM_init[field].values
+    SOM=CORPSE_deriv.pack_pools(SOM_dict,pools)+zeros(npoints)
+    full_pools=pools
+    if prune:
+        model,keep=prune_pools(model,SOM.T,input_vals[:,0])
+        pools=model['pools']
+        SOM=SOM[keep]
+        input_vals=input_vals[keep]
+
+    ckpt,saved=None,None
+    if checkpoint is not None:
+        import CORPSE_checkpoint
+        settings={'times':times,'npoints':npoints,'pools':pools,'chunk_records':chunk_records}
+        ckpt=CORPSE_checkpoint.Checkpoint(checkpoint,'vector_iterate',call,checkpoint_interval)
+        saved=ckpt.load(settings)
+
+    if sink is None:
+        state_out=zeros((len(pools),npoints,nrecords))
+    else:
+        sink.open(pools,npoints,times,full_pools=full_pools,resume=saved is not None)
+        state_out=zeros((len(pools),npoints,min(chunk_records,nrecords)))
+
+    first=0
+    if saved is not None:
+        log.info('Resuming from checkpoint at step %d (time %g)',saved['position'],saved['time'])
+        first=saved['position']
+        SOM=saved['state']
+        if sink is None:
+            state_out=saved['output']
+        else:
+            sink.set_state(saved['output'])
 
     # Iterate through simulations
-    for step in range(nsteps):
+    for step in range(first,nsteps):
         if step==nsteps-1:
             dt=times[step]-times[step-1]
         else:
             dt=times[step+1]-times[step]
-        if len(T.shape)>1:
-            T_step=T[step,:]
-        else:
-            T_step=T
-        if len(theta.shape)>1:
-            theta_step=theta[step,:]
+        if forcing is not None:
+            T_step,theta_step=forcing(times[step])
+            T_step=T_step+273.15
         else:
-            theta_step=theta
+            if len(T.shape)>1:
+                T_step=T[step,:]
+            else:
+                T_step=T
+            if len(theta.shape)>1:
+                theta_step=theta[step,:]
+            else:
+                theta_step=theta
         # In this case, T, theta, clay, and all the pools in SOM are vectors containing one value per geographical location
-        deriv=CORPSE_deriv.CORPSE_deriv(SOM,T_step,theta_step,params,claymod=CORPSE_deriv.prot_clay(clay.values)/CORPSE_deriv.prot_clay(2.5))
+        deriv=CORPSE_kernel.deriv(SOM,T_step,theta_step,model,claymod=claymod)
 
         # Since we have carbon inputs, these also need to be added to those rates of change with time
-        for pool in inputs.keys():
-            deriv[pool]+=inputs[pool]
-
-        for field in deriv.keys():
-            SOM[field]=SOM[field]+deriv[field]*dt
+        SOM=SOM+(deriv+input_vals)*dt
 
         if (step*dt)%10==0:
-            print('Time = %d'%(step*dt))
-        for field in SOM.keys():
-            SOM_out[field][:,step]=SOM[field]
+            log.debug('Time = %d',step*dt)
+        if sink is None:
+            state_out[:,:,step]=SOM
+        else:
+            state_out[:,:,step%chunk_records]=SOM
+            if step%chunk_records==chunk_records-1 or step==nsteps-1:
+                sink.write(state_out[:,:,:step%chunk_records+1],step-step%chunk_records)
+        if ckpt is not None and step%chunk_records==chunk_records-1 and step<nsteps-1 and ckpt.due():
+            ckpt.save(settings,step+1,times[step],SOM,state_out if sink is None else sink.get_state(),None)
+
+    if ckpt is not None:
+        ckpt.remove()
+    if sink is not None:
+        sink.close()
+        return sink.result()
+
+    # Pools that are not part of the model (e.g. originalC) stay at their initial values
+    SOM_out={}
+    for field in SOM_init.keys():
+        if field in pools:
+            SOM_out[field]=state_out[pools.index(field)]
+        else:
+            SOM_out[field]=zeros((npoints,nrecords))+SOM_dict[field][:,None]
 
     return SOM_out
 
+# Drop the pools that stay zero for these initial values and inputs (see CORPSE_array.prune_model)
+# ivals: initial values (n_points, n_pools) and input_vals: input rates, in the order of model['pools'] (or (n_pools, n_points))
+# live: optional flags (n_pools,) of pools to keep even if they are zero (e.g. pools that disturbance events move C into)
+# Returns the pruned model and the indices of its pools in model['pools']
+def prune_pools(model,ivals,input_vals,live=None):
+    from numpy import absolute
+    flags=absolute(input_vals).reshape(len(input_vals),-1).max(axis=1)
+    if live is not None:
+        flags=flags+live
+    pruned=CORPSE_deriv.prune_model(model,ivals.T,flags)
+    keep=[model['pools'].index(p) for p in pruned['pools']]
+    if len(keep)<len(model['pools']):
+        log.debug('Pruned pools that stay zero: %s',[p for p in model['pools'] if p not in pruned['pools']])
+    return pruned,keep
+
+# One value of each environmental variable per point, with temperatures converted to K
+# With tabular forcing (CORPSE_forcing.Forcing), Tmin/Tmax/thetamin/thetamax are not used and come back as None.
+# The number of points is set by clay
+def point_envir(Tmin,Tmax,thetamin,thetamax,clay,forcing=None):
+    from numpy import atleast_1d,broadcast_to
+    npoints=len(atleast_1d(clay))
+    clay=broadcast_to(atleast_1d(clay),(npoints,)).astype(float)
+    if forcing is not None:
+        if forcing.npoints not in (1,npoints):
+            raise ValueError('Forcing has %d points but the simulation has %d'%(forcing.npoints,npoints))
+        return npoints,None,None,None,None,clay
+    Tmax,Tmin,thetamax,thetamin=[broadcast_to(atleast_1d(v),(npoints,)).astype(float) for v in (Tmax,Tmin,thetamax,thetamin)]
+    return npoints,Tmax+273.15,Tmin+273.15,thetamax,thetamin,clay
+
+# Set initial values for one point into an array to give the solver
+# initvals can be a dictionary of pools (values can be scalars or one value per point), a DataFrame with one row per point,
+# a list of pool values, an array of shape (n_points, n_pools), or a list of previous results (continues from the last row)
+def get_initvals(initvals,point):
+    import sys
+    from numbers import Number
+    from numpy import atleast_1d,array,size,ndarray
+    # I'm using a convenient piece of Python syntax for making lists
+    if isinstance(initvals,dict):
+        ivals=[initvals[f] if size(initvals[f])==1 else atleast_1d(initvals[f])[point] for f in fields]
+    # initvals can only be a DataFrame if pandas has been imported already, so pandas isn't imported just to check
+    elif 'pandas' in sys.modules and isinstance(initvals, sys.modules['pandas'].DataFrame):
+        ivals=[initvals.iloc[point][f] for f in fields]
+    elif isinstance(initvals,ndarray) and initvals.ndim==2:
+        ivals=initvals[point]
+    else:
+        if isinstance(initvals[0],Number):
+            ivals=initvals
+        else:
+            init_sim=initvals[point]
+            ivals=[init_sim.iloc[-1][f] for f in fields]
+
+    return array(ivals,dtype=float).ravel()
+
 # This function runs an actual simulation using the ODE solver
 # Tmin and Tmax allow a sinusoidal temperature variation. Similar for thetamin and thetamax. Set min and max equal for constant state
 # times is an array of all the time steps for the simulation
@@ -101,77 +380,697 @@ def vector_iterate(SOM_init,params,T,theta,inputs,clay,times):
 # initvals is a dictionary of the initial values for all pools
 # params is a dictionary of all the parameter values
 # inputs is a dictionary of the C input rates of all pools. Assumes zero rate for pools not in the inputs data structure (so it can be empty for no inputs)
-def run_models_ODE(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals):
-    import time,pandas
-    from numpy import atleast_1d
-    t0=time.time()
-    from scipy.integrate import odeint
-    # Again, start with an empty list to hold the output
-    SOM_out_ODE=[]
-    print('ODE integrator')
-
-
-    def get_initvals(initvals,point):
-        # Set initial values into a list to give the solver
-        # I'm using a convenient piece of Python syntax for making lists
-        if isinstance(initvals,dict):
-            ivals=[initvals[f] for f in fields]
-        elif isinstance(initvals, pandas.DataFrame):
-            ivals=[initvals.iloc[point][f] for f in fields]
+# method selects the solver backend: 'odeint' (default) or a scipy.integrate.solve_ivp method such as 'BDF', 'Radau' or 'LSODA'
+# jac=True gives the solver the analytical Jacobian. With jac=False, jac_sparsity can be a sparsity pattern for the finite difference
+#   Jacobian (solve_ivp BDF/Radau only), or True to use the model's structural pattern. The Jacobian saves derivative calls with
+#   the stiff methods (BDF, Radau); odeint only uses it while LSODA is on its stiff method (see integrate_ODE)
+# rtol and atol are passed to the solver if they are set
+# batch=True solves all points as one stacked ODE system with a block diagonal Jacobian, instead of one solver call per point.
+#   Each point keeps its own Tmin/Tmax/thetamin/thetamax/clay. All points then share the solver's time steps
+# output='dataframes' (default) returns a list with one DataFrame per point. output='results' returns a CORPSE_results.Results with
+#   all pools of all points, which is much faster to build for many points (see make_output for the options)
+# sink is an optional output sink from CORPSE_output (e.g. keep only some pools, every N-th record, streamed to disk).
+#   The output then goes to the sink instead of being kept in memory, and sink.result() is returned. In batch mode the
+#   solver is restarted every chunk_records output times, so only one chunk of output is in memory at a time
+# full_output=True also returns a stats dictionary for the run (see CORPSE_instrument): totals of call counts, solver steps and
+#   timings, time_output (building the output), time_elapsed, peak_rss, and 'solves' with the stats of each solver call
+#   (one per point, or one per chunk of output times in batch mode)
+# profile (True or a file name) runs the simulation under cProfile, and trace_memory=True records its peak memory allocation.
+#   Their results are added to the stats
+# forcing is optional tabular temperature and moisture forcing (CORPSE_forcing.Forcing) that replaces the sinusoidal cycle.
+#   Tmin, Tmax, thetamin and thetamax are then ignored (they can be None)
+# prune=True leaves out pools that stay zero (microbial groups without biomass, unused chem types, protected pools with
+#   zero protection rate; see CORPSE_array.prune_model) from the integration. They are still in the output, as zeros
+# checkpoint is a directory where the state of the run is saved, at most every checkpoint_interval seconds (see CORPSE_checkpoint).
+#   If it already has a checkpoint of this run, the run continues from there. Checkpoints are taken after each point, or in batch mode
+#   after each chunk of chunk_records output times (the batch solver is then restarted every chunk even if the output is kept in memory)
+# cache is a directory (or CORPSE_cache.ResultCache) of saved results. If it has the result of a run with the same inputs and
+#   settings, that is returned instead of running the simulation, otherwise the result is added to it. Not used with a sink
+# layers runs soil columns with this many layers each (see CORPSE_layers): the points are the layers, top first, column by column.
+#   Layers of a column are coupled by vertical transport (transport, see CORPSE_layers.compile_transport), so columns are always
+#   solved in batch mode. inputs can then be a list with one dictionary per layer, and parameters can have an ensemble axis with
+#   one member per layer (the same for every column)
+# events is a list of disturbance events (see CORPSE_disturbance): pool transfers and parameter switches at given times, which can
+#   differ between points. The points are then solved in batch mode, and the solver restarts at each event time
+def run_models_ODE(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals,method='odeint',jac=True,jac_sparsity=None,rtol=None,atol=None,
+                   batch=False,output='dataframes',sink=None,chunk_records=1000,full_output=False,profile=False,trace_memory=False,forcing=None,
+                   prune=True,checkpoint=None,checkpoint_interval=60.0,cache=None,layers=None,transport=None,events=None):
+    # Arguments of the call, saved with checkpoints so that CORPSE_checkpoint.resume can repeat it, and hashed for the cache
+    call=dict(locals())
+    from time import perf_counter
+    from numpy import array,zeros,inf,searchsorted,concatenate
+    hooks=CORPSE_instrument.start_hooks(profile,trace_memory)
+    cache,key,cached=cache_lookup(cache,'run_models_ODE',call)
+    if cached is not None:
+        return cached_output(cached,times,output,full_output,hooks)
+    log.info('ODE integrator')
+
+    # Compile parameters and inputs once, instead of on every call of the derivative function
+    model=CORPSE_deriv.get_model(params)
+    npools=len(model['pools'])
+
+    # One value of each environmental variable per point
+    npoints,Tmax,Tmin,thetamax,thetamin,clay=point_envir(Tmin,Tmax,thetamin,thetamax,clay,forcing)
+
+    # Parameters with one ensemble member per layer are used for every column
+    def layer_members(model):
+        from numpy import tile,arange
+        if layers is not None and model['nensemble']==layers and npoints>layers:
+            return CORPSE_deriv.select_members(model,tile(arange(layers),npoints//layers))
+        return model
+
+    if layers is not None:
+        import CORPSE_layers
+        if npoints%layers!=0:
+            raise ValueError('%d points are not whole columns of %d layers'%(npoints,layers))
+        batch=True
+        model=layer_members(model)
+        transport=CORPSE_layers.compile_transport(transport,model['pools'],layers)
+        input_vals=CORPSE_layers.pack_inputs(inputs,model['pools'],layers,npoints)
+    elif transport is not None:
+        raise ValueError('transport needs the number of layers of the soil columns (layers)')
+    else:
+        input_vals=CORPSE_deriv.pack_inputs(inputs,model['pools'])
+    CORPSE_deriv.check_ensemble(model,npoints)
+
+    # Disturbance events, and the compiled model of each parameter switch
+    event_models,live=[],None
+    if events is not None:
+        import CORPSE_disturbance
+        batch=True
+        events=CORPSE_disturbance.compile_events(events,model['pools'],npoints)
+        event_models=[None if e['params'] is None else layer_members(CORPSE_deriv.get_model(e['params'])) for e in events]
+        for m in event_models:
+            if m is not None:
+                CORPSE_deriv.check_ensemble(m,npoints)
+        live=CORPSE_disturbance.live_pools(events,[model]+event_models,model['pools'])
+
+    # Initial values of all points, and the pools that are actually integrated
+    full_pools=model['pools']
+    initial=array([get_initvals(initvals,point) for point in range(npoints)])
+    keep=list(range(npools))
+    if prune:
+        model,keep=prune_pools(model,initial,input_vals,live)
+        # Switched parameters are pruned the same way, so they have the same pools
+        event_models=[None if m is None else prune_pools(m,initial,input_vals,live)[0] for m in event_models]
+        initial=initial[:,keep]
+        input_vals=input_vals[keep]
+        npools=len(keep)
+        if transport is not None:
+            transport=CORPSE_layers.select_pools(transport,keep)
+
+    # Latest checkpoint of this run, if there is one
+    ckpt,saved=None,None
+    if checkpoint is not None:
+        import CORPSE_checkpoint
+        settings={'times':times,'npoints':npoints,'pools':model['pools'],'batch':batch,'method':method,'rtol':rtol,'atol':atol,
+                  'chunk_records':chunk_records,'layers':layers}
+        ckpt=CORPSE_checkpoint.Checkpoint(checkpoint,'run_models_ODE',call,checkpoint_interval)
+        saved=ckpt.load(settings)
+
+    # Output array (n_pools, n_points, n_times) with all the pools, unless output goes to a sink
+    if sink is None:
+        result=zeros((len(full_pools),npoints,len(times)))
+        if checkpoint is None:
+            chunk_records=len(times)
+    else:
+        sink.open(model['pools'],npoints,times,full_pools=full_pools,resume=saved is not None)
+
+    solves=[]
+    time_output=0.0
+    # Position (output time in batch mode, point otherwise) to start from
+    first=0
+    if saved is not None:
+        log.info('Resuming from checkpoint at %s %d (time %g)','output time' if batch else 'point',saved['position'],saved['time'])
+        first=saved['position']
+        solves=saved['solves']
+        if sink is None:
+            result=saved['output']
+        else:
+            sink.set_state(saved['output'])
+    if batch:
+        # Time the state has reached
+        t_now=times[0] if saved is None else saved['time']
+        if events is not None:
+            # Events at or before the first output time change the initial state. A resumed run repeats the parameter
+            # switches of the events it has passed (their transfers are already in the saved state)
+            for t in CORPSE_disturbance.event_times(events,-inf,t_now):
+                if saved is None:
+                    CORPSE_disturbance.apply_transfers(events,t,initial.T,model['pools'])
+                model=CORPSE_disturbance.switch_params(events,event_models,t,model,npoints)
+        breaks=[] if events is None else CORPSE_disturbance.event_times(events,t_now,times[-1])
+        # One solver call for all the points, stacked point by point
+        ivals=initial.ravel() if saved is None else saved['state']
+        coupling=None
+        if transport is not None:
+            coupling=CORPSE_layers.transport_jacobian(transport,npoints)
+        if jac_sparsity is True and transport is not None:
+            jac_sparsity=CORPSE_layers.column_sparsity(model,transport,npoints)
+        elif jac_sparsity is True:
+            from scipy.sparse import kron,identity
+            jac_sparsity=kron(identity(npoints),CORPSE_deriv.jacobian_sparsity(model),format='csc')
+        if method in ('odeint','LSODA'):
+            # Transport couples each pool with the same pool in the next layer, npools further along the state
+            form,band='banded',npools if transport is not None else npools-1
+        else:
+            form,band='sparse',None
+        if forcing is None:
+            fun,jacblocks,envir=batch_ode_wrapper,batch_ode_jacobian,(Tmax,Tmin,thetamax,thetamin)
         else:
-            if is_numlike(initvals[0]):
-                ivals=initvals
+            fun,jacblocks,envir=forcing_batch_wrapper,forcing_batch_jacobian,(forcing,)
+        jacfun=lambda SOM_vector,t,*args: block_jacobian(jacblocks(SOM_vector,t,*args),form,coupling)
+        # Integrate one chunk of output times at a time, restarting from the end of the previous chunk
+        # A chunk ends early at the next event: the solver stops there, and restarts from the state after the event
+        start=first
+        while start<len(times):
+            stop=min(start+chunk_records,len(times))
+            t_end=times[stop-1]
+            t_event=next((t for t in breaks if t>t_now),None)
+            if t_event is not None and t_event<=t_end:
+                stop=int(searchsorted(times,t_event,side='right'))
+                t_end=t_event
             else:
-                init_sim=initvals[point]
-                ivals=[init_sim.iloc[-1][f] for f in fields]
+                t_event=None
+            # Solver times: from the time reached so far, through the output times of the segment, to the event
+            nrecords=stop-start
+            lead=int(nrecords==0 or times[start]>t_now)
+            trail=int(nrecords==0 or times[stop-1]<t_end)
+            segment_times=concatenate([[t_now]*lead,times[start:stop],[t_end]*trail])
+            solves.append(CORPSE_instrument.new_stats())
+            batch_result=integrate_ODE(fun,jacfun,ivals,segment_times,
+                args=envir+(input_vals,CORPSE_deriv.clay_modifier(clay),model,transport),
+                method=method,jac=jac,jac_sparsity=jac_sparsity,rtol=rtol,atol=atol,band=band,stats=solves[-1])
+            log.debug('Times %d to %d of %d: %s',start,stop,len(times),CORPSE_instrument.format_stats(solves[-1]))
+            t0=perf_counter()
+            ivals=batch_result[-1]
+            batch_result=batch_result[lead:lead+nrecords].reshape(nrecords,npoints,npools).transpose(2,1,0)
+            if t_event is not None:
+                log.debug('Events at time %g',t_event)
+                SOM=ivals.reshape(npoints,npools).T.copy()
+                CORPSE_disturbance.apply_transfers(events,t_event,SOM,model['pools'])
+                model=CORPSE_disturbance.switch_params(events,event_models,t_event,model,npoints)
+                ivals=SOM.T.ravel()
+                # An output record at the event time has the state after the event
+                if trail==0:
+                    batch_result[:,:,-1]=SOM
+            if nrecords>0 and sink is None:
+                result[keep,:,start:stop]=batch_result
+            elif nrecords>0:
+                sink.write(batch_result,start)
+            t_now=t_end
+            start=stop
+            if ckpt is not None and stop<len(times) and ckpt.due():
+                ckpt.save(settings,stop,t_now,ivals,result if sink is None else sink.get_state(),solves)
+            time_output+=perf_counter()-t0
+    else:
+        if jac_sparsity is True:
+            jac_sparsity=CORPSE_deriv.jacobian_sparsity(model)
+        for point in range(first,npoints):
+            log.debug('Point %d of %d',point,npoints)
 
-        return ivals
+            ivals=initial[point]
 
-    for point in range(len(atleast_1d(clay))):
-        print('Point %d of %d'%(point,len(atleast_1d(clay))))
+            # Runs the ODE integrator
+            if forcing is None:
+                fun,jacfun,envir=ode_wrapper,ode_jacobian,(Tmax[point],Tmin[point],thetamax[point],thetamin[point])
+            else:
+                fun,jacfun,envir=forcing_ode_wrapper,forcing_ode_jacobian,(forcing,point)
+            solves.append(CORPSE_instrument.new_stats())
+            point_result=integrate_ODE(fun,jacfun,ivals,times,
+                args=envir+(input_vals,clay[point],CORPSE_deriv.select_members(model,[point])),
+                method=method,jac=jac,jac_sparsity=jac_sparsity,rtol=rtol,atol=atol,stats=solves[-1]).T
+            log.debug('Point %d: %s',point,CORPSE_instrument.format_stats(solves[-1]))
+            t0=perf_counter()
+            if sink is None:
+                result[keep,point,:]=point_result
+            else:
+                sink.write(point_result[:,None,:],0,points=[point])
+            if ckpt is not None and point<npoints-1 and ckpt.due():
+                ckpt.save(settings,point+1,times[-1],None,result if sink is None else sink.get_state(),solves)
+            time_output+=perf_counter()-t0
 
-        ivals=get_initvals(initvals,point)
+    t0=perf_counter()
+    if sink is not None:
+        sink.close()
+        SOM_out_ODE=sink.result()
+    else:
+        if cache is not None:
+            cache.store(key,result)
+        SOM_out_ODE=make_output(result,times,output)
+    time_output+=perf_counter()-t0
+    if ckpt is not None:
+        ckpt.remove()
 
-        # Runs the ODE integrator
-        result=odeint(ode_wrapper,ivals,times,
-            args=(atleast_1d(Tmax)[point]+273.15,atleast_1d(Tmin)[point]+273.15,atleast_1d(thetamax)[point],atleast_1d(thetamin)[point],inputs,atleast_1d(clay)[point],params))
-        # Store the output in a pandas DataFrame (similar to R's dataframes)
-        result_df=pandas.DataFrame(result[:,:len(fields)],columns=fields,index=times)
+    stats=CORPSE_instrument.summarize(solves)
+    stats['time_output']=time_output
+    CORPSE_instrument.stop_hooks(hooks,stats)
+    log.info('Time elapsed: %1.1f s',stats['time_elapsed'],extra={'stats':stats})
+    log.info('Run stats: %s',CORPSE_instrument.format_stats(stats))
 
-        # Add it to the list of the output from each point
-        SOM_out_ODE.append(result_df)
+    if full_output:
+        return SOM_out_ODE,stats
+    return SOM_out_ODE
 
+# Output of the solvers from a result array of shape (n_pools, n_points, n_times)
+# output='dataframes': a list with one pandas DataFrame per point (much slower for many points)
+# output='results': CORPSE_results.Results, with views of each pool and point and vectorized diagnostics. output='array': the array itself
+def make_output(result,times,output='dataframes'):
+    import CORPSE_results
+    if output=='array':
+        return result
+    results=CORPSE_results.Results(result,fields,times)
+    if output=='results':
+        return results
+    elif output=='dataframes':
+        return results.to_dataframes()
+    raise ValueError('Unknown output type: %s'%output)
 
-    print('Time elapsed: %1.1f s'%(time.time()-t0))
+# Look up a run in the result cache (see CORPSE_cache)
+# Returns the cache, the key of the run and its cached result array (n_pools, n_points, n_times), or None if it is not in the cache.
+# Runs that write to a sink are not cached, the cache is then None
+def cache_lookup(cache,function,call):
+    if cache is None or call.get('sink') is not None:
+        return None,None,None
+    import CORPSE_cache
+    cache=CORPSE_cache.get_cache(cache)
+    key=cache.key(function,call)
+    return cache,key,cache.load(key)
 
-    return SOM_out_ODE
+# Output (and stats, with full_output) of a run that was loaded from the cache
+def cached_output(result,times,output,full_output,hooks):
+    stats=CORPSE_instrument.summarize([])
+    stats['cached']=True
+    CORPSE_instrument.stop_hooks(hooks,stats)
+    log.info('Loaded result from cache in %1.3f s',stats['time_elapsed'])
+    SOM_out=make_output(result,times,output)
+    if full_output:
+        return SOM_out,stats
+    return SOM_out
 
-# # Run a simulation using the explicit iterator instead of the ODE solver. Can edit this function to allow more complex temperature and moisture patterns, among other things
-# def run_models_iterator(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals):
-#     # Iterate explicitly
-#     import time
-#     from pandas import DataFrame
-#     from numpy import arange
-#     t0=time.time()
-    
-#     from numpy import cos,pi
-#     T=(cos(times[:,None]*2*pi)+1)*(Tmax.values-Tmin.values)/2+Tmin.values
-#     theta=(cos(times[:,None]*2*pi)+1)*(thetamax.values-thetamin.values)/2+thetamin.values
-    
-#     dt=times[1]-times[0]
-#     result_iterator=vector_iterate(initvals,params,T+273.15,theta,inputs,clay,times)
-#     SOM_out_iterator=[]
-#     for point in range(len(Tmin)):
-#         df=DataFrame(index=times,columns=fields)
-#         for field in result_iterator.keys():
-#             df[field]=result_iterator[field][point,:]
-#         # df['livingMicrobeN']=df['livingMicrobeC']/params['CN_microbe']
-#         SOM_out_iterator.append(df)
-
-#     print('Time elapsed: %1.1f s'%(time.time()-t0))
-#     return SOM_out_iterator
-
-# Functions for adding together all the C pools. They work on either dictionary or dataframe data types because both have the same names for the pools
+# Dormand-Prince 5(4) coefficients for adaptive_iterate
+DP_c=[0.0,1/5,3/10,4/5,8/9,1.0]
+DP_a=[[],
+      [1/5],
+      [3/40,9/40],
+      [44/45,-56/15,32/9],
+      [19372/6561,-25360/2187,64448/6561,-212/729],
+      [9017/3168,-355/33,46732/5247,49/176,-5103/18656]]
+DP_b=[35/384,0.0,500/1113,125/192,-2187/6784,11/84]
+DP_e=[71/57600,0.0,-71/16695,71/1920,-17253/339200,22/525,-1/40]
+# Coefficients of the 4th order continuous extension (dense output), for powers 1-4 of the fraction of the step
+DP_P=[[1.0,-8048581381/2820520608,8663915743/2820520608,-12715105075/11282082432],
+      [0.0,0.0,0.0,0.0],
+      [0.0,131558114200/32700410799,-68118460800/10900136933,87487479700/32700410799],
+      [0.0,-1754552775/470086768,14199869525/1410260304,-10690763975/1880347072],
+      [0.0,127303824393/49829197408,-318862633887/49829197408,701980252875/199316789632],
+      [0.0,-282668133/205662961,2019193451/616988883,-1453857185/822651844],
+      [0.0,40617522/29380423,-110615467/29380423,69997945/29380423]]
+
+# Vectorized explicit integrator with a separate adaptive time step for every point
+# Uses the embedded Dormand-Prince 5(4) Runge-Kutta pair. Each point has its own time and step size; steps are accepted or
+# rejected point by point, so converging points take long steps while points with fast transients take short ones.
+# Points that reach the end of the simulation drop out of the calculation.
+# Output at the requested times comes from the method's 4th order dense output within each step, so the steps don't have to land on them.
+#  fun(t,SOM,points): returns the derivative (n_pools, len(points)) for the state SOM (n_pools, len(points)) of the given point
+#                     indices at their times t (one time per point)
+#  SOM_init: initial state, shape (n_pools, n_points), at times[0]
+#  stats: optional dictionary (CORPSE_instrument.new_stats) that gets the total accepted and rejected steps, plus
+#         point_steps and point_rejected with the counts of each point
+# Returns array of shape (n_pools, n_points, n_times)
+def adaptive_iterate(fun,SOM_init,times,rtol=1e-6,atol=1e-8,first_step=None,max_step=None,min_step=1e-12,sink=None,chunk_records=1000,stats=None):
+    from numpy import asarray,zeros,full,arange,sqrt,abs,maximum,minimum,inf,any,nonzero,zeros_like,array,einsum,searchsorted,repeat,cumsum
+
+    times=asarray(times,dtype=float)
+    Y=asarray(SOM_init,dtype=float).copy()
+    npools,npoints=Y.shape
+    ntimes=len(times)
+    if max_step is None:
+        max_step=inf
+
+    # Without a sink, all output is kept in one array. With a sink, output is produced in windows of chunk_records
+    # output times, which are written to the sink as soon as every point has passed the end of the window
+    if sink is None:
+        chunk_records=ntimes
+        result=zeros((npools,npoints,ntimes))
+    next_out=full(npoints,1)
+    steps=zeros(npoints,dtype=int)
+    rejected=zeros(npoints,dtype=int)
+    t=full(npoints,times[0])
+    F=fun(t,Y,arange(npoints))
+
+    # Starting step from the size of the state relative to its rate of change
+    if first_step is None:
+        scale=atol+rtol*abs(Y)
+        d0=sqrt(((Y/scale)**2).mean(axis=0))
+        d1=sqrt(((F/scale)**2).mean(axis=0))
+        h=where_positive(d1,0.01*d0/d1+1e-6,1e-6)
+    else:
+        h=full(npoints,float(first_step))
+    h=minimum(minimum(h,max_step),times[-1]-times[0])
+
+    for start in range(0,ntimes,chunk_records):
+        stop=min(start+chunk_records,ntimes)
+        t_end=times[stop-1]
+        if sink is not None:
+            result=zeros((npools,npoints,stop-start))
+        if start==0:
+            result[:,:,0]=Y
+
+        active=t<t_end
+        while any(active):
+            idx=nonzero(active)[0]
+            y0=Y[:,idx]
+            t0=t[idx]
+            h0=minimum(h[idx],t_end-t0)
+
+            # Runge-Kutta stages
+            k=[F[:,idx]]
+            for stage in range(1,6):
+                dy=zeros_like(y0)
+                for j,a in enumerate(DP_a[stage]):
+                    dy+=a*k[j]
+                k.append(fun(t0+DP_c[stage]*h0,y0+h0*dy,idx))
+            dy=zeros_like(y0)
+            for j,b in enumerate(DP_b):
+                dy+=b*k[j]
+            y1=y0+h0*dy
+            k.append(fun(t0+h0,y1,idx))
+            err_est=zeros_like(y0)
+            for j,e in enumerate(DP_e):
+                err_est+=e*k[j]
+            err_est*=h0
+
+            # Scaled RMS error of each point, and step acceptance
+            scale=atol+rtol*maximum(abs(y0),abs(y1))
+            err=sqrt(((err_est/scale)**2).mean(axis=0))
+            accept=err<=1.0
+            steps[idx]+=accept
+            rejected[idx]+=~accept
+
+            # Dense output for any output times passed by accepted steps, for all points and output times at once
+            acc=idx[accept]
+            if len(acc)>0:
+                ya,yb,ta,ha=y0[:,accept],y1[:,accept],t0[accept],h0[accept]
+                tb=ta+ha
+                tb[tb>=t_end-1e-12*abs(t_end)]=t_end
+                last=minimum(searchsorted(times,tb,side='right'),stop)
+                counts=last-next_out[acc]
+                if counts.sum()>0:
+                    Q=einsum('jq,jnp->qnp',DP_P,array([kj[:,accept] for kj in k]))
+                    pairs_pt=repeat(arange(len(acc)),counts)
+                    pairs_out=arange(counts.sum())-repeat(cumsum(counts)-counts,counts)+repeat(next_out[acc],counts)
+                    # Blocks of (point, output time) pairs, to limit the size of temporary arrays
+                    for block in range(0,len(pairs_pt),65536):
+                        pt=pairs_pt[block:block+65536]
+                        out_index=pairs_out[block:block+65536]
+                        frac=(times[out_index]-ta[pt])/ha[pt]
+                        spow=array([frac,frac**2,frac**3,frac**4])
+                        result[:,acc[pt],out_index-start]=ya[:,pt]+ha[pt]*einsum('qnp,qp->np',Q[:,:,pt],spow)
+                next_out[acc]=last
+                Y[:,acc]=yb
+                F[:,acc]=k[6][:,accept]
+                t[acc]=tb
+
+            # New step sizes for all points, from the error estimate
+            factor=minimum(5.0,maximum(0.2,0.9*where_positive(err,err**-0.2,5.0)))
+            factor[~accept]=minimum(factor[~accept],1.0)
+            h[idx]=minimum(maximum(h0,h[idx]*accept)*factor,max_step)
+            if any(h[idx][~accept]<min_step):
+                raise RuntimeError('adaptive_iterate: step size fell below min_step at t=%1.6g'%t0[~accept].min())
+            active=t<t_end
+
+        if sink is not None:
+            sink.write(result,start)
+
+    if stats is not None:
+        stats['steps']=int(steps.sum())
+        stats['rejected']=int(rejected.sum())
+        stats['point_steps']=steps
+        stats['point_rejected']=rejected
+    if sink is None:
+        return result
+
+# where(x>0,a,b) without evaluating a where x is zero
+def where_positive(x,a,b):
+    from numpy import where,errstate
+    with errstate(divide='ignore',invalid='ignore'):
+        return where(x>0,a,b)
+
+# Run a simulation using the adaptive vectorized iterator instead of the ODE solver. All points are integrated together, each with its own step size.
+# Arguments are the same as run_models_ODE. rtol and atol control the error of each step, max_step limits the step size (years)
+# output works as in run_models_ODE
+# sink is an optional output sink from CORPSE_output. Output is then written to it every chunk_records output times and sink.result() is returned
+# full_output, profile and trace_memory work as in run_models_ODE. The stats also include point_steps and point_rejected,
+#   the accepted and rejected steps of each point, which show where the model is stiff
+# forcing, prune and cache work as in run_models_ODE. Each point interpolates the forcing at its own time
+def run_models_iterator(Tmin,Tmax,thetamin,thetamax,times,inputs,params,clay,initvals,rtol=1e-6,atol=1e-8,first_step=None,max_step=None,output='dataframes',
+                        sink=None,chunk_records=1000,full_output=False,profile=False,trace_memory=False,forcing=None,prune=True,cache=None):
+    call=dict(locals())
+    from time import perf_counter
+    from numpy import array,cos,pi
+    hooks=CORPSE_instrument.start_hooks(profile,trace_memory)
+    cache,key,cached=cache_lookup(cache,'run_models_iterator',call)
+    if cached is not None:
+        return cached_output(cached,times,output,full_output,hooks)
+
+    model=CORPSE_deriv.get_model(params)
+    input_vals=CORPSE_deriv.pack_inputs(inputs,model['pools'])
+
+    npoints,Tmax,Tmin,thetamax,thetamin,clay=point_envir(Tmin,Tmax,thetamin,thetamax,clay,forcing)
+    claymod=CORPSE_deriv.clay_modifier(clay)
+    CORPSE_deriv.check_ensemble(model,npoints)
+
+    full_pools=model['pools']
+    initial=array([get_initvals(initvals,point) for point in range(npoints)])
+    if prune:
+        model,keep=prune_pools(model,initial,input_vals)
+        initial=initial[:,keep]
+        input_vals=input_vals[keep]
+    input_vals=input_vals[:,None]
+
+    # Same sinusoidal temperature and moisture cycle as ode_wrapper (or the forcing), evaluated at each point's own time
+    def deriv(t,SOM,points):
+        if forcing is None:
+            T=(cos(t*2*pi)+1)*(Tmax[points]-Tmin[points])/2+Tmin[points]
+            theta=(cos(t*2*pi)+1)*(thetamax[points]-thetamin[points])/2+thetamin[points]
+        else:
+            T,theta=forcing(t,points)
+            T=T+273.15
+        point_model=model if len(points)==npoints else CORPSE_deriv.select_members(model,points)
+        return CORPSE_kernel.deriv(SOM,T,theta,point_model,claymod=claymod[points])+input_vals
+
+    SOM_init=initial.T
+    if sink is not None:
+        sink.open(model['pools'],npoints,times,full_pools=full_pools)
+    solve=CORPSE_instrument.new_stats()
+    t0=perf_counter()
+    result=adaptive_iterate(CORPSE_instrument.counted(deriv,solve,'nfev','time_deriv'),SOM_init,times,rtol=rtol,atol=atol,
+                            first_step=first_step,max_step=max_step,sink=sink,chunk_records=chunk_records,stats=solve)
+    solve['time_total']=perf_counter()-t0
+    solve['time_solver']=solve['time_total']-solve['time_deriv']
+
+    t0=perf_counter()
+    if sink is not None:
+        sink.close()
+        SOM_out_iterator=sink.result()
+    else:
+        result=CORPSE_deriv.expand_pools(result,model['pools'],full_pools)
+        if cache is not None:
+            cache.store(key,result)
+        SOM_out_iterator=make_output(result,times,output)
+
+    stats=CORPSE_instrument.summarize([solve])
+    stats['point_steps']=solve['point_steps']
+    stats['point_rejected']=solve['point_rejected']
+    stats['time_output']=perf_counter()-t0
+    CORPSE_instrument.stop_hooks(hooks,stats)
+    log.info('Time elapsed: %1.1f s',stats['time_elapsed'],extra={'stats':stats})
+    log.info('Run stats: %s',CORPSE_instrument.format_stats(stats))
+
+    if full_output:
+        return SOM_out_iterator,stats
+    return SOM_out_iterator
+
+# Find the steady state (equilibrium) of the model directly, instead of spinning it up by integrating for centuries
+# Environmental conditions and C inputs are constant: T is temperature (C), theta is soil moisture, one value (or one per point) each.
+# Cumulative CO2 never reaches a steady state, so it is kept at its initial value. Microbial pools that start at zero stay at zero.
+# initvals is the starting guess, in any form accepted by run_models_ODE. All points are solved together.
+# Each point is first solved with Newton's method using the analytical Jacobian. Points where Newton fails are solved again
+# from the starting guess with pseudo-transient continuation, which takes implicit pseudo-time steps that grow as the residual shrinks.
+# A point has converged when every pool's rate of change is less than rtol times the pool size (plus atol) per year.
+# Returns a dictionary of pools with one value per point, which can be passed directly as initvals to run_models_ODE.
+# With full_output=True, also returns a dictionary with 'converged', 'iterations', 'method' and 'residual' for each point
+def find_steady_state(T,theta,inputs,params,clay,initvals,rtol=1e-10,atol=1e-10,newton_iter=50,ptc_iter=2000,dtau0=1e-2,full_output=False):
+    from numpy import atleast_1d,broadcast_to,array,zeros,full,nonzero
+
+    model=CORPSE_deriv.get_model(params)
+    full_pools=model['pools']
+    npoints=len(atleast_1d(clay))
+    T,theta,clay=[broadcast_to(atleast_1d(v),(npoints,)).astype(float) for v in (T,theta,clay)]
+    T=T+273.15
+    claymod=CORPSE_deriv.clay_modifier(clay)
+    input_vals=CORPSE_deriv.pack_inputs(inputs,full_pools)
+    x0=array([get_initvals(initvals,point) for point in range(npoints)])
+
+    # Pools that stay zero are left out of the solve and returned as zeros
+    model,keep=prune_pools(model,x0,input_vals)
+    pools=model['pools']
+    npools=len(pools)
+    x0=x0[:,keep].T
+    input_vals=input_vals[keep][:,None]
+
+    # Pools that are held fixed: cumulative CO2, and microbial pools with no biomass
+    nc=model['nchem']; nm=model['nmic']; npr=model['nprot']
+    frozen=zeros((npools,npoints),dtype=bool)
+    frozen[pools.index('CO2')]=True
+    frozen[nc+npr:nc+npr+nm]|=x0[nc+npr:nc+npr+nm]==0
+
+    CORPSE_deriv.check_ensemble(model,npoints)
+
+    def residual(x,points):
+        point_model=model if len(points)==npoints else CORPSE_deriv.select_members(model,points)
+        F=CORPSE_kernel.deriv(x,T[points],theta[points],point_model,claymod=claymod[points])+input_vals
+        F[frozen[:,points]]=0.0
+        return F
+
+    # Jacobian blocks (n_points, n_pools, n_pools). Frozen pools get -1 on the diagonal and no coupling, so they never change
+    def jacobian(x,points):
+        point_model=model if len(points)==npoints else CORPSE_deriv.select_members(model,points)
+        J=CORPSE_kernel.jacobian(x,T[points],theta[points],point_model,claymod=claymod[points])
+        if J.ndim==2:
+            J=J[:,:,None]
+        J=J.transpose(2,0,1).copy()
+        fr=frozen[:,points].T
+        J[fr[:,:,None]|fr[:,None,:]]=0.0
+        J[fr[:,:,None]&eye_mask]=-1.0
+        return J
+
+    from numpy import eye
+    eye_mask=eye(npools,dtype=bool)[None,:,:]
+    x,converged,iterations,res=newton_steady_state(residual,jacobian,x0.copy(),rtol,atol,newton_iter)
+    method=full(npoints,'newton',dtype=object)
+
+    failed=nonzero(~converged)[0]
+    if len(failed)>0:
+        xp,convp,itp,resp=ptc_steady_state(residual,jacobian,x0[:,failed].copy(),failed,rtol,atol,ptc_iter,dtau0)
+        x[:,failed]=xp
+        converged[failed]=convp
+        iterations[failed]+=itp
+        res[failed]=resp
+        method[failed]='ptc'
+    if not converged.all():
+        log.warning('Steady state did not converge for %d of %d points',(~converged).sum(),npoints)
+
+    SOM=dict([(p,x[pools.index(p)].copy() if p in pools else zeros(npoints)) for p in full_pools])
+    if full_output:
+        return SOM,{'converged':converged,'iterations':iterations,'method':method,'residual':res}
+    return SOM
+
+# Scaled residual of each point: largest rate of change relative to pool size
+def steady_state_norm(F,x,atol):
+    from numpy import abs
+    return (abs(F)/(abs(x)+atol)).max(axis=0)
+
+# Solve J*dx=b for a stack of small systems (n_points, n, n). Points with singular matrices get NaN
+def solve_blocks(J,b):
+    from numpy.linalg import solve,LinAlgError
+    from numpy import full,nan
+    try:
+        return solve(J,b.T[:,:,None])[:,:,0].T
+    except LinAlgError:
+        dx=full(b.shape,nan)
+        for point in range(J.shape[0]):
+            try:
+                dx[:,point]=solve(J[point],b[:,point])
+            except LinAlgError:
+                pass
+        return dx
+
+# Largest step fraction (up to 1) that keeps all pools non-negative
+def positive_step(x,dx):
+    from numpy import where,inf,minimum,errstate
+    with errstate(divide='ignore',invalid='ignore'):
+        ratio=where(dx<0,-x/dx,inf)
+    return minimum(1.0,0.99*ratio.min(axis=0))
+
+# Vectorized damped Newton iteration for the steady state. Each point stops as soon as it converges
+def newton_steady_state(residual,jacobian,x,rtol,atol,maxiter):
+    from numpy import zeros,full,nonzero,isfinite,inf,abs
+    npoints=x.shape[1]
+    converged=zeros(npoints,dtype=bool)
+    failed=zeros(npoints,dtype=bool)
+    iterations=zeros(npoints,dtype=int)
+    res=full(npoints,inf)
+    for it in range(maxiter):
+        act=nonzero(~converged&~failed)[0]
+        if len(act)==0:
+            break
+        xa=x[:,act]
+        F=residual(xa,act)
+        res[act]=steady_state_norm(F,xa,atol)
+        done=res[act]<rtol
+        converged[act[done]]=True
+        act,xa,F=act[~done],xa[:,~done],F[:,~done]
+        if len(act)==0:
+            break
+        iterations[act]+=1
+
+        dx=solve_blocks(jacobian(xa,act),-F)
+        ok=isfinite(dx).all(axis=0)
+        failed[act[~ok]]=True
+        alpha=positive_step(xa,dx)
+        # Backtracking: shorten the step until the residual decreases
+        for n in range(10):
+            xn=xa+alpha*dx
+            better=steady_state_norm(residual(xn,act),xn,atol)<res[act]
+            if better.all():
+                break
+            alpha[~better]*=0.5
+        step_ok=ok&better&(alpha>1e-8)
+        failed[act[~step_ok]]=True
+        x[:,act[step_ok]]=xn[:,step_ok]
+        # A full Newton step that barely changes the pools also means convergence
+        small=step_ok&(alpha==1.0)&((abs(dx)/(abs(xa)+atol)).max(axis=0)<rtol)
+        converged[act[small]]=True
+    return x,converged,iterations,res
+
+# Vectorized pseudo-transient continuation for the steady state
+# Takes implicit Euler steps (I/dtau - J)*dx = F in pseudo-time. dtau grows as the residual shrinks (switched evolution relaxation),
+# so it starts out like a stable time integration and ends up like Newton's method
+def ptc_steady_state(residual,jacobian,x,points,rtol,atol,maxiter,dtau0):
+    from numpy import zeros,full,nonzero,isfinite,eye,minimum,maximum
+    npoints=x.shape[1]
+    npools=x.shape[0]
+    converged=zeros(npoints,dtype=bool)
+    iterations=zeros(npoints,dtype=int)
+    dtau=full(npoints,float(dtau0))
+    F=residual(x,points)
+    res=steady_state_norm(F,x,atol)
+    I=eye(npools)[None,:,:]
+    for it in range(maxiter):
+        converged|=res<rtol
+        act=nonzero(~converged)[0]
+        if len(act)==0:
+            break
+        iterations[act]+=1
+        xa=x[:,act]
+        M=I/dtau[act,None,None]-jacobian(xa,points[act])
+        xn=xa+solve_blocks(M,F[:,act])
+        Fn=residual(xn,points[act])
+        resn=steady_state_norm(Fn,xn,atol)
+        # Reject steps that go negative or fail, and retry them with a smaller pseudo-time step
+        ok=isfinite(xn).all(axis=0)&(xn>=0).all(axis=0)&isfinite(resn)
+        acc=act[ok]
+        x[:,acc]=xn[:,ok]
+        F[:,acc]=Fn[:,ok]
+        dtau[acc]*=minimum(maximum(res[acc]/resn[ok],0.5),10.0)
+        res[acc]=resn[ok]
+        dtau[act[~ok]]*=0.25
+    # Points that converged on the last iteration
+    converged|=res<rtol
+    return x,converged,iterations,res
+
+# Functions for adding together all the C pools. They work on dictionary, dataframe or CORPSE_results.Results data types because all have the same names for the pools
 def totalCarbon(SOM, microbial_pools):
     totalMBC=0
     for m in microbial_pools:
@@ -1,4 +1,3 @@
-import pandas as pd
 import CORPSE_solvers
 from numpy import array,arange
 import copy
@@ -95,88 +94,105 @@ envir_params['high sev burn sandy soil']['thetamin']=array(0.5)
 envir_params['high sev burn sandy soil']['thetamax']=array(0.7)
 envir_params['high sev burn sandy soil']['porosity']=array(0.4)
 
-
-# Set up a data structure to hold the results of the different simulations
-results={}
-# Goes through each functional type and runs a simulation using the appropriate set of parameters and initial values
-# Simulations are assuming a constant temperature of 20 C and constant moisture of 60% of saturation
-# Inputs are empty because this is running as an incubation without any constant inputs of C
-
-for functype in initvals:
-    results[functype] = CORPSE_solvers.run_models_ODE(Tmin=18.0,Tmax=24.0,thetamin=envir_params[functype]['thetamin'],
-                                                      thetamax=envir_params[functype]['thetamax'],
-                                            times=t,inputs={},clay=2.5,initvals=initvals[functype],params=paramsets[functype])
-
-
-# Tally total number of microbial pools being used in simulation
-from numpy import where
-num_micro_pools=0
-num_micro_pools=where(SOM_init['MBC_1']>0, num_micro_pools+1, num_micro_pools+0)   
-num_micro_pools=where(SOM_init['MBC_2']>0, num_micro_pools+1, num_micro_pools+0)   
-num_micro_pools=where(SOM_init['MBC_3']>0, num_micro_pools+1, num_micro_pools+0)   
-num_micro_pools=where(SOM_init['MBC_4']>0, num_micro_pools+1, num_micro_pools+0)   
-
-
-# This section plots the results
-# Each set of results should have the same set of pools as the initial values structure from the beginning of the simulation
-from matplotlib import pyplot
-
-# Plot CO2 fluxes
-fig,ax=pyplot.subplots(nrows=1,ncols=1,clear=True,num='CORPSE results')
-
-for sim in results:
-    totalC=CORPSE_array.sumCtypes(results[sim][0], 'u')+CORPSE_array.sumCtypes(results[sim][0], 'p')
-    ax.plot(t*365,results[sim][0]['CO2'].diff()/totalC[0]*100,label=sim)
-    # ax[1].plot(t*365,results[sim][0]['uFastC'],label='Simple')
-    # ax[1].plot(t*365,results[sim][0]['uSlowC'],label='Complex')
-    # ax[1].plot(t*365,results[sim][0]['uNecroC'],label='Necromass')
-ax.set_xlabel('Time (days)')
-ax.set_ylabel('CO$_2$ flux rate (% initial C/day)')
-ax.legend(fontsize='small')
-ax.set_title('CO$_2$ fluxes')
-
-pyplot.show()
+# Solver settings for these incubations. odeint (LSODA) stays on its non-stiff method for them, so it never uses the analytical
+# Jacobian. BDF does, and needs about 40 derivative calls per scenario instead of about 60, within about 1e-5 of a tight-tolerance run
+solver_options={'method':'BDF','jac':True,'rtol':1e-4,'atol':1e-6}
+
+
+# Everything below runs the simulations and plots the results. It only runs when this file is run as a script,
+# so the initial values and parameter sets above can be imported by other scripts (e.g. CORPSE_benchmark.py)
+if __name__=='__main__':
+    # Show the solver progress messages
+    import logging
+    logging.basicConfig(level=logging.INFO,format='%(message)s')
+
+    # Set up a data structure to hold the results of the different simulations
+    results={}
+    # Goes through each functional type and runs a simulation using the appropriate set of parameters and initial values
+    # Simulations are assuming a constant temperature of 20 C and constant moisture of 60% of saturation
+    # Inputs are empty because this is running as an incubation without any constant inputs of C
+    # Set cache_dir to a directory (e.g. 'Whitman_cache') to cache the results there, so running the script again only simulates
+    # the scenarios whose parameters or initial values changed (see CORPSE_cache). None runs every scenario without a cache
+    cache_dir=None
+
+    for functype in initvals:
+        results[functype] = CORPSE_solvers.run_models_ODE(Tmin=18.0,Tmax=24.0,thetamin=envir_params[functype]['thetamin'],
+                                                          thetamax=envir_params[functype]['thetamax'],
+                                                times=t,inputs={},clay=2.5,initvals=initvals[functype],params=paramsets[functype],
+                                                cache=cache_dir,output='results',**solver_options)
+
+
+    # Tally total number of microbial pools being used in simulation
+    from numpy import where
+    num_micro_pools=0
+    num_micro_pools=where(SOM_init['MBC_1']>0, num_micro_pools+1, num_micro_pools+0)   
+    num_micro_pools=where(SOM_init['MBC_2']>0, num_micro_pools+1, num_micro_pools+0)   
+    num_micro_pools=where(SOM_init['MBC_3']>0, num_micro_pools+1, num_micro_pools+0)   
+    num_micro_pools=where(SOM_init['MBC_4']>0, num_micro_pools+1, num_micro_pools+0)   
+
+
+    # This section plots the results
+    # Each set of results should have the same set of pools as the initial values structure from the beginning of the simulation
+    from matplotlib import pyplot
+
+    # Plot CO2 fluxes
+    fig,ax=pyplot.subplots(nrows=1,ncols=1,clear=True,num='CORPSE results')
+
+    for sim in results:
+        # Each result holds all pools of all points (here just one point), as arrays of shape (n_points, n_times)
+        totalC=results[sim].sum_ctypes('u')+results[sim].sum_ctypes('p')
+        # CO2 flux (per year, converted to per day) relative to initial C
+        ax.plot(t*365,results[sim].flux('CO2',relative_to=totalC[:,0])[0]/365*100,label=sim)
+        # ax[1].plot(t*365,results[sim][0]['uFastC'],label='Simple')
+        # ax[1].plot(t*365,results[sim][0]['uSlowC'],label='Complex')
+        # ax[1].plot(t*365,results[sim][0]['uNecroC'],label='Necromass')
+    ax.set_xlabel('Time (days)')
+    ax.set_ylabel('CO$_2$ flux rate (% initial C/day)')
+    ax.legend(fontsize='small')
+    ax.set_title('CO$_2$ fluxes')
+
+    pyplot.show()
     
 
 
-# Plot microbial pool sizes
-nrows=int(num_micro_pools)
-
-fig,ax=pyplot.subplots(nrows=nrows,ncols=1,clear=True,num='CORPSE results')
-for sim in results:
-    if nrows == 1: 
-        ax.plot(t*365,results[sim][0]['MBC_1']/totalC[0]*100)
-        ax.set_ylabel('MBC 1')
-        ax.set_xlabel('Time (days)')
-        ax.legend(fontsize='small')
-        ax.set_title('Microbial biomass C pool size (% of initial C)')
-    elif nrows == 2: 
-        ax[0].plot(t*365,results[sim][0]['MBC_1']/totalC[0]*100)
-        ax[0].set_ylabel('MBC 1')
-        ax[1].plot(t*365,results[sim][0]['MBC_2']/totalC[0]*100)  
-        ax[1].set_ylabel('MBC 2')
-        ax[1].set_xlabel('Time (days)')
-    elif nrows ==3: 
-        ax[0].plot(t*365,results[sim][0]['MBC_1']/totalC[0]*100)
-        ax[0].set_ylabel('MBC 1')
-        ax[1].plot(t*365,results[sim][0]['MBC_2']/totalC[0]*100)  
-        ax[1].set_ylabel('MBC 2')
-        ax[2].plot(t*365,results[sim][0]['MBC_3']/totalC[0]*100)
-        ax[2].set_ylabel('MBC 3')
-        ax[2].set_xlabel('Time (days)')
-    elif nrows == 4:
-        ax[0].plot(t*365,results[sim][0]['MBC_1']/totalC[0]*100)
-        ax[0].set_ylabel('MBC 1')
-        ax[1].plot(t*365,results[sim][0]['MBC_2']/totalC[0]*100)  
-        ax[1].set_ylabel('MBC 2')
-        ax[2].plot(t*365,results[sim][0]['MBC_3']/totalC[0]*100)
-        ax[2].set_ylabel('MBC 3')
-        ax[3].plot(t*365,results[sim][0]['MBC_4']/totalC[0]*100)
-        ax[3].set_ylabel('MBC 4')
-        ax[3].set_xlabel('Time (days)')
-
-ax[0].legend(fontsize='small')
-ax[0].set_title('Microbial biomass C pool size (% of initial C)')
-# ax[1].set_title('Microbial biomass')
-
-pyplot.show()
\ No newline at end of file
+    # Plot microbial pool sizes
+    nrows=int(num_micro_pools)
+
+    fig,ax=pyplot.subplots(nrows=nrows,ncols=1,clear=True,num='CORPSE results')
+    for sim in results:
+        if nrows == 1: 
+            ax.plot(t*365,results[sim]['MBC_1'][0]/totalC[0,0]*100)
+            ax.set_ylabel('MBC 1')
+            ax.set_xlabel('Time (days)')
+            ax.legend(fontsize='small')
+            ax.set_title('Microbial biomass C pool size (% of initial C)')
+        elif nrows == 2: 
+            ax[0].plot(t*365,results[sim]['MBC_1'][0]/totalC[0,0]*100)
+            ax[0].set_ylabel('MBC 1')
+            ax[1].plot(t*365,results[sim]['MBC_2'][0]/totalC[0,0]*100)  
+            ax[1].set_ylabel('MBC 2')
+            ax[1].set_xlabel('Time (days)')
+        elif nrows ==3: 
+            ax[0].plot(t*365,results[sim]['MBC_1'][0]/totalC[0,0]*100)
+            ax[0].set_ylabel('MBC 1')
+            ax[1].plot(t*365,results[sim]['MBC_2'][0]/totalC[0,0]*100)  
+            ax[1].set_ylabel('MBC 2')
+            ax[2].plot(t*365,results[sim]['MBC_3'][0]/totalC[0,0]*100)
+            ax[2].set_ylabel('MBC 3')
+            ax[2].set_xlabel('Time (days)')
+        elif nrows == 4:
+            ax[0].plot(t*365,results[sim]['MBC_1'][0]/totalC[0,0]*100)
+            ax[0].set_ylabel('MBC 1')
+            ax[1].plot(t*365,results[sim]['MBC_2'][0]/totalC[0,0]*100)  
+            ax[1].set_ylabel('MBC 2')
+            ax[2].plot(t*365,results[sim]['MBC_3'][0]/totalC[0,0]*100)
+            ax[2].set_ylabel('MBC 3')
+            ax[3].plot(t*365,results[sim]['MBC_4'][0]/totalC[0,0]*100)
+            ax[3].set_ylabel('MBC 4')
+            ax[3].set_xlabel('Time (days)')
+
+    ax[0].legend(fontsize='small')
+    ax[0].set_title('Microbial biomass C pool size (% of initial C)')
+    # ax[1].set_title('Microbial biomass')
+
+    pyplot.show()
\ No newline at end of file
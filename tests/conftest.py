@@ -0,0 +1,34 @@
+# The CORPSE modules are scripts in the top directory of the repository, not an installed package
+import os
+import sys
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import pytest
+import Whitman_sims
+
+
+# Whitman_sims scenario that the tests run. Its initial values leave two microbial groups and all protected pools empty,
+# so the zero-pool branches of the model and pool pruning are covered too
+@pytest.fixture(scope='session')
+def scenario():
+    return 'high sev burn sandy soil'
+
+@pytest.fixture(scope='session')
+def params(scenario):
+    return Whitman_sims.paramsets[scenario]
+
+@pytest.fixture(scope='session')
+def initvals(scenario):
+    return Whitman_sims.initvals[scenario]
+
+# Arguments of run_models_ODE for npoints points of the scenario: the Whitman_sims temperature and moisture cycle, clay 2.5%,
+# no inputs, one year of daily output as an array. Keyword arguments replace or add to them
+@pytest.fixture(scope='session')
+def run_kwargs(params,initvals):
+    def make(npoints=1,**kwargs):
+        args=dict(Tmin=18.0,Tmax=24.0,thetamin=0.5,thetamax=0.7,times=numpy.arange(0,1,1/365),inputs={},params=params,
+                  clay=numpy.full(npoints,2.5),initvals=initvals,output='array')
+        args.update(kwargs)
+        return args
+    return make
@@ -0,0 +1,33 @@
+# Compiled models of parameter dictionaries (CORPSE_array.get_model)
+import copy
+import numpy
+import CORPSE_array
+
+
+# The same dictionary gives the same compiled model (with its memos) until one of its values changes
+def test_get_model_reuses_compiled_model(params):
+    params=copy.deepcopy(params)
+    model=CORPSE_array.get_model(params)
+    assert CORPSE_array.get_model(params) is model
+    assert CORPSE_array.get_model(model) is model
+    params['vmaxref']['MBC_1']['Fast']*=2
+    changed=CORPSE_array.get_model(params)
+    assert changed is not model
+    assert changed['vmaxref'][0,0,0]==2*model['vmaxref'][0,0,0]
+    assert CORPSE_array.get_model(params) is changed
+
+# Ensemble arrays are compared by identity: replacing one compiles again
+def test_get_model_ensemble_arrays(params):
+    params=copy.deepcopy(params)
+    params['Tmic']['MBC_1']=numpy.array([0.2,0.4,0.6])
+    model=CORPSE_array.get_model(params)
+    assert CORPSE_array.get_model(params) is model
+    params['Tmic']['MBC_1']=numpy.array([0.2,0.4,0.8])
+    assert CORPSE_array.get_model(params)['Tmic'][0,2]==0.8
+
+# The dictionary adapter gives the same rates of change as the packed model function
+def test_dictionary_adapter(params,initvals):
+    model=CORPSE_array.get_model(params)
+    deriv=CORPSE_array.CORPSE_deriv(initvals,293.15,0.6,params)
+    packed=CORPSE_array.CORPSE_deriv_array(CORPSE_array.pack_pools(initvals,model['pools']),293.15,0.6,model)
+    assert numpy.array_equal(CORPSE_array.pack_pools(deriv,model['pools']),packed)
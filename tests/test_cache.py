@@ -0,0 +1,110 @@
+# Result cache (CORPSE_cache): hits, least recently used eviction, and new keys when anything that changes the result changes
+import os
+import copy
+import numpy
+import pytest
+import CORPSE_array
+import CORPSE_cache
+import CORPSE_forcing
+import CORPSE_solvers
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CORPSE_cache.ResultCache(str(tmp_path/'cache'))
+
+@pytest.fixture
+def cache_kwargs(run_kwargs):
+    return run_kwargs(2,Tmin=numpy.array([18.0,10.0]),times=numpy.arange(0,0.1,1/365))
+
+def run(cache,**kwargs):
+    result,stats=CORPSE_solvers.run_models_ODE(cache=cache,full_output=True,**kwargs)
+    return result,stats.get('cached',False)
+
+# A forcing version of the cosine cycle of cache_kwargs
+def forcing(T_shift=0.0):
+    times=CORPSE_forcing.record_times(40)
+    cycle=(numpy.cos(times*2*numpy.pi)+1)/2
+    return CORPSE_forcing.Forcing(times,cycle[:,None]*numpy.array([6.0,14.0])+numpy.array([18.0,10.0])+T_shift,cycle*0.2+0.5)
+
+
+def test_cache_hit(cache,cache_kwargs):
+    first,cached=run(cache,**cache_kwargs)
+    assert not cached and len(cache.entries())==1
+    second,cached=run(cache,**cache_kwargs)
+    assert cached
+    assert numpy.array_equal(first,second)
+    # The output form is not part of the key
+    results,cached=run(cache,**dict(cache_kwargs,output='results'))
+    assert cached and numpy.array_equal(results.values,first)
+    # Nor are default arguments that were left out
+    result,cached=run(cache,method='odeint',**cache_kwargs)
+    assert cached
+    # The iterator is a different function, so it has its own results
+    result,stats=CORPSE_solvers.run_models_iterator(cache=cache,full_output=True,**cache_kwargs)
+    assert not stats.get('cached',False) and len(cache.entries())==2
+
+@pytest.mark.parametrize('change',['params','initvals','envir','forcing','solver','model_version'])
+def test_cache_invalidated_by_changes(cache,cache_kwargs,params,monkeypatch,change):
+    if change=='forcing':
+        cache_kwargs.update(Tmin=None,Tmax=None,thetamin=None,thetamax=None,forcing=forcing())
+    first=run(cache,**cache_kwargs)[0]
+    assert run(cache,**cache_kwargs)[1]
+    changed=dict(cache_kwargs)
+    if change=='params':
+        changed['params']=copy.deepcopy(params)
+        changed['params']['Tmic']['MBC_1']*=1.5
+    elif change=='initvals':
+        changed['initvals']=dict(cache_kwargs['initvals'],uFastC=1.0)
+    elif change=='envir':
+        changed['clay']=numpy.array([2.5,5.0])
+    elif change=='forcing':
+        changed['forcing']=forcing(T_shift=0.5)
+    elif change=='solver':
+        changed['rtol']=1e-8
+    else:
+        # Editing the model source changes its version
+        monkeypatch.setattr(CORPSE_cache,'version','edited model source')
+    result,cached=run(cache,**changed)
+    assert not cached
+    assert len(cache.entries())==2
+    # A new simulation, not the old result under a new key
+    if change in ('params','initvals','envir','forcing'):
+        assert not numpy.array_equal(result,first)
+
+# Compiled models hash by their values: memos filled in by a run (see CORPSE_array.memo_keys) don't change the key,
+# but changing a parameter array does
+def test_compiled_model_key(cache,cache_kwargs,params):
+    model=CORPSE_array.compile_params(params)
+    call=dict(cache_kwargs,params=model)
+    key=cache.key('run_models_ODE',call)
+    run(cache,**call)
+    assert any([len(model[k])>0 for k in CORPSE_array.memo_keys])
+    assert cache.key('run_models_ODE',call)==key
+    assert run(cache,**call)[1]
+    model['Tmic']=model['Tmic']*1.5
+    assert cache.key('run_models_ODE',call)!=key
+
+def test_lru_eviction(cache):
+    value=numpy.zeros(1000)
+    for n,key in enumerate(['a','b','c']):
+        cache.store(key,value+n)
+        os.utime(cache.filename(key),(1000+n,1000+n))
+        size=os.path.getsize(cache.filename(key))
+    assert [e[0] for e in cache.entries()]==['a','b','c']
+    # Loading a result marks it as recently used, so b is now the least recently used
+    assert cache.load('a')[0]==0
+    cache.max_bytes=3*size
+    cache.store('d',value+3)
+    assert sorted([e[0] for e in cache.entries()])==['a','c','d']
+    assert cache.load('b') is None
+    assert cache.size()==3*size
+    assert cache.invalidate('c') and not cache.invalidate('c')
+    cache.clear()
+    assert cache.entries()==[]
+
+def test_invalidate_call(cache,cache_kwargs):
+    run(cache,**cache_kwargs)
+    call=dict(cache_kwargs,cache=cache)
+    assert cache.invalidate('run_models_ODE',call)
+    assert not run(cache,**cache_kwargs)[1]
@@ -0,0 +1,83 @@
+# Checkpoint and resume of run_models_ODE (CORPSE_checkpoint)
+import os
+import copy
+import numpy
+import pytest
+import CORPSE_solvers
+import CORPSE_checkpoint
+import CORPSE_output
+
+
+class Interrupted(Exception):
+    pass
+
+
+# Batch run of three points, restarted (and checkpointed) every 50 output times
+@pytest.fixture
+def ckpt_kwargs(run_kwargs):
+    return run_kwargs(3,Tmin=numpy.linspace(5,18,3),inputs={'uFastC':0.5},batch=True,chunk_records=50,checkpoint_interval=0)
+
+# Uninterrupted run with a checkpoint. Without a sink, the checkpoint makes the batch solver restart every chunk
+def reference(path,kwargs):
+    return CORPSE_solvers.run_models_ODE(checkpoint=str(path),**kwargs)
+
+# Run until the solver has been called ncalls times, leaving a checkpoint in path
+def interrupt(monkeypatch,path,ncalls=3,**kwargs):
+    integrate=CORPSE_solvers.integrate_ODE
+    calls=[0]
+    def failing(*args,**kw):
+        calls[0]+=1
+        if calls[0]>ncalls:
+            raise Interrupted()
+        return integrate(*args,**kw)
+    monkeypatch.setattr(CORPSE_solvers,'integrate_ODE',failing)
+    with pytest.raises(Interrupted):
+        CORPSE_solvers.run_models_ODE(checkpoint=path,**kwargs)
+    monkeypatch.setattr(CORPSE_solvers,'integrate_ODE',integrate)
+    assert CORPSE_checkpoint.checkpoint_time(path) is not None
+
+
+def test_resume_matches_uninterrupted_run(tmp_path,monkeypatch,ckpt_kwargs):
+    path=str(tmp_path/'ckpt')
+    interrupt(monkeypatch,path,**ckpt_kwargs)
+    resumed=CORPSE_solvers.run_models_ODE(checkpoint=path,**ckpt_kwargs)
+    assert numpy.abs(resumed-reference(tmp_path/'ref',ckpt_kwargs)).max()==0.0
+    # The checkpoint created its directory, so it is removed once the resumed run finishes
+    assert not os.path.exists(path)
+
+# Per-point runs and batch runs with a sink are checkpointed where they restart anyway, so they give the same output as
+# a run without a checkpoint, interrupted or not
+@pytest.mark.parametrize('batch,sink',[(False,False),(True,True)])
+def test_resume_matches_run_without_checkpoint(tmp_path,monkeypatch,ckpt_kwargs,batch,sink):
+    def kwargs():
+        return dict(ckpt_kwargs,batch=batch,sink=CORPSE_output.OutputSink() if sink else None)
+    def values(result):
+        return numpy.array([result[p] for p in CORPSE_solvers.fields]) if sink else result
+    path=str(tmp_path/'ckpt')
+    interrupt(monkeypatch,path,ncalls=2,**kwargs())
+    resumed=values(CORPSE_solvers.run_models_ODE(checkpoint=path,**kwargs()))
+    assert numpy.abs(resumed-values(CORPSE_solvers.run_models_ODE(**kwargs()))).max()==0.0
+
+# A batch run that keeps its output in memory is solved in one call without a checkpoint, so the restarts for the
+# checkpoints change its output within the solver tolerances
+def test_checkpoint_restarts_in_memory_batch_run(tmp_path,ckpt_kwargs):
+    plain=CORPSE_solvers.run_models_ODE(**ckpt_kwargs)
+    checkpointed=reference(tmp_path/'ref',ckpt_kwargs)
+    assert numpy.abs(checkpointed-plain).max()<=1e-7*numpy.abs(plain).max()
+
+def test_resume_keeps_other_files(tmp_path,monkeypatch,ckpt_kwargs):
+    (tmp_path/'notes.txt').write_text('not part of the checkpoint')
+    interrupt(monkeypatch,str(tmp_path),**ckpt_kwargs)
+    CORPSE_checkpoint.resume(str(tmp_path))
+    assert sorted(os.listdir(tmp_path))==['notes.txt']
+
+def test_rerun_with_changed_params_is_rejected(tmp_path,monkeypatch,ckpt_kwargs,params):
+    path=str(tmp_path/'ckpt')
+    interrupt(monkeypatch,path,**ckpt_kwargs)
+    changed=copy.deepcopy(params)
+    changed['vmaxref']['MBC_1']['Fast']*=2
+    with pytest.raises(ValueError,match='different arguments'):
+        CORPSE_solvers.run_models_ODE(checkpoint=path,**dict(ckpt_kwargs,params=changed))
+    # The checkpoint of the original run is still there and can be resumed
+    assert CORPSE_checkpoint.checkpoint_time(path) is not None
+    assert numpy.abs(CORPSE_checkpoint.resume(path)-reference(tmp_path/'ref',ckpt_kwargs)).max()==0.0
@@ -0,0 +1,69 @@
+# Disturbance events in run_models_ODE (CORPSE_disturbance), against runs stopped and restarted by hand at the event time
+import copy
+import numpy
+import pytest
+import CORPSE_solvers
+import CORPSE_disturbance
+
+pools=CORPSE_solvers.fields
+times=numpy.arange(0,0.8,1/365)
+fire_time=0.3
+transfers=[('uFastC','CO2',0.6),('uFastC','uPyC',0.1),('MBC_1','uNecroC',0.5),('uSlowC',None,0.2)]
+tolerances=dict(rtol=1e-10,atol=1e-12)
+
+
+@pytest.fixture
+def run(run_kwargs):
+    def run(npoints=1,**kwargs):
+        args=dict(tolerances,times=times)
+        args.update(kwargs)
+        return CORPSE_solvers.run_models_ODE(**run_kwargs(npoints,**args))
+    return run
+
+# One point run to time t, changed by event(state), and continued from there (with params changed by kwargs)
+def restarted(run,t,event,**kwargs):
+    before=run(times=numpy.append(times[times<t],t))[:,0]
+    state=event(before[:,-1].copy())
+    after=run(times=numpy.append(t,times[times>t]),initvals=dict(zip(pools,state)),**kwargs)[:,0]
+    return numpy.concatenate([before[:,:-1],after[:,1:]],axis=1)
+
+def burn(state):
+    pre=state.copy()
+    for source,target,fraction in transfers:
+        state[pools.index(source)]-=fraction*pre[pools.index(source)]
+        if target is not None:
+            state[pools.index(target)]+=fraction*pre[pools.index(source)]
+    return state
+
+
+# The first point burns, the second doesn't
+def test_transfers_match_restart(run):
+    result=run(npoints=2,events=[{'time':[fire_time,numpy.nan],'transfers':transfers}])
+    assert numpy.abs(result[:,0]-restarted(run,fire_time,burn)).max()<=1e-8*numpy.abs(result).max()
+    assert numpy.abs(result[:,1]-run()[:,0]).max()<=1e-8*numpy.abs(result).max()
+
+# Without inputs, total C (with CO2) only changes by the C that the event removes from the system
+def test_transfers_conserve_carbon(run):
+    result=run(events=[{'time':fire_time,'transfers':transfers}])[:,0]
+    total=result.sum(axis=0)
+    before=times<fire_time
+    removed=0.2*run(times=numpy.append(times[before],fire_time))[pools.index('uSlowC'),0,-1]
+    assert numpy.ptp(total[before])<=1e-8*total[0]
+    assert numpy.abs(total[~before]-(total[0]-removed)).max()<=1e-8*total[0]
+
+def test_param_switch_matches_restart(run,params):
+    params_after=copy.deepcopy(params)
+    params_after['vmaxref']['MBC_1']=dict([(k,2*v) for k,v in params_after['vmaxref']['MBC_1'].items()])
+    result=run(npoints=2,events=[{'time':[numpy.nan,0.5],'params':params_after}])
+    assert numpy.abs(result[:,1]-restarted(run,0.5,lambda state: state,params=params_after)).max()<=1e-8*numpy.abs(result).max()
+    assert numpy.abs(result[:,0]-run()[:,0]).max()<=1e-8*numpy.abs(result).max()
+
+# An event at the first output time changes the initial state
+def test_event_at_start(run):
+    result=run(events=[{'time':0.0,'transfers':transfers}])[:,0]
+    initial=run(times=times[:2])[:,0,0]
+    assert numpy.allclose(result[:,0],burn(initial.copy()),rtol=1e-12,atol=0)
+
+def test_fractions_out_of_a_pool_cannot_exceed_one():
+    with pytest.raises(ValueError):
+        CORPSE_disturbance.compile_events([{'time':0.5,'transfers':[('uFastC','CO2',0.7),('uFastC','uPyC',0.4)]}],pools,1)
@@ -0,0 +1,44 @@
+# Parameter ensembles (CORPSE_ensemble.sample_ensemble): reproducible samples, Latin hypercube stratification and ranges
+import numpy
+import pytest
+import CORPSE_ensemble
+
+n=16
+ranges={'vmaxref.MBC_1.Fast':(1.0,20.0),'Tmic.MBC_2':(0.1,1.0),'kC.MBC_1.Slow':(0.001,0.1,'log')}
+
+
+def samples(ensemble):
+    return numpy.array([CORPSE_ensemble.get_param(ensemble,name) for name in ranges]).T
+
+# Position of each sample in its range, from 0 to 1 (in log space for log ranges)
+def unit_position(ensemble):
+    positions=[]
+    for name,vals in zip(ranges,samples(ensemble).T):
+        low,high=ranges[name][0],ranges[name][1]
+        if len(ranges[name])>2:
+            vals,low,high=numpy.log(vals),numpy.log(low),numpy.log(high)
+        positions.append((vals-low)/(high-low))
+    return numpy.array(positions).T
+
+
+@pytest.mark.parametrize('method',['lhs','sobol','random'])
+def test_same_seed_same_ensemble(params,method):
+    first=CORPSE_ensemble.sample_ensemble(params,ranges,n,method=method,seed=5)
+    assert numpy.array_equal(samples(first),samples(CORPSE_ensemble.sample_ensemble(params,ranges,n,method=method,seed=5)))
+    assert not numpy.array_equal(samples(first),samples(CORPSE_ensemble.sample_ensemble(params,ranges,n,method=method,seed=6)))
+    assert CORPSE_ensemble.ensemble_size(first)==n
+
+# A Latin hypercube has exactly one member in each of the n equal slices of every parameter's range
+def test_lhs_stratified(params):
+    position=unit_position(CORPSE_ensemble.sample_ensemble(params,ranges,n,seed=1))
+    assert ((position>=0)&(position<1)).all()
+    for column in position.T:
+        assert sorted(numpy.floor(column*n).astype(int))==list(range(n))
+
+# The base parameters are not changed, and parameters that are not sampled are shared by all members
+def test_ensemble_copies_params(params):
+    ensemble=CORPSE_ensemble.sample_ensemble(params,ranges,n,seed=1)
+    assert numpy.ndim(params['vmaxref']['MBC_1']['Fast'])==0
+    assert ensemble['vmaxref']['MBC_1']['Slow']==params['vmaxref']['MBC_1']['Slow']
+    with pytest.raises(ValueError):
+        CORPSE_ensemble.unit_samples(n,2,method='grid')
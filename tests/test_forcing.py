@@ -0,0 +1,64 @@
+# Tabular climate forcing (CORPSE_forcing) against the cosine annual cycle the solvers use without it
+import pickle
+import numpy
+import pytest
+import CORPSE_forcing
+import CORPSE_solvers
+
+Tmin=numpy.array([18.0,5.0])
+Tmax=numpy.array([24.0,25.0])
+thetamin=numpy.array([0.5,0.3])
+thetamax=numpy.array([0.7,0.6])
+
+
+# Hourly records of the cosine cycle of run_models_ODE, so interpolating them only adds a tiny error
+@pytest.fixture(scope='module')
+def cosine_forcing():
+    times=CORPSE_forcing.record_times(365*24+1,'hourly')
+    cycle=(numpy.cos(times*2*numpy.pi)+1)/2
+    return times,cycle[:,None]*(Tmax-Tmin)+Tmin,cycle[:,None]*(thetamax-thetamin)+thetamin
+
+@pytest.fixture
+def forcing_kwargs(run_kwargs):
+    return run_kwargs(2,Tmin=Tmin,Tmax=Tmax,thetamin=thetamin,thetamax=thetamax,rtol=1e-10,atol=1e-12)
+
+def no_cycle(kwargs,forcing):
+    return dict(kwargs,Tmin=None,Tmax=None,thetamin=None,thetamax=None,forcing=forcing)
+
+
+@pytest.mark.parametrize('solver,method',[('ode','odeint'),('ode','BDF'),('iterator',None)])
+def test_forcing_matches_cosine_cycle(forcing_kwargs,cosine_forcing,solver,method):
+    if solver=='ode':
+        run=lambda **kwargs: CORPSE_solvers.run_models_ODE(method=method,**kwargs)
+    else:
+        run=CORPSE_solvers.run_models_iterator
+    reference=run(**forcing_kwargs)
+    result=run(**no_cycle(forcing_kwargs,CORPSE_forcing.Forcing(*cosine_forcing)))
+    assert numpy.abs(result-reference).max()<=1e-8*numpy.abs(reference).max()
+
+# Linear interpolation between records, for one time for all points or one time per point, and the end values outside the records
+def test_interpolation():
+    forcing=CORPSE_forcing.Forcing(numpy.array([0.0,1.0,2.0]),numpy.array([[0.0,10.0],[2.0,20.0],[6.0,0.0]]),numpy.array([0.2,0.4,0.8]))
+    T,theta=forcing(0.5)
+    assert numpy.allclose(T,[1.0,15.0]) and numpy.allclose(theta,[0.3,0.3])
+    T,theta=forcing(numpy.array([1.25,-1.0]))
+    assert numpy.allclose(T,[3.0,10.0]) and numpy.allclose(theta,[0.5,0.2])
+    T,theta=forcing(5.0,1)
+    assert T==0.0 and theta==0.8
+    # Going back to an earlier time after the cached bracket has moved on
+    assert numpy.allclose(forcing(0.25)[0],[0.5,12.5])
+    with pytest.raises(ValueError):
+        CORPSE_forcing.Forcing(numpy.array([0.0,2.0,1.0]),numpy.zeros(3),numpy.zeros(3))
+
+# Memory-mapped forcing gives the same run, and is pickled by reference to its files (as CORPSE_parallel sends it to workers)
+def test_saved_forcing(forcing_kwargs,cosine_forcing,tmp_path):
+    path=str(tmp_path/'forcing')
+    CORPSE_forcing.save_forcing(path,*cosine_forcing)
+    loaded=CORPSE_forcing.load_forcing(path)
+    assert isinstance(loaded.T,numpy.memmap)
+    kwargs=no_cycle(forcing_kwargs,loaded)
+    assert numpy.array_equal(CORPSE_solvers.run_models_ODE(**kwargs),
+                             CORPSE_solvers.run_models_ODE(**no_cycle(forcing_kwargs,CORPSE_forcing.Forcing(*cosine_forcing))))
+    second=pickle.loads(pickle.dumps(loaded.select(slice(1,2))))
+    assert isinstance(second.T,numpy.memmap)
+    assert numpy.array_equal(second.T[:,0],cosine_forcing[1][:,1])
@@ -0,0 +1,74 @@
+# Solver stats and profiling hooks (CORPSE_instrument) of run_models_ODE and run_models_iterator
+import pstats
+import numpy
+import pytest
+import CORPSE_instrument
+import CORPSE_output
+import CORPSE_solvers
+
+
+@pytest.fixture
+def stats_kwargs(run_kwargs):
+    return run_kwargs(2,Tmin=numpy.array([18.0,5.0]),times=numpy.arange(0,0.2,1/365))
+
+# Replace the solver function name of CORPSE_solvers with a wrapper that counts its calls in calls[name]
+def count_calls(monkeypatch,calls,name):
+    fun=getattr(CORPSE_solvers,name)
+    calls[name]=0
+    def wrapper(*args,**kwargs):
+        calls[name]+=1
+        return fun(*args,**kwargs)
+    monkeypatch.setattr(CORPSE_solvers,name,wrapper)
+
+
+# Derivative and Jacobian calls are counted as the solver makes them, for odeint and for solve_ivp
+@pytest.mark.parametrize('method',['odeint','BDF'])
+def test_call_counts(monkeypatch,stats_kwargs,method):
+    calls={}
+    count_calls(monkeypatch,calls,'ode_wrapper')
+    count_calls(monkeypatch,calls,'ode_jacobian')
+    result,stats=CORPSE_solvers.run_models_ODE(method=method,full_output=True,**stats_kwargs)
+    assert stats['nfev']==calls['ode_wrapper']>0
+    assert stats['njev']==calls['ode_jacobian']
+    assert stats['steps']>0 and stats['rejected'] is None
+
+# Batch runs with a sink, which restart every chunk of output times, add up the counts of every solver call
+def test_batch_counts_add_up(monkeypatch,stats_kwargs):
+    calls={}
+    count_calls(monkeypatch,calls,'batch_ode_wrapper')
+    result,stats=CORPSE_solvers.run_models_ODE(batch=True,sink=CORPSE_output.OutputSink(),chunk_records=20,full_output=True,**stats_kwargs)
+    assert len(stats['solves'])==4
+    assert stats['nfev']==sum([s['nfev'] for s in stats['solves']])==calls['batch_ode_wrapper']
+    assert stats['steps']==sum([s['steps'] for s in stats['solves']])
+
+# solve_ivp doesn't report its steps, so they are counted. Its dense output has one interpolant per accepted step
+@pytest.mark.parametrize('method,jac',[('RK45',False),('BDF',True),('Radau',True)])
+def test_solve_ivp_steps(method,jac):
+    from scipy.integrate import solve_ivp
+    rates=numpy.array([1.0,50.0])
+    fun=lambda y,t: -rates*y
+    jacfun=lambda y,t: numpy.diag(-rates)
+    times=numpy.linspace(0,2,11)
+    stats=CORPSE_instrument.new_stats()
+    CORPSE_solvers.integrate_ODE(fun,jacfun,numpy.ones(2),times,(),method=method,jac=jac,stats=stats)
+    options={'jac':lambda t,y: jacfun(y,t)} if jac else {}
+    sol=solve_ivp(lambda t,y: fun(y,t),(0,2),numpy.ones(2),method=method,dense_output=True,**options)
+    assert stats['steps']==len(sol.sol.ts)-1
+
+# The iterator reports its rejected steps, in total and for each point
+def test_iterator_rejected_steps(stats_kwargs):
+    result,stats=CORPSE_solvers.run_models_iterator(full_output=True,first_step=0.1,**stats_kwargs)
+    assert stats['rejected']==stats['point_rejected'].sum()>0
+    assert stats['steps']==stats['point_steps'].sum()
+
+def test_trace_memory(stats_kwargs):
+    result,stats=CORPSE_solvers.run_models_ODE(full_output=True,**stats_kwargs)
+    assert 'peak_memory' not in stats
+    result,stats=CORPSE_solvers.run_models_ODE(full_output=True,trace_memory=True,**stats_kwargs)
+    assert stats['peak_memory']>0
+
+def test_profile_file(stats_kwargs,tmp_path):
+    path=str(tmp_path/'run.prof')
+    result,stats=CORPSE_solvers.run_models_ODE(full_output=True,profile=path,**stats_kwargs)
+    profile=pstats.Stats(path)
+    assert any([name[2]=='integrate_ODE' for name in profile.stats])
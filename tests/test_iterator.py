@@ -0,0 +1,37 @@
+# run_models_iterator (adaptive Dormand-Prince 5(4) steps with dense output) against a tight-tolerance odeint run
+import numpy
+import pytest
+import CORPSE_solvers
+import CORPSE_output
+
+npoints=3
+
+
+# Points with different temperature cycles and C inputs, so they take their own step sizes
+@pytest.fixture
+def iterator_kwargs(run_kwargs):
+    return run_kwargs(npoints,Tmin=numpy.array([18.0,10.0,5.0]),Tmax=numpy.array([24.0,20.0,25.0]),inputs={'uFastC':0.5})
+
+@pytest.fixture
+def reference(iterator_kwargs):
+    return CORPSE_solvers.run_models_ODE(rtol=1e-12,atol=1e-14,**iterator_kwargs)
+
+def relative_difference(a,b):
+    return numpy.abs(a-b).max()/numpy.abs(b).max()
+
+
+@pytest.mark.parametrize('rtol,atol,limit',[(1e-6,1e-8,1e-7),(1e-8,1e-10,1e-8)])
+def test_iterator_matches_odeint(iterator_kwargs,reference,rtol,atol,limit):
+    result,stats=CORPSE_solvers.run_models_iterator(rtol=rtol,atol=atol,full_output=True,**iterator_kwargs)
+    assert result.shape==reference.shape
+    assert numpy.array_equal(result[:,:,0],reference[:,:,0])
+    assert relative_difference(result,reference)<=limit
+    assert len(stats['point_steps'])==npoints and (stats['point_steps']>0).all()
+
+# Output windows of a few records end steps at the window boundaries, written to the sink as each window finishes
+def test_iterator_sink_chunks(iterator_kwargs,reference):
+    sink=CORPSE_output.OutputSink()
+    SOM=CORPSE_solvers.run_models_iterator(rtol=1e-8,atol=1e-10,sink=sink,chunk_records=7,**iterator_kwargs)
+    assert list(SOM.keys())==list(CORPSE_solvers.fields)
+    assert numpy.array_equal(sink.times,iterator_kwargs['times'])
+    assert relative_difference(numpy.array([SOM[p] for p in CORPSE_solvers.fields]),reference)<=1e-8
@@ -0,0 +1,109 @@
+# Analytical Jacobian (CORPSE_array.CORPSE_jacobian_array) against central differences of CORPSE_deriv_array
+import os
+import json
+import numpy
+import pytest
+import CORPSE_array
+import CORPSE_ensemble
+import CORPSE_kernel
+import CORPSE_solvers
+import Whitman_sims
+
+
+def numerical_jacobian(SOM,T,theta,model,claymod):
+    J=numpy.zeros((SOM.shape[0],SOM.shape[0],SOM.shape[1]))
+    for j in range(SOM.shape[0]):
+        h=1e-6*numpy.maximum(1.0,numpy.abs(SOM[j]))
+        up=SOM.copy()
+        up[j]+=h
+        down=SOM.copy()
+        down[j]-=h
+        J[:,j]=(CORPSE_array.CORPSE_deriv_array(up,T,theta,model,claymod)-CORPSE_array.CORPSE_deriv_array(down,T,theta,model,claymod))/(2*h)
+    return J
+
+# Random states around the Whitman initial values, at different temperatures, moistures and clay
+# Points with zero pools: empty microbial groups and protected pools (as in Whitman_sims), a group with no biomass among
+# others, all microbes dead, no unprotected C, and dry and saturated soil (no decomposition)
+def states(model,initvals,npoints=12,seed=0):
+    rng=numpy.random.default_rng(seed)
+    pools=model['pools']
+    SOM=rng.uniform(0.01,2.0,(len(pools),npoints))
+    SOM[pools.index('CO2')]=0.0
+    T=rng.uniform(273.15,313.15,npoints)
+    theta=rng.uniform(0.05,0.95,npoints)
+    claymod=rng.uniform(0.5,2.0,npoints)
+    microbes=[pools.index(m) for m in model['microbial_pools']]
+    unprotected=list(range(model['nchem']))
+    protected=list(range(model['nchem'],model['nchem']+model['nprot']))
+    initial=CORPSE_array.pack_pools(initvals,pools)[:,0]
+    SOM[initial==0,0]=0.0
+    SOM[microbes[0],1]=0.0
+    SOM[microbes,2]=0.0
+    SOM[unprotected,3]=0.0
+    SOM[protected,4]=0.0
+    theta[5]=0.0
+    theta[6]=1.0
+    # Microbial turnover stops where biomass is below minMicrobeC of the unprotected C
+    SOM[microbes,7]=1e-3
+    return SOM,T,theta,claymod
+
+def check(model,initvals,seed=0):
+    SOM,T,theta,claymod=states(model,initvals,seed=seed)
+    J=CORPSE_array.CORPSE_jacobian_array(SOM,T,theta,model,claymod=claymod)
+    assert J.shape==(len(model['pools']),len(model['pools']),SOM.shape[1])
+    assert numpy.abs(J-numerical_jacobian(SOM,T,theta,model,claymod)).max()<=1e-6*numpy.abs(J).max()
+    # The kernel backend has the same branches
+    Jk=CORPSE_kernel.kernel_jacobian(SOM,T,theta,model,claymod,CORPSE_kernel.jacobian_points)
+    assert numpy.abs(Jk-J).max()<=1e-12*numpy.abs(J).max()
+
+
+@pytest.mark.parametrize('seed',[0,1,2])
+def test_jacobian(params,initvals,seed):
+    check(CORPSE_array.get_model(params),initvals,seed)
+
+def test_jacobian_pruned(params,initvals):
+    model=CORPSE_array.get_model(params)
+    pruned=CORPSE_array.prune_model(model,CORPSE_array.pack_pools(initvals,model['pools']))
+    assert pruned['nmic']<model['nmic'] and pruned['nprot']<model['nprot']
+    check(pruned,initvals)
+
+def test_jacobian_ensemble(params,initvals):
+    ensemble=CORPSE_ensemble.sample_ensemble(params,{'vmaxref.MBC_1.Fast':(1.0,20.0),'kC.MBC_2.Slow':(0.005,0.05),'eup.MBC_1.Slow':(0.1,0.6),
+                                                     'Ea.Fast':(3e4,6e4),'protection_rate.Slow':(0.0,0.01),'minMicrobeC.MBC_2':(1e-4,1e-2),
+                                                     'Tmic.MBC_1':(0.1,1.0),'et.MBC_2':(0.3,0.9),'tProtected':(50.0,100.0)},12,seed=3)
+    check(CORPSE_array.get_model(ensemble),initvals)
+
+# One point as a one-dimensional state gives a (n_pools, n_pools) Jacobian
+def test_jacobian_single_point(params,initvals):
+    model=CORPSE_array.get_model(params)
+    SOM,T,theta,claymod=states(model,initvals)
+    J=CORPSE_array.CORPSE_jacobian_array(SOM[:,8],T[8],theta[8],model,claymod=claymod[8])
+    assert numpy.allclose(J,CORPSE_array.CORPSE_jacobian_array(SOM,T,theta,model,claymod=claymod)[:,:,8],rtol=1e-12,atol=0)
+
+# BDF and Radau evaluate the Jacobian of the batched system whenever they refresh it. Without the analytical Jacobian each of
+# those takes a finite difference estimate with one model evaluation per state variable, so the run needs several times
+# as many evaluations, for the same result
+@pytest.mark.parametrize('method',['BDF','Radau'])
+def test_jacobian_saves_evaluations(run_kwargs,method):
+    npoints=10
+    args=run_kwargs(npoints,Tmin=numpy.linspace(5,25,npoints),Tmax=30.0,times=numpy.arange(0,2,1/365),batch=True,method=method,full_output=True)
+    analytical,stats=CORPSE_solvers.run_models_ODE(jac=True,**args)
+    numerical,stats_fd=CORPSE_solvers.run_models_ODE(jac=False,**args)
+    assert stats['njev']>0
+    assert stats['nfev']<stats_fd['nfev']/2
+    assert numpy.abs(analytical-numerical).max()<=1e-6*numpy.abs(analytical).max()
+
+# The Whitman_sims incubations (script and configuration file) use a backend that calls the analytical Jacobian, and need fewer
+# derivative calls than odeint, which never uses it for them
+def test_whitman_solver_options(scenario):
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Whitman_sims.json')) as f:
+        assert json.load(f)['defaults']['solver_options']==Whitman_sims.solver_options
+    args=dict(Tmin=18.0,Tmax=24.0,thetamin=Whitman_sims.envir_params[scenario]['thetamin'],thetamax=Whitman_sims.envir_params[scenario]['thetamax'],
+              times=Whitman_sims.t,inputs={},clay=2.5,initvals=Whitman_sims.initvals[scenario],params=Whitman_sims.paramsets[scenario],
+              output='array',full_output=True)
+    result,stats=CORPSE_solvers.run_models_ODE(**dict(args,**Whitman_sims.solver_options))
+    baseline,stats_odeint=CORPSE_solvers.run_models_ODE(method='odeint',**args)
+    assert stats_odeint['njev']==0
+    assert stats['njev']>0
+    assert stats['nfev']<stats_odeint['nfev']
+    assert numpy.abs(result-baseline).max()<=1e-5*numpy.abs(baseline).max()
@@ -0,0 +1,105 @@
+# The fused kernels (CORPSE_kernel) against the NumPy model functions (CORPSE_array)
+# Without Numba the kernels run as plain Python, so the comparison runs either way; the compiled kernels need Numba
+import numpy
+import pytest
+import CORPSE_array
+import CORPSE_kernel
+import CORPSE_ensemble
+
+npoints=20
+
+
+# Default model (with empty microbial groups), an ensemble with different parameters at every point, and a pruned model
+@pytest.fixture(params=['default','ensemble','pruned'])
+def model(request,params,initvals):
+    if request.param=='ensemble':
+        params=CORPSE_ensemble.sample_ensemble(params,{'vmaxref.MBC_1.Fast':(1.0,20.0),'kC.MBC_2.Slow':(0.005,0.05),'Tmic.MBC_1':(0.1,1.0),
+                                                       'protection_rate.Fast':(0.0,0.01),'et.MBC_2':(0.3,0.9)},npoints,seed=1)
+    model=CORPSE_array.get_model(params)
+    if request.param=='pruned':
+        model=CORPSE_array.prune_model(model,CORPSE_array.pack_pools(initvals,model['pools']))
+        assert len(model['pools'])<len(CORPSE_array.state_pools)
+    return model
+
+@pytest.fixture
+def restore_backend():
+    yield
+    CORPSE_kernel.set_backend('auto')
+
+
+def test_kernels_match_numpy(model,initvals):
+    diff=CORPSE_kernel.compare_backends(model,initvals,npoints=npoints)
+    assert diff['deriv']<1e-12
+    assert diff['jacobian']<1e-12
+
+def test_numba_backend_matches_numpy(model,initvals,restore_backend):
+    pytest.importorskip('numba')
+    CORPSE_kernel.set_backend('numba')
+    assert CORPSE_kernel.active_backend()=='numba'
+    rng=numpy.random.default_rng(0)
+    SOM=CORPSE_array.pack_pools(initvals,model['pools'])[:,[0]*npoints]*rng.uniform(0.5,1.5,(len(model['pools']),npoints))
+    T=rng.uniform(273.15,313.15,npoints)
+    theta=rng.uniform(0.0,1.0,npoints)
+    D=CORPSE_array.CORPSE_deriv_array(SOM,T,theta,model,claymod=1.3)
+    J=CORPSE_array.CORPSE_jacobian_array(SOM,T,theta,model,claymod=1.3)
+    assert numpy.abs(CORPSE_kernel.deriv(SOM,T,theta,model,claymod=1.3)-D).max()<=1e-12*numpy.abs(D).max()
+    assert numpy.abs(CORPSE_kernel.jacobian(SOM,T,theta,model,claymod=1.3)-J).max()<=1e-12*numpy.abs(J).max()
+
+def test_set_backend_round_trip(params,initvals,restore_backend):
+    model=CORPSE_array.get_model(params)
+    SOM=CORPSE_array.pack_pools(initvals,model['pools'])
+    CORPSE_kernel.set_backend('numpy')
+    assert CORPSE_kernel.active_backend()=='numpy'
+    assert numpy.array_equal(CORPSE_kernel.deriv(SOM,293.15,0.6,model),CORPSE_array.CORPSE_deriv_array(SOM,293.15,0.6,model))
+    CORPSE_kernel.set_backend('auto')
+    assert CORPSE_kernel.active_backend()==('numpy' if CORPSE_kernel.numba is None else 'numba')
+    with pytest.raises(ValueError):
+        CORPSE_kernel.set_backend('fortran')
+    if CORPSE_kernel.numba is None:
+        with pytest.raises(ImportError):
+            CORPSE_kernel.set_backend('numba')
+
+# Like NumPy broadcasting, a single state column is used for every point, but other mismatches are errors
+def test_kernel_point_counts(params,initvals):
+    model=CORPSE_array.get_model(params)
+    SOM=CORPSE_array.pack_pools(initvals,model['pools'])
+    T=numpy.linspace(280,300,5)
+    expected=CORPSE_array.CORPSE_deriv_array(SOM,T,0.6,model)
+    assert numpy.allclose(CORPSE_kernel.kernel_deriv(SOM,T,0.6,model,1.0,CORPSE_kernel.deriv_points),expected,rtol=1e-12,atol=0)
+    for function,kernel in ((CORPSE_kernel.kernel_deriv,CORPSE_kernel.deriv_points),(CORPSE_kernel.kernel_jacobian,CORPSE_kernel.jacobian_points)):
+        with pytest.raises(ValueError):
+            function(SOM[:,[0,0,0]],T,0.6,model,1.0,kernel)
+
+# vmax as the kernels calculated it inline before they used the temperature response memo (CORPSE_array.temperature_response)
+def inline_vmax(model,T):
+    Rugas=8.314472
+    return model['vmaxref']*numpy.exp(-model['Ea']*(1.0/(Rugas*numpy.atleast_1d(T))-1.0/(Rugas*293.15)))
+
+# The memoized temperature response gives the same rates of change as calculating it on every call, whether the memo is
+# empty or already holds the temperature, with one temperature for all points or one per point
+@pytest.mark.parametrize('T',[293.15,numpy.linspace(275,305,npoints)])
+def test_kernel_temperature_memo(model,initvals,T):
+    rng=numpy.random.default_rng(3)
+    SOM=CORPSE_array.pack_pools(initvals,model['pools'])[:,[0]*npoints]*rng.uniform(0.5,1.5,(len(model['pools']),npoints))
+    theta=rng.uniform(0.0,1.0,npoints)
+    claymod=numpy.full(npoints,1.3)
+    expected=numpy.empty(SOM.shape)
+    CORPSE_kernel.deriv_points(SOM,numpy.ascontiguousarray(inline_vmax(model,T)),theta,claymod,*CORPSE_kernel.kernel_params(model),expected)
+    CORPSE_array.clear_cache(model)
+    cold=CORPSE_kernel.kernel_deriv(SOM,T,theta,model,claymod,CORPSE_kernel.deriv_points)
+    assert len(model['Tcache'])==1
+    warm=CORPSE_kernel.kernel_deriv(SOM,T,theta,model,claymod,CORPSE_kernel.deriv_points)
+    assert numpy.array_equal(cold,warm)
+    assert numpy.abs(cold-expected).max()<=1e-14*numpy.abs(expected).max()
+    assert numpy.allclose(CORPSE_array.temperature_response(T,model),inline_vmax(model,T),rtol=1e-15,atol=0)
+
+# The legacy dictionary function gives the same values from the memo
+def test_legacy_vmax(params):
+    model=CORPSE_array.get_model(params)
+    for T in (283.15,numpy.array([275.0,290.0,300.0])):
+        vmax=inline_vmax(model,T)
+        for m,pool in enumerate(CORPSE_array.microbial_pools):
+            V=CORPSE_array.Vmax(pool,T,params)
+            for c,t in enumerate(CORPSE_array.chem_types):
+                assert numpy.shape(V[t])==numpy.shape(T)
+                assert numpy.allclose(V[t],vmax[m,c] if numpy.ndim(T) else vmax[m,c,0],rtol=1e-15,atol=0)
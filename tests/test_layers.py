@@ -0,0 +1,64 @@
+# Multi-layer soil columns (CORPSE_layers) in run_models_ODE
+import numpy
+import pytest
+import CORPSE_array
+import CORPSE_solvers
+import CORPSE_layers
+
+nlayers=3
+ncolumns=2
+npoints=nlayers*ncolumns
+transport={'advection':{'uFastC':0.5,'uNecroC':0.3},'diffusion':{'uSlowC':0.2,'pSlowC':0.1,'uFastC':0.05}}
+
+
+# Layers get cooler, wetter, more clayey and have less C with depth
+@pytest.fixture
+def column_kwargs(run_kwargs,initvals):
+    T=numpy.tile([22.0,19.0,16.0],ncolumns)
+    theta=numpy.tile([0.4,0.55,0.7],ncolumns)
+    initvals=dict([(k,numpy.tile([1.0,0.5,0.2],ncolumns)*v) for k,v in initvals.items()])
+    return run_kwargs(npoints,Tmin=T-3,Tmax=T+3,thetamin=theta,thetamax=theta,clay=numpy.tile([2.5,10.0,20.0],ncolumns),initvals=initvals,
+                      rtol=1e-10,atol=1e-12)
+
+
+# With a closed bottom and no inputs, transport only moves C around the column, so its total C (with CO2) stays the same
+def test_closed_column_conserves_carbon(column_kwargs):
+    result=CORPSE_solvers.run_models_ODE(layers=nlayers,transport=dict(transport,bottom='closed'),**column_kwargs)
+    total=CORPSE_layers.column_totals(result,nlayers).sum(axis=0)
+    assert numpy.abs(total-total[:,:1]).max()<=1e-8*total.max()
+
+# An open bottom only loses C
+def test_open_column_loses_carbon(column_kwargs):
+    result=CORPSE_solvers.run_models_ODE(layers=nlayers,transport=transport,**column_kwargs)
+    total=CORPSE_layers.column_totals(result,nlayers).sum(axis=0)
+    assert (numpy.diff(total,axis=1)<=1e-10*total.max()).all()
+    assert (total[:,-1]<total[:,0]).all()
+
+# Layers without transport are independent points
+def test_zero_transport_matches_independent_points(column_kwargs):
+    columns=CORPSE_solvers.run_models_ODE(layers=nlayers,transport={'bottom':'closed'},**column_kwargs)
+    points=CORPSE_solvers.run_models_ODE(batch=True,**column_kwargs)
+    assert numpy.abs(columns-points).max()<=1e-8*numpy.abs(points).max()
+
+# Jacobian of the stacked columns (model blocks plus transport coupling), in sparse and banded form, against central differences
+def test_column_jacobian(column_kwargs):
+    args=column_kwargs
+    model=CORPSE_array.get_model(args['params'])
+    compiled=CORPSE_layers.compile_transport(transport,model['pools'],nlayers)
+    state=CORPSE_array.pack_pools(args['initvals'],model['pools']).T.ravel()+0.01
+    wrapper_args=(args['Tmax']+273.15,args['Tmin']+273.15,args['thetamax'],args['thetamin'],
+                  CORPSE_layers.pack_inputs({},model['pools'],nlayers,npoints),CORPSE_array.clay_modifier(args['clay']),model,compiled)
+    deriv=lambda y: CORPSE_solvers.batch_ode_wrapper(y,0.3,*wrapper_args)
+    h=1e-6
+    numerical=numpy.array([(deriv(state+h*e)-deriv(state-h*e))/(2*h) for e in numpy.eye(len(state))]).T
+    blocks=CORPSE_solvers.batch_ode_jacobian(state,0.3,*wrapper_args)
+    coupling=CORPSE_layers.transport_jacobian(compiled,npoints)
+    sparse=CORPSE_solvers.block_jacobian(blocks,'sparse',coupling).toarray()
+    assert numpy.abs(sparse-numerical).max()<=1e-6*numpy.abs(numerical).max()
+    banded=CORPSE_solvers.block_jacobian(blocks,'banded',coupling)
+    band=len(model['pools'])
+    index=numpy.arange(len(state))
+    distance=numpy.abs(numpy.subtract.outer(index,index))
+    rows,cols=numpy.nonzero(distance<=band)
+    assert numpy.array_equal(banded[rows-cols+band,cols],sparse[rows,cols])
+    assert (sparse[distance>band]==0).all()
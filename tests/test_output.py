@@ -0,0 +1,52 @@
+# Output sinks (CORPSE_output) against the full output of run_models_ODE(output='array')
+import numpy
+import pytest
+import CORPSE_solvers
+import CORPSE_output
+
+npoints=3
+every=5
+pools=['CO2','uFastC','MBC_3']
+
+
+@pytest.fixture
+def output_kwargs(run_kwargs):
+    return run_kwargs(npoints,Tmin=numpy.array([18.0,10.0,5.0]),inputs={'uFastC':0.5})
+
+@pytest.fixture
+def full_output(output_kwargs):
+    return CORPSE_solvers.run_models_ODE(**output_kwargs)
+
+def expected(full_output,pool):
+    return full_output[CORPSE_solvers.fields.index(pool)][:,::every]
+
+
+# chunk_records is not a multiple of every, so kept records fall at different places in each chunk
+@pytest.mark.parametrize('chunk_records',[50,1000])
+def test_npy_sink_matches_array(output_kwargs,full_output,tmp_path,chunk_records):
+    path=str(tmp_path/'out')
+    sink=CORPSE_output.NpyOutputSink(path,pools=pools,every=every)
+    SOM=CORPSE_solvers.run_models_ODE(sink=sink,chunk_records=chunk_records,**output_kwargs)
+    loaded=CORPSE_output.load_output(path)
+    assert sorted(loaded.keys())==sorted(pools)
+    assert numpy.array_equal(CORPSE_output.load_times(path),output_kwargs['times'][::every])
+    for p in pools:
+        assert loaded[p].shape==(npoints,len(output_kwargs['times'][::every]))
+        numpy.testing.assert_allclose(loaded[p],expected(full_output,p),rtol=1e-12,atol=1e-14)
+        assert numpy.array_equal(SOM[p],loaded[p])
+    # MBC_3 starts empty and is pruned from the run, so its output stays zero
+    assert (loaded['MBC_3']==0).all()
+    # A subset of the points, as when working through output that doesn't fit in memory
+    subset=CORPSE_output.load_output(path,points=slice(1,3))
+    assert numpy.array_equal(subset['CO2'],loaded['CO2'][1:3])
+
+def test_memory_sink_matches_array(output_kwargs,full_output):
+    sink=CORPSE_output.OutputSink(pools=pools,every=every)
+    SOM=CORPSE_solvers.run_models_ODE(sink=sink,chunk_records=50,**output_kwargs)
+    assert numpy.array_equal(sink.times,output_kwargs['times'][::every])
+    for p in pools:
+        numpy.testing.assert_allclose(SOM[p],expected(full_output,p),rtol=1e-12,atol=1e-14)
+
+def test_sink_unknown_pool(output_kwargs):
+    with pytest.raises(ValueError):
+        CORPSE_solvers.run_models_ODE(sink=CORPSE_output.OutputSink(pools=['CO2','no such pool']),**output_kwargs)
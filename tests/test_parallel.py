@@ -0,0 +1,61 @@
+# Scenarios run on worker processes (CORPSE_parallel, CORPSE_run.run_config): a worker that dies only fails its own scenario
+import multiprocessing
+import os
+import numpy
+import pytest
+import CORPSE_array
+import CORPSE_parallel
+import CORPSE_run
+import CORPSE_solvers
+
+# The crashing solver is patched into this process, so the workers have to be forked from it
+pytestmark=pytest.mark.skipif(multiprocessing.get_start_method()!='fork',reason='needs worker processes started by fork')
+
+crash_clay=99.0
+
+
+# run_models_ODE, except that the worker process exits without a Python exception when clay is crash_clay (like being killed)
+@pytest.fixture
+def crashing_solver(monkeypatch):
+    run_models_ODE=CORPSE_solvers.run_models_ODE
+    def run(**kwargs):
+        if numpy.any(numpy.asarray(kwargs['clay'])==crash_clay):
+            os._exit(1)
+        return run_models_ODE(**kwargs)
+    monkeypatch.setattr(CORPSE_solvers,'run_models_ODE',run)
+
+def envir(clay):
+    return {'Tmin':18.0,'Tmax':24.0,'thetamin':0.5,'thetamax':0.7,'clay':clay,'inputs':{}}
+
+
+def test_scenarios_survive_worker_crash(crashing_solver,params,initvals):
+    times=numpy.arange(0,0.1,1/365)
+    clays=[2.5,crash_clay,5.0,10.0,20.0]
+    scenarios=dict([('clay %g'%clay,(initvals,params,envir(clay),times)) for clay in clays])
+    results,errors=CORPSE_parallel.run_scenarios(scenarios,nworkers=2,output='array')
+    assert list(errors.keys())==['clay %g'%crash_clay]
+    assert list(results.keys())==['clay %g'%clay for clay in clays if clay!=crash_clay]
+    for clay in [2.5,20.0]:
+        direct=CORPSE_solvers.run_models_ODE(times=times,params=params,initvals=initvals,output='array',**envir(numpy.array([clay])))
+        assert numpy.array_equal(results['clay %g'%clay],direct)
+
+def test_run_config_survives_worker_crash(crashing_solver,params,initvals,tmp_path):
+    scenario={'initvals':initvals,'params':params,'times':{'start':0,'stop':0.05,'step':1/365}}
+    config={'scenarios':{'ok':dict(scenario,envir=envir(2.5)),'crash':dict(scenario,envir=envir(crash_clay)),
+                         'ok too':dict(scenario,envir=envir(5.0))}}
+    outcomes=CORPSE_run.run_config(config,str(tmp_path),workers=3)
+    assert outcomes['ok'][0]=='ok' and outcomes['ok too'][0]=='ok'
+    assert outcomes['crash'][0]=='error' and 'BrokenProcessPool' in outcomes['crash'][1]
+    assert os.path.exists(os.path.join(str(tmp_path),'ok_too','stats.json'))
+
+# Tasks carry the compiled model without the memos that runs in this process have filled in
+def test_tasks_leave_out_memos(params,initvals):
+    model=CORPSE_array.get_model(params)
+    CORPSE_solvers.run_models_ODE(times=numpy.arange(0,0.05,1/365),params=model,initvals=initvals,output='array',**envir(2.5))
+    filled=[k for k in CORPSE_array.memo_keys if len(model[k])>0]
+    assert len(filled)>0
+    ivals,packed,packed_envir,times=CORPSE_parallel.pack_scenario(initvals,model,envir(2.5),numpy.arange(0,0.05,1/365))
+    assert all([packed[k]=={} for k in CORPSE_array.memo_keys])
+    assert all([packed[k] is model[k] for k in CORPSE_array.ensemble_params])
+    # The model of this process keeps its memos
+    assert all([len(model[k])>0 for k in filled])
@@ -0,0 +1,92 @@
+# Columnar results (CORPSE_results.Results) against the array and DataFrame output of run_models_ODE
+import numpy
+import pandas
+import pytest
+import CORPSE_array
+import CORPSE_results
+import CORPSE_solvers
+
+npoints=3
+
+
+@pytest.fixture
+def results_kwargs(run_kwargs):
+    return run_kwargs(npoints,Tmin=numpy.array([18.0,10.0,5.0]),inputs={'uFastC':0.5},times=numpy.arange(0,0.2,1/365))
+
+@pytest.fixture
+def array(results_kwargs):
+    return CORPSE_solvers.run_models_ODE(**results_kwargs)
+
+@pytest.fixture
+def results(results_kwargs):
+    return CORPSE_solvers.run_models_ODE(**dict(results_kwargs,output='results'))
+
+
+# Pools are (n_points, n_times) views of the result array, and integers select one point
+def test_indexing(results,array):
+    assert numpy.array_equal(results.values,array)
+    assert results.shape==array.shape and results.npoints==npoints
+    assert list(results.keys())==list(CORPSE_solvers.fields) and 'CO2' in results and len(results)==len(CORPSE_solvers.fields)
+    n=CORPSE_solvers.fields.index('uSlowC')
+    assert numpy.shares_memory(results['uSlowC'],results.values)
+    assert numpy.array_equal(results['uSlowC'],array[n])
+    assert numpy.array_equal(results[1]['uSlowC'],array[n,1])
+    with pytest.raises(KeyError):
+        results['no such pool']
+    subset=results.select(slice(1,3))
+    assert numpy.shares_memory(subset.values,results.values)
+    assert numpy.array_equal(subset['CO2'],array[-1,1:3]) and list(subset.points)==[1,2]
+    assert numpy.array_equal(results.select(2)['CO2'],array[-1,2:3])
+
+# The vectorized sums agree with the dictionary functions, which work on Results as they do on dictionaries of pools
+def test_carbon_sums(results,array):
+    total=CORPSE_solvers.totalCarbon(results,CORPSE_array.microbial_pools)
+    assert numpy.allclose(results.total_carbon(),total,rtol=1e-14,atol=0)
+    assert numpy.allclose(results.sum_ctypes('u'),CORPSE_array.sumCtypes(results,'u'),rtol=1e-14,atol=0)
+    assert numpy.allclose(results.sum_ctypes('p'),array[[CORPSE_solvers.fields.index('p'+t+'C') for t in CORPSE_array.chem_types]].sum(axis=0),
+                          rtol=1e-14,atol=0)
+
+def test_flux(results,array,results_kwargs):
+    times=results_kwargs['times']
+    CO2=array[-1]
+    flux=results.flux()
+    assert numpy.isnan(flux[:,0]).all()
+    assert numpy.allclose(flux[:,1:],(CO2[:,1:]-CO2[:,:-1])/(times[1:]-times[:-1]),rtol=1e-12,atol=0)
+    initial=results.total_carbon()[:,0]
+    assert numpy.allclose(results.flux('CO2',relative_to=initial)[:,1:],flux[:,1:]/initial[:,None],rtol=1e-14,atol=0)
+
+# DataFrames are the default output of the solvers, and the same as Results.to_dataframes
+def test_dataframes(results,results_kwargs):
+    default=CORPSE_solvers.run_models_ODE(**dict(results_kwargs,output='dataframes'))
+    del results_kwargs['output']
+    assert isinstance(CORPSE_solvers.run_models_ODE(**results_kwargs),list)
+    converted=results.to_dataframes()
+    assert len(default)==len(converted)==npoints
+    for a,b in zip(default,converted):
+        assert isinstance(a,pandas.DataFrame)
+        pandas.testing.assert_frame_equal(a,b)
+    assert numpy.array_equal(default[2]['CO2'].values,results[2]['CO2'])
+
+@pytest.mark.parametrize('dtype,compress',[(None,False),(None,True),('float32',False)])
+def test_save_load(results,tmp_path,dtype,compress):
+    path=str(tmp_path/'results.npz')
+    results=CORPSE_results.Results(results.values,results.pools,results.times,points=['a','b','c'])
+    results.save(path,dtype=dtype,compress=compress)
+    loaded=CORPSE_results.load_results(path)
+    assert loaded.pools==results.pools and list(loaded.points)==['a','b','c']
+    assert numpy.array_equal(loaded.times,results.times)
+    if dtype is None:
+        assert numpy.array_equal(loaded.values,results.values)
+    else:
+        assert loaded.values.dtype==numpy.float32
+        assert numpy.allclose(loaded.values,results.values,rtol=1e-7,atol=0)
+
+def test_concatenate(results):
+    joined=CORPSE_results.concatenate([results.select(slice(0,1)),results.select(slice(1,3))])
+    assert numpy.array_equal(joined.values,results.values)
+    assert list(joined.points)==[0,1,2]
+    shorter=CORPSE_results.Results(results.values[:,:,:-1],results.pools,results.times[:-1])
+    with pytest.raises(ValueError):
+        CORPSE_results.concatenate([results,shorter])
+    with pytest.raises(ValueError):
+        CORPSE_results.Results(results.values[0],results.pools,results.times)
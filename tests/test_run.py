@@ -0,0 +1,88 @@
+# Command line runs of configuration files (CORPSE_run) against running the same scenarios directly
+import os
+import sys
+import json
+import numpy
+import pytest
+import CORPSE_output
+import CORPSE_run
+import CORPSE_solvers
+
+config_file=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'Whitman_sims.json')
+
+
+# The scenario of the config file run directly with run_models_ODE (as CORPSE_results.Results)
+def direct_run(name):
+    scenario=CORPSE_run.get_scenarios(CORPSE_run.load_config(config_file))[name]
+    envir=scenario['envir']
+    return CORPSE_solvers.run_models_ODE(Tmin=envir['Tmin'],Tmax=envir['Tmax'],thetamin=envir['thetamin'],thetamax=envir['thetamax'],
+                                        times=CORPSE_run.make_times(scenario['times']),inputs=envir['inputs'],
+                                        params=CORPSE_run.make_params(scenario['params']),clay=envir['clay'],
+                                        initvals=scenario['initvals'],output='results',**scenario['solver_options'])
+
+def test_main_npy(tmp_path,scenario):
+    out=str(tmp_path)
+    assert CORPSE_run.main([config_file,'--out',out])==0
+    config=CORPSE_run.load_config(config_file)
+    assert sorted(os.listdir(out))==sorted([CORPSE_run.scenario_dir(name) for name in config['scenarios']])
+    path=os.path.join(out,CORPSE_run.scenario_dir(scenario))
+    SOM=CORPSE_output.load_output(path)
+    reference=direct_run(scenario)
+    assert numpy.array_equal(CORPSE_output.load_times(path),reference.times)
+    assert sorted(SOM.keys())==sorted(CORPSE_solvers.fields)
+    for pool in SOM:
+        assert numpy.array_equal(SOM[pool],reference[pool])
+    with open(os.path.join(path,'stats.json')) as f:
+        stats=json.load(f)
+    assert stats['nfev']>0 and stats['njev']>0 and stats['steps']>0
+    assert not os.path.exists(os.path.join(path,'plot.png'))
+
+def test_main_csv(tmp_path,scenario):
+    out=str(tmp_path)
+    assert CORPSE_run.main([config_file,'--out',out,'--scenario',scenario,'--format','csv'])==0
+    path=os.path.join(out,CORPSE_run.scenario_dir(scenario))
+    assert sorted(os.listdir(path))==['point_0.csv','stats.json']
+    table=numpy.genfromtxt(os.path.join(path,'point_0.csv'),delimiter=',',names=True)
+    reference=direct_run(scenario)
+    assert numpy.allclose(table['time'],reference.times,rtol=1e-15,atol=0)
+    assert numpy.allclose(table['CO2'],reference[0]['CO2'],rtol=1e-15,atol=0)
+
+# Without matplotlib, --plot only logs a warning: the output is written and the scenario doesn't fail
+def test_plot_without_matplotlib(tmp_path,scenario,monkeypatch,caplog):
+    monkeypatch.setitem(sys.modules,'matplotlib',None)
+    assert CORPSE_run.main([config_file,'--out',str(tmp_path),'--scenario',scenario,'--plot'])==0
+    path=os.path.join(str(tmp_path),CORPSE_run.scenario_dir(scenario))
+    assert os.path.exists(os.path.join(path,'stats.json')) and not os.path.exists(os.path.join(path,'plot.png'))
+    assert any([r.levelname=='WARNING' and 'no plot' in r.getMessage() for r in caplog.records])
+
+def test_main_failures(tmp_path,capsys):
+    assert CORPSE_run.main([config_file,'--list'])==0
+    assert capsys.readouterr().out.splitlines()==list(CORPSE_run.load_config(config_file)['scenarios'].keys())
+    with pytest.raises(ValueError,match='not in configuration'):
+        CORPSE_run.main([config_file,'--out',str(tmp_path),'--scenario','no such scenario'])
+    with pytest.raises(SystemExit):
+        CORPSE_run.main([config_file,'--format','xlsx'])
+    # A scenario that fails is reported in the exit code
+    path=str(tmp_path/'broken.json')
+    config=CORPSE_run.load_config(config_file)
+    config['defaults']['solver']='no such solver'
+    CORPSE_run.write_config(path,config['scenarios'],config['defaults'])
+    assert CORPSE_run.main([path,'--out',str(tmp_path/'out')])==1
+
+# TOML files have the same structure as JSON files
+def test_load_config(tmp_path):
+    toml=(tmp_path/'config.toml')
+    toml.write_text('[defaults]\nsolver = "ode"\ntimes = {start = 0, stop = 0.5, step = 0.25}\n\n'+
+                    '[scenarios."cold site".envir]\nTmin = [5.0, 8.0]\nclay = 2.5\n')
+    CORPSE_run.write_config(str(tmp_path/'config.json'),{'cold site':{'envir':{'Tmin':numpy.array([5.0,8.0]),'clay':numpy.float64(2.5)}}},
+                            {'solver':'ode','times':{'start':0,'stop':0.5,'step':0.25}})
+    config=CORPSE_run.load_config(str(toml))
+    assert config==CORPSE_run.load_config(str(tmp_path/'config.json'))
+    assert CORPSE_run.get_scenarios(config)=={'cold site':{'solver':'ode','times':{'start':0,'stop':0.5,'step':0.25},
+                                                           'envir':{'Tmin':[5.0,8.0],'clay':2.5}}}
+
+def test_make_times():
+    assert numpy.array_equal(CORPSE_run.make_times({'stop':0.5,'step':0.25}),[0.0,0.25])
+    assert numpy.array_equal(CORPSE_run.make_times({'start':1,'stop':2,'step':0.5}),[1.0,1.5])
+    times=CORPSE_run.make_times([0,1,3])
+    assert times.dtype==float and numpy.array_equal(times,[0.0,1.0,3.0])
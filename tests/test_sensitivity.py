@@ -0,0 +1,74 @@
+# Forward sensitivities (CORPSE_sensitivity) against finite differences, and calibration with them
+import copy
+import numpy
+import pytest
+import CORPSE_solvers
+import CORPSE_ensemble
+import CORPSE_sensitivity
+
+names=['vmaxref.MBC_1.Slow','kC.MBC_1.Fast','eup.MBC_1.Slow','Tmic.MBC_1','et.MBC_2','minMicrobeC.MBC_1','Ea.Fast',
+       'protection_rate.Slow','tProtected']
+
+
+# Arguments of run_sensitivities other than params and parameters: two points at different temperatures, with inputs
+@pytest.fixture(scope='module')
+def sens_kwargs(run_kwargs):
+    args=run_kwargs(2,Tmin=numpy.array([8.0,18.0]),times=numpy.arange(0,0.5,1/365),inputs={'uFastC':0.5},rtol=1e-11,atol=1e-13)
+    del args['params'],args['output']
+    return args
+
+@pytest.fixture(scope='module')
+def sensitivities(params,sens_kwargs):
+    return CORPSE_sensitivity.run_sensitivities(params=params,parameters=names,**sens_kwargs)
+
+def with_param(params,name,value):
+    changed=copy.deepcopy(params)
+    CORPSE_ensemble.set_param(changed,name,value)
+    return changed
+
+
+def test_values_match_run_models_ODE(sensitivities,params,sens_kwargs):
+    results,sens=sensitivities
+    reference=CORPSE_solvers.run_models_ODE(params=params,batch=True,output='array',**sens_kwargs)
+    assert numpy.abs(results.values-reference).max()<=1e-9*numpy.abs(reference).max()
+    assert sorted(sens)==sorted(names)
+
+@pytest.mark.parametrize('name',names)
+def test_sensitivities_match_finite_differences(sensitivities,params,sens_kwargs,name):
+    results,sens=sensitivities
+    value=CORPSE_ensemble.get_param(params,name)
+    # The flux divides differences of records by their (daily) interval, which amplifies solver error in the finite differences,
+    # so the step can't be much smaller than this
+    h=1e-3*abs(value)
+    up,down=[CORPSE_sensitivity.run_sensitivities(params=with_param(params,name,value+s*h),parameters=[],**sens_kwargs)[0] for s in (1,-1)]
+    pools=(up.values-down.values)/(2*h)
+    assert numpy.abs(pools).max()>0
+    assert numpy.abs(sens[name].values-pools).max()<=1e-4*numpy.abs(pools).max()
+    flux=(up.flux('CO2')-down.flux('CO2'))[:,1:]/(2*h)
+    assert numpy.abs(sens[name].flux('CO2')[:,1:]-flux).max()<=1e-2*numpy.abs(flux).max()
+
+# Parameters of microbial groups that have no biomass have no effect
+def test_empty_group_has_zero_sensitivity(params,sens_kwargs):
+    results,sens=CORPSE_sensitivity.run_sensitivities(params=params,parameters='Tmic.MBC_3',**sens_kwargs)
+    assert (sens['Tmic.MBC_3'].values==0).all()
+
+def test_expand_names():
+    assert CORPSE_sensitivity.expand_names('eup.MBC_2')==['eup.MBC_2.'+t for t in ('Fast','Slow','Necro','Py')]
+    with pytest.raises(ValueError):
+        CORPSE_sensitivity.expand_names('vmaxref.Fast')
+    with pytest.raises(ValueError):
+        CORPSE_sensitivity.expand_names('porosity')
+
+# Parameters used to make synthetic observations are found again from a different starting point
+def test_calibrate_recovers_parameters(params,sens_kwargs):
+    fitted=['vmaxref.MBC_1.Slow','eup.MBC_1.Slow','Tmic.MBC_1']
+    kwargs=dict(sens_kwargs,rtol=None,atol=None)
+    observed=CORPSE_sensitivity.observable(CORPSE_sensitivity.run_sensitivities(params=params,parameters=[],**kwargs)[0],'CO2').copy()
+    observed[:,::3]=numpy.nan
+    start=copy.deepcopy(params)
+    for name,factor in zip(fitted,(1.5,0.8,1.3)):
+        CORPSE_ensemble.set_param(start,name,factor*CORPSE_ensemble.get_param(params,name))
+    fit=CORPSE_sensitivity.calibrate(observed,fitted,start,kwargs)
+    for name in fitted:
+        assert fit['values'][name]==pytest.approx(CORPSE_ensemble.get_param(params,name),rel=1e-4)
+    assert CORPSE_ensemble.get_param(start,fitted[0])==1.5*CORPSE_ensemble.get_param(params,fitted[0])
@@ -0,0 +1,118 @@
+# Batching simulation server (CORPSE_server): batched results against direct runs, recovery from a dead worker process
+# and expiry of unfetched results
+import os
+import asyncio
+import multiprocessing
+import numpy
+import pytest
+import CORPSE_server
+import CORPSE_solvers
+
+crash_Tmin=-99.0
+
+
+# Simulation request for the scenario, with one site or (with lists in envir) several
+@pytest.fixture
+def simulation(params,initvals):
+    def simulation(Tmin=10.0,**envir):
+        return {'initvals':initvals,'params':params,'envir':dict({'Tmin':Tmin,'Tmax':24.0,'thetamin':0.5,'thetamax':0.7,'clay':2.5},**envir),
+                'times':{'start':0,'stop':0.1,'step':1/365},'solver_options':{'rtol':1e-10,'atol':1e-12}}
+    return simulation
+
+# Kills the worker process running a batch that has a job with crash_Tmin (as if e.g. it ran out of memory)
+def crashing_run_batch(jobs):
+    if any([(job['envir']['Tmin']==crash_Tmin).any() for job in jobs]):
+        os._exit(1)
+    return run_batch(jobs)
+
+run_batch=CORPSE_server.run_batch
+
+def serve(test,**kwargs):
+    async def main():
+        server=await CORPSE_server.SimulationServer(**kwargs).start(port=0)
+        try:
+            return await test(server)
+        finally:
+            await server.stop()
+    return asyncio.run(main())
+
+
+# Requests with the same settings are run as one batch, and each gets the same result as running it on its own
+def test_batch_matches_direct_runs(simulation):
+    requests=[simulation(5.0),simulation([8.0,12.0],clay=[2.5,10.0],thetamin=[0.4,0.5]),simulation(15.0,Tmax=30.0)]
+    async def test(server):
+        jobs=[server.submit(request) for request in requests]
+        return [await server.result(job_id) for job_id in jobs],server.metrics()
+    jobs,metrics=serve(test,window=0.05,workers=0)
+    assert metrics['batches']==1 and metrics['batch_jobs']['max']==3
+    for request,job in zip(requests,jobs):
+        assert job['status']=='done'
+        envir=request['envir']
+        direct=CORPSE_solvers.run_models_ODE(Tmin=envir['Tmin'],Tmax=envir['Tmax'],thetamin=envir['thetamin'],thetamax=envir['thetamax'],
+                                             times=numpy.arange(0,0.1,1/365),inputs={},params=request['params'],clay=envir['clay'],
+                                             initvals=request['initvals'],output='array',**request['solver_options'])
+        assert job['result'].shape==direct.shape
+        assert numpy.abs(job['result']-direct).max()<=1e-9*numpy.abs(direct).max()
+        # and the same values reach the client
+        assert numpy.array_equal(CORPSE_server.results(CORPSE_server.job_response(job)).values,job['result'])
+
+# Workers compile the parameters of a request once and reuse the model for later batches with the same parameters,
+# although each batch brings its own copy of them
+def test_workers_keep_compiled_models(monkeypatch,simulation):
+    import pickle
+    import CORPSE_array
+    compile_params=CORPSE_array.compile_params
+    compiled=[]
+    monkeypatch.setattr(CORPSE_array,'compile_params',lambda params: compiled.append(params) or compile_params(params))
+    monkeypatch.setattr(CORPSE_server,'worker_models',{})
+    def run(request):
+        key,job=CORPSE_server.pack_request(request)
+        return CORPSE_server.run_batch(pickle.loads(pickle.dumps([job])))
+    first=run(simulation(5.0))
+    assert first[0]=='ok' and len(compiled)==1
+    # Different times (so another batch key) with the same parameters
+    second=run(dict(simulation(5.0),times={'start':0,'stop':0.05,'step':1/365}))
+    assert second[0]=='ok' and len(compiled)==1
+    assert numpy.array_equal(second[1][0],first[1][0][:,:,:second[1][0].shape[2]])
+    changed=simulation(5.0)
+    changed['params']=dict(changed['params'],Tmic=dict(changed['params']['Tmic'],MBC_1=0.75))
+    assert run(changed)[0]=='ok' and len(compiled)==2
+    assert len(CORPSE_server.worker_models)==2
+
+def test_worker_crash(monkeypatch,simulation):
+    if multiprocessing.get_start_method()!='fork':
+        pytest.skip('The crashing batch function only reaches the workers when they are forked')
+    monkeypatch.setattr(CORPSE_server,'run_batch',crashing_run_batch)
+    async def test(server):
+        executor=server.executor
+        job=await server.result(server.submit(simulation(crash_Tmin)))
+        assert job['status']=='failed'
+        assert 'Worker process died' in job['error']
+        assert server.executor is not executor
+        # The new pool runs the next jobs
+        jobs=[server.submit(simulation(T)) for T in (5.0,10.0)]
+        for job_id in jobs:
+            job=await server.result(job_id)
+            assert job['status']=='done'
+        metrics=server.metrics()
+        assert metrics['worker_restarts']==1
+        assert metrics['failed']==1 and metrics['done']==2
+    serve(test,window=0.01,workers=1)
+
+
+def test_result_expiry(simulation):
+    async def test(server):
+        jobs=[server.submit(simulation(T)) for T in (5.0,10.0,15.0)]
+        while server.metrics()['done']<3:
+            await asyncio.sleep(0.01)
+        # Only history finished results are kept: the oldest one was dropped
+        assert server.metrics()['waiting_results']==2
+        assert server.metrics()['expired']==1
+        with pytest.raises(KeyError):
+            server.get_job(jobs[0])
+        # and the others go once they are older than result_ttl
+        await asyncio.sleep(0.3)
+        metrics=server.metrics()
+        assert metrics['waiting_results']==0 and metrics['expired']==3
+        assert len(server.jobs)==0
+    serve(test,window=0.01,workers=0,history=2,result_ttl=0.2)
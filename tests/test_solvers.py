@@ -0,0 +1,50 @@
+# run_models_ODE: all points solved as one batched system against one solver call per point
+import numpy
+import pytest
+import CORPSE_solvers
+import CORPSE_ensemble
+
+npoints=4
+tolerances=dict(rtol=1e-10,atol=1e-12)
+
+
+# Points with their own temperature and moisture cycles and clay, and C inputs
+@pytest.fixture
+def points_kwargs(run_kwargs):
+    return run_kwargs(npoints,Tmin=numpy.linspace(5,20,npoints),Tmax=numpy.linspace(15,30,npoints),thetamin=numpy.linspace(0.3,0.6,npoints),
+                      thetamax=0.75,clay=numpy.array([2.5,5.0,10.0,30.0]),inputs={'uFastC':0.5,'uSlowC':0.2},**tolerances)
+
+def relative_difference(a,b):
+    return numpy.abs(a-b).max()/numpy.abs(b).max()
+
+
+@pytest.mark.parametrize('method',['odeint','BDF'])
+def test_batch_matches_points(points_kwargs,method):
+    batch=CORPSE_solvers.run_models_ODE(batch=True,method=method,**points_kwargs)
+    points=CORPSE_solvers.run_models_ODE(batch=False,method=method,**points_kwargs)
+    assert batch.shape==(len(CORPSE_solvers.fields),npoints,len(points_kwargs['times']))
+    assert relative_difference(batch,points)<=1e-9
+
+# A parameter ensemble has one member per point in both modes
+def test_batch_matches_points_ensemble(points_kwargs,params):
+    ensemble=CORPSE_ensemble.sample_ensemble(params,{'vmaxref.MBC_1.Slow':(0.05,0.5),'Tmic.MBC_2':(0.1,0.5)},npoints,seed=2)
+    batch=CORPSE_solvers.run_models_ODE(batch=True,**dict(points_kwargs,params=ensemble))
+    points=CORPSE_solvers.run_models_ODE(batch=False,**dict(points_kwargs,params=ensemble))
+    assert relative_difference(batch,points)<=1e-9
+    # and the points differ from the base parameters
+    assert relative_difference(batch,CORPSE_solvers.run_models_ODE(batch=True,**points_kwargs))>1e-3
+
+# Pools that stay zero (two microbial groups and most protected pools in this scenario) are dropped from the solve by default.
+# Solving without them gives the same result, and they come back as zeros
+@pytest.mark.parametrize('method,batch',[('odeint',False),('odeint',True),('BDF',True),('iterator',True)])
+def test_pruned_matches_unpruned(points_kwargs,method,batch):
+    if method=='iterator':
+        run=CORPSE_solvers.run_models_iterator
+    else:
+        run=lambda **kwargs: CORPSE_solvers.run_models_ODE(method=method,batch=batch,**kwargs)
+    pruned=run(prune=True,**points_kwargs)
+    unpruned=run(prune=False,**points_kwargs)
+    assert relative_difference(pruned,unpruned)<=1e-9
+    for p in ['MBC_3','MBC_4','pPyC']:
+        n=CORPSE_solvers.fields.index(p)
+        assert (pruned[n]==0).all() and (unpruned[n]==0).all()
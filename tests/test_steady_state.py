@@ -0,0 +1,42 @@
+# find_steady_state (Newton's method, then pseudo-transient continuation) against a long integration at constant conditions
+import numpy
+import pytest
+import CORPSE_solvers
+
+T=numpy.array([10.0,20.0])
+theta=numpy.array([0.4,0.6])
+clay=numpy.array([5.0,20.0])
+inputs={'uFastC':0.3,'uSlowC':0.7}
+
+
+# 3000 years at constant temperature and moisture, long enough for the protected pools (75 year turnover) to settle
+@pytest.fixture(scope='module')
+def spun_up(params,initvals):
+    return CORPSE_solvers.run_models_ODE(Tmin=T,Tmax=T,thetamin=theta,thetamax=theta,times=numpy.array([0.0,3000.0]),inputs=inputs,
+                                         params=params,clay=clay,initvals=initvals,output='array',method='BDF',rtol=1e-10,atol=1e-12)[:,:,-1]
+
+def check_steady_state(SOM,spun_up):
+    for n,p in enumerate(CORPSE_solvers.fields):
+        if p!='CO2':
+            numpy.testing.assert_allclose(SOM[p],spun_up[n],rtol=1e-7,atol=1e-12)
+
+
+# newton_iter=1 sends every point to pseudo-transient continuation
+@pytest.mark.parametrize('newton_iter',[50,1])
+def test_steady_state_matches_spin_up(params,initvals,spun_up,newton_iter):
+    SOM,info=CORPSE_solvers.find_steady_state(T,theta,inputs,params,clay,initvals,newton_iter=newton_iter,full_output=True)
+    assert info['converged'].all()
+    assert (info['residual']<1e-10).all()
+    if newton_iter==1:
+        assert list(info['method'])==['ptc','ptc']
+    check_steady_state(SOM,spun_up)
+    # Cumulative CO2 is kept at its initial value
+    assert (SOM['CO2']==initvals['CO2']).all()
+
+# A point that converges on the last pseudo-time step counts as converged
+def test_ptc_converges_on_last_iteration(params,initvals,spun_up):
+    SOM,info=CORPSE_solvers.find_steady_state(T,theta,inputs,params,clay,initvals,newton_iter=1,full_output=True)
+    ptc_iter=info['iterations'].max()-1
+    SOM,info=CORPSE_solvers.find_steady_state(T,theta,inputs,params,clay,initvals,newton_iter=1,ptc_iter=ptc_iter,full_output=True)
+    assert info['converged'].all()
+    check_steady_state(SOM,spun_up)